@@ -6,9 +6,13 @@ from munch import munchify
 from utils.util import opt_get
 
 
-def create_dataloader(dataset, dataset_opt, opt=None, sampler=None, collate_fn=None, shuffle=True):
+def create_dataloader(dataset, dataset_opt, opt=None, sampler=None, collate_fn=None, shuffle=True, batch_sampler=None):
     phase = dataset_opt['phase']
     pin_memory = opt_get(dataset_opt, ['pin_memory'], True)
+    if batch_sampler is not None:
+        # Batch samplers determine their own batch sizes, ordering and distributed splits.
+        return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, num_workers=dataset_opt['n_workers'],
+                                           pin_memory=pin_memory, collate_fn=collate_fn)
     if phase == 'train':
         if opt_get(opt, ['dist'], False):
             world_size = torch.distributed.get_world_size()
@@ -81,6 +85,8 @@ def create_dataset(dataset_opt, return_collate=False):
         default_params = create_hparams()
         default_params.update(dataset_opt)
         dataset_opt = munchify(default_params)
+    elif mode == 'packed_paired_voice_audio':
+        from data.audio.packed_paired_dataset import PackedPairedVoiceDataset as D
     elif mode == 'fast_paired_voice_audio_with_phonemes':
         from data.audio.fast_paired_dataset_with_phonemes import FastPairedVoiceDataset as D
         from models.audio.tts.tacotron2 import create_hparams
@@ -114,7 +120,7 @@ def create_dataset(dataset_opt, return_collate=False):
 
 def get_dataset_debugger(dataset_opt):
     mode = dataset_opt['mode']
-    if mode == 'paired_voice_audio':
+    if mode == 'paired_voice_audio' or mode == 'packed_paired_voice_audio':
         from data.audio.paired_voice_audio_dataset import PairedVoiceDebugger
         return PairedVoiceDebugger()
     elif mode == 'fast_paired_voice_audio':
@@ -37,10 +37,13 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
     is relative to these offsets.
 
     In practice, this means two things:
-    1) Index {i} of this dataset means nothing: fetching from the same index will almost always return different data.
-       As a result, this dataset should not be used for validation or test runs. Use PairedVoiceAudio dataset instead.
+    1) Index {i} of this dataset means nothing on its own: the offset it seeks to is derived from (seed, epoch, i), so
+       the same index returns different data every epoch. As a result, this dataset should not be used for validation
+       or test runs. Use PairedVoiceAudio dataset instead.
     2) This dataset has a slight bias for items with longer text or longer filenames.
 
+    Because offsets are a deterministic function of the index, a resumed sampler reproduces exactly the same data.
+
     The upshot is that this dataset loads extremely quickly and consumes almost no system memory.
     """
     def __init__(self, hparams):
@@ -54,6 +57,7 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
         self.load_conditioning = opt_get(hparams, ['load_conditioning'], False)
         self.conditioning_candidates = opt_get(hparams, ['num_conditioning_candidates'], 1)
         self.conditioning_length = opt_get(hparams, ['conditioning_length'], 44100)
+        self.similar_clip_index = opt_get(hparams, ['similar_clip_index'], None)
         self.produce_ctc_metadata = opt_get(hparams, ['produce_ctc_metadata'], False)
         self.debug_failures = opt_get(hparams, ['debug_loading_failures'], False)
         self.text_cleaners = hparams.text_cleaners
@@ -71,10 +75,19 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
             self.tokenizer = VoiceBpeTokenizer(opt_get(hparams, ['tokenizer_vocab'], '../experiments/bpe_lowercase_asr_256.json'))
         else:
             self.tokenizer = CharacterTokenizer()
+        text_token_cache = opt_get(hparams, ['text_token_cache'], None)
+        if text_token_cache is not None:
+            from data.audio.text_token_cache import CachedTokenizer
+            self.tokenizer = CachedTokenizer(self.tokenizer, text_token_cache, getattr(self.tokenizer, 'vocab_file', None))
         self.skipped_items = 0  # records how many items are skipped when accessing an index.
 
         self.load_times = torch.zeros((256,))
         self.load_ind = 0
+        self.seed = opt_get(hparams, ['seed'], 0)
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
     def get_wav_text_pair(self, audiopath_and_text):
         # separate filename and text
@@ -93,10 +106,10 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
         assert not torch.any(tokens == 0)
         return tokens
 
-    def load_random_line(self, depth=0):
+    def load_random_line(self, rng, depth=0):
         assert depth < 10
 
-        rand_offset = random.randint(0, self.total_size_bytes)
+        rand_offset = rng.randint(0, self.total_size_bytes)
         for i in range(len(self.paths)):
             if rand_offset < self.paths_size_bytes[i]:
                 break
@@ -110,7 +123,7 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
             try:  # This can fail when seeking to a UTF-8 escape byte.
                 f.readline()
             except:
-                return self.load_random_line(depth=depth + 1), type  # On failure, just recurse and try again.
+                return self.load_random_line(rng, depth=depth + 1), type  # On failure, just recurse and try again.
             l2 = f.readline()
 
         if l2:
@@ -119,7 +132,7 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
                 return parse_tsv_aligned_codes(l2, base_path), type
             except:
                 print(f"error parsing random offset: {sys.exc_info()}")
-        return self.load_random_line(depth=depth+1), type  # On failure, just recurse and try again.
+        return self.load_random_line(rng, depth=depth+1), type  # On failure, just recurse and try again.
 
     def get_ctc_metadata(self, codes):
         grouped = groupby(codes.tolist())
@@ -159,13 +172,14 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
     def __getitem__(self, index):
         start = time.time()
         self.skipped_items += 1
-        apt, type = self.load_random_line()
+        rng = random.Random(f'{self.seed}-{self.epoch}-{index}')
+        apt, type = self.load_random_line(rng)
         try:
             tseq, wav, text, path = self.get_wav_text_pair(apt)
             if text is None or len(text.strip()) == 0:
                 raise ValueError
             cond, cond_is_self = load_similar_clips(apt[0], self.conditioning_length, self.sample_rate,
-                                      n=self.conditioning_candidates) if self.load_conditioning else (None, False)
+                                      n=self.conditioning_candidates, clip_index=self.similar_clip_index) if self.load_conditioning else (None, False)
         except:
             if self.skipped_items > 100:
                 raise  # Rethrow if we have nested too far.
@@ -184,7 +198,7 @@ class FastPairedVoiceDataset(torch.utils.data.Dataset):
             # It's hard to handle this situation properly. Best bet is to return the a random valid token and skew the dataset somewhat as a result.
             if self.debug_failures:
                 print(f"error loading {path}: ranges are out of bounds; {wav.shape[-1]}, {tseq.shape[0]}")
-            rv = random.randint(0,len(self)-1)
+            rv = rng.randint(0,len(self)-1)
             return self[rv]
         orig_output = wav.shape[-1]
         orig_text_len = tseq.shape[0]
@@ -233,6 +247,8 @@ class FastPairedVoiceDebugger:
         self.self_conditioning_items = 0
         self.unique_files = set()
         self.load_time = 0
+        self.real_samples = 0
+        self.padded_samples = 0
 
     def get_state(self):
         return {'total_items': self.total_items,
@@ -249,6 +265,8 @@ class FastPairedVoiceDebugger:
         self.total_items += batch['wav'].shape[0]
         self.loaded_items += batch['skipped_items'].sum().item()
         self.load_time = batch['load_time'].mean().item()
+        self.real_samples += batch['wav_lengths'].sum().item()
+        self.padded_samples += batch['wav'].shape[0] * batch['wav'].shape[-1]
         for filename in batch['filenames']:
             self.unique_files.add(hashlib.sha256(filename.encode('utf-8')))
         if 'conditioning' in batch.keys():
@@ -261,6 +279,7 @@ class FastPairedVoiceDebugger:
             'percent_conditioning_is_self': self.self_conditioning_items / self.loaded_items,
             'unique_files_loaded': len(self.unique_files),
             'load_time': self.load_time,
+            'padding_ratio': 1 - self.real_samples / max(self.padded_samples, 1),
         }
 
 
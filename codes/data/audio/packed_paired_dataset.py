@@ -0,0 +1,338 @@
+import json
+import os
+import random
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+import torchaudio
+from tqdm import tqdm
+
+from data.audio.voice_tokenizer import vocab_fingerprint
+from utils.util import opt_get
+
+
+# Column layout of the shard index. Each row describes one clip; offsets and lengths are in elements of the
+# respective data file, not bytes.
+INDEX_WAV_OFFSET = 0
+INDEX_WAV_LENGTH = 1
+INDEX_TEXT_OFFSET = 2
+INDEX_TEXT_LENGTH = 3
+INDEX_CODES_OFFSET = 4
+INDEX_CODES_LENGTH = 5
+INDEX_STRINGS_OFFSET = 6
+INDEX_STRINGS_LENGTH = 7
+INDEX_TYPE = 8
+INDEX_NEIGHBORS_OFFSET = 9
+INDEX_NEIGHBORS_LENGTH = 10
+INDEX_COLUMNS = 11
+
+PCM_SCALE = 32767
+
+
+def packed_shard_files(prefix):
+    return {
+        'meta': f'{prefix}.json',
+        'index': f'{prefix}.index.npy',
+        'wav': f'{prefix}.wav.bin',
+        'text': f'{prefix}.text.bin',
+        'codes': f'{prefix}.codes.bin',
+        'strings': f'{prefix}.strings.bin',
+        'neighbors': f'{prefix}.neighbors.bin',
+    }
+
+
+class PackedShardWriter:
+    """
+    Appends clips to a packed shard. A shard is a set of flat binary files which hold pre-resampled int16 PCM, tokenized
+    text and aligned codes for every clip back to back, plus an int64 index describing where each clip lives. Each clip
+    can also list the rows of other clips in the shard which are suitable conditioning inputs for it (see
+    data/audio/similar_clip_index.py). The companion reader is PackedPairedVoiceDataset.
+    """
+    def __init__(self, prefix, sample_rate, tokenizer_vocab=None):
+        self.prefix = prefix
+        self.files = packed_shard_files(prefix)
+        self.sample_rate = sample_rate
+        self.tokenizer_vocab = tokenizer_vocab
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        self.handles = {k: open(self.files[k], 'wb') for k in ['wav', 'text', 'codes', 'strings']}
+        self.offsets = {k: 0 for k in self.handles.keys()}
+        self.index = []
+
+    def _append(self, key, data):
+        offset = self.offsets[key]
+        self.handles[key].write(data.tobytes() if isinstance(data, np.ndarray) else data)
+        self.offsets[key] += len(data)
+        return offset, len(data)
+
+    def add(self, wav, tokens, path, text, type=0, codes=None):
+        """
+        wav is a float tensor/array in [-1,1] already resampled to the shard sample rate. tokens and codes are int
+        sequences.
+        """
+        if isinstance(wav, torch.Tensor):
+            wav = wav.squeeze().numpy()
+        pcm = np.round(np.clip(wav, -1, 1) * PCM_SCALE).astype(np.int16)
+        tokens = np.asarray(tokens, dtype=np.int16)
+        codes = np.zeros((0,), dtype=np.int16) if codes is None else np.asarray(codes, dtype=np.int16)
+        strings = f'{path}\t{text}'.encode('utf-8')
+        row = [0] * INDEX_COLUMNS
+        row[INDEX_WAV_OFFSET], row[INDEX_WAV_LENGTH] = self._append('wav', pcm)
+        row[INDEX_TEXT_OFFSET], row[INDEX_TEXT_LENGTH] = self._append('text', tokens)
+        row[INDEX_CODES_OFFSET], row[INDEX_CODES_LENGTH] = self._append('codes', codes)
+        row[INDEX_STRINGS_OFFSET], row[INDEX_STRINGS_LENGTH] = self._append('strings', strings)
+        row[INDEX_TYPE] = type
+        self.index.append(row)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self, neighbors=None):
+        """ neighbors is an optional list (parallel to the added clips) of lists of rows of similar clips. """
+        with open(self.files['neighbors'], 'wb') as f:
+            offset = 0
+            for row, clip_neighbors in zip(self.index, neighbors or []):
+                clip_neighbors = np.asarray(clip_neighbors, dtype=np.int32)
+                f.write(clip_neighbors.tobytes())
+                row[INDEX_NEIGHBORS_OFFSET], row[INDEX_NEIGHBORS_LENGTH] = offset, len(clip_neighbors)
+                offset += len(clip_neighbors)
+        for h in self.handles.values():
+            h.close()
+        np.save(self.files['index'], np.asarray(self.index, dtype=np.int64).reshape(-1, INDEX_COLUMNS))
+        with open(self.files['meta'], 'w', encoding='utf-8') as f:
+            json.dump({'sample_rate': self.sample_rate,
+                       'tokenizer_vocab': self.tokenizer_vocab,
+                       'vocab_fingerprint': vocab_fingerprint(self.tokenizer_vocab),
+                       'num_clips': len(self.index),
+                       'pcm_dtype': 'int16',
+                       'text_dtype': 'int16',
+                       'codes_dtype': 'int16',
+                       'neighbors_dtype': 'int32'}, f, indent=2)
+
+
+class PackedShard:
+    """
+    Read-only view of a shard written by PackedShardWriter. All data files are opened with np.memmap, so fetching a clip
+    is a slice of a page-cached mapping: no per-item file opens, decoding or resampling.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.files = packed_shard_files(prefix)
+        with open(self.files['meta'], 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.index = np.load(self.files['index'], mmap_mode='r')
+        self.wav = self._map('wav', self.meta['pcm_dtype'])
+        self.text = self._map('text', self.meta['text_dtype'])
+        self.codes = self._map('codes', self.meta['codes_dtype'])
+        self.strings = self._map('strings', 'uint8')
+        self.neighbors = self._map('neighbors', self.meta['neighbors_dtype'])
+
+    def _map(self, key, dtype):
+        if os.path.getsize(self.files[key]) == 0:
+            return np.zeros((0,), dtype=dtype)
+        return np.memmap(self.files[key], dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def wav_length(self, i):
+        return int(self.index[i, INDEX_WAV_LENGTH])
+
+    def get_wav(self, i, start=0, length=None):
+        row = self.index[i]
+        offset, total = int(row[INDEX_WAV_OFFSET]), int(row[INDEX_WAV_LENGTH])
+        length = total - start if length is None else min(length, total - start)
+        pcm = np.asarray(self.wav[offset+start:offset+start+length], dtype=np.float32)
+        return torch.from_numpy(pcm).div_(PCM_SCALE).unsqueeze(0)
+
+    def get_text(self, i):
+        row = self.index[i]
+        offset = int(row[INDEX_TEXT_OFFSET])
+        return torch.from_numpy(np.asarray(self.text[offset:offset+int(row[INDEX_TEXT_LENGTH])], dtype=np.int32))
+
+    def get_codes(self, i):
+        row = self.index[i]
+        offset = int(row[INDEX_CODES_OFFSET])
+        return torch.from_numpy(np.asarray(self.codes[offset:offset+int(row[INDEX_CODES_LENGTH])], dtype=np.int64))
+
+    def get_strings(self, i):
+        row = self.index[i]
+        offset = int(row[INDEX_STRINGS_OFFSET])
+        path, text = bytes(self.strings[offset:offset+int(row[INDEX_STRINGS_LENGTH])]).decode('utf-8').split('\t', 1)
+        return path, text
+
+    def get_type(self, i):
+        return int(self.index[i, INDEX_TYPE])
+
+    def get_neighbors(self, i):
+        """ Rows of the clips in this shard which are suitable conditioning inputs for clip i. """
+        row = self.index[i]
+        offset = int(row[INDEX_NEIGHBORS_OFFSET])
+        return self.neighbors[offset:offset+int(row[INDEX_NEIGHBORS_LENGTH])]
+
+
+class PackedPairedVoiceDataset(torch.utils.data.Dataset):
+    """
+    Drop-in replacement for paired_voice_audio which reads from packed shards built with
+    scripts/audio/preparation/build_packed_voice_shards.py. Audio is already resampled and text is already tokenized,
+    so __getitem__ is reduced to memmap slicing and padding. Conditioning clips are cropped from the neighbors stored in
+    the shard, which take the place of paired_voice_audio's similar_clip_index.
+
+    Shards are opened lazily so that each DataLoader worker gets its own mappings rather than pickled copies.
+    """
+    def __init__(self, hparams):
+        self.paths = hparams['path']
+        if not isinstance(self.paths, list):
+            self.paths = [self.paths]
+        self.types = opt_get(hparams, ['types'], None)
+        self.load_conditioning = opt_get(hparams, ['load_conditioning'], False)
+        self.conditioning_candidates = opt_get(hparams, ['num_conditioning_candidates'], 1)
+        self.conditioning_length = opt_get(hparams, ['conditioning_length'], 44100)
+        self.debug_failures = opt_get(hparams, ['debug_loading_failures'], False)
+        self.load_aligned_codes = opt_get(hparams, ['load_aligned_codes'], False)
+        self.sample_rate = opt_get(hparams, ['sample_rate'], 22050)
+        self.aligned_codes_to_audio_ratio = opt_get(hparams, ['aligned_codes_ratio'], 443)
+        self.max_wav_len = opt_get(hparams, ['max_wav_length'], None)
+        self.max_text_len = opt_get(hparams, ['max_text_length'], None)
+        assert self.max_wav_len is not None and self.max_text_len is not None
+        self.max_aligned_codes = self.max_wav_len // self.aligned_codes_to_audio_ratio
+        # Text is stored pre-tokenized, so the shards must have been built with the tokenizer paired_voice_audio would use.
+        if opt_get(hparams, ['use_bpe_tokenizer'], True):
+            self.tokenizer_vocab = opt_get(hparams, ['tokenizer_vocab'], '../experiments/bpe_lowercase_asr_256.json')
+        else:
+            self.tokenizer_vocab = None
+        fingerprint = vocab_fingerprint(self.tokenizer_vocab)
+
+        # Only the index is needed to compute the dataset size and global->shard mapping.
+        self.shard_sizes = []
+        for p in self.paths:
+            with open(packed_shard_files(p)['meta'], 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            assert meta['sample_rate'] == self.sample_rate, f'{p} was packed at {meta["sample_rate"]}hz, dataset expects {self.sample_rate}hz.'
+            assert meta['vocab_fingerprint'] == fingerprint, f'{p} was tokenized with {meta["tokenizer_vocab"] or "the character tokenizer"}, dataset expects {self.tokenizer_vocab or "the character tokenizer"}.'
+            self.shard_sizes.append(meta['num_clips'])
+        self.shard_starts = np.cumsum([0] + self.shard_sizes[:-1])
+        self.total_clips = sum(self.shard_sizes)
+        self.shards = None
+        self.skipped_items = 0
+        self.bucket_sampler = None
+
+    def _get_shards(self):
+        if self.shards is None:
+            self.shards = [PackedShard(p) for p in self.paths]
+        return self.shards
+
+    def _locate(self, index):
+        shard_id = int(np.searchsorted(self.shard_starts, index, side='right')) - 1
+        return shard_id, index - int(self.shard_starts[shard_id])
+
+    def _random_crop(self, shard, i, length):
+        total = shard.wav_length(i)
+        start = random.randint(0, total - length) if total > length else 0
+        clip = shard.get_wav(i, start, length)
+        if clip.shape[-1] < length:
+            clip = F.pad(clip, (0, length - clip.shape[-1]))
+        return clip
+
+    def get_conditioning(self, shard, i):
+        # Like load_similar_clips(), sample the neighbors recorded at packing time with replacement and only fall back to
+        # the clip itself when it has none.
+        neighbors = shard.get_neighbors(i)
+        if len(neighbors) > 0:
+            rows, contains_self = [int(random.choice(neighbors)) for _ in range(self.conditioning_candidates)], False
+        else:
+            rows, contains_self = [i] * self.conditioning_candidates, True
+        clips = [self._random_crop(shard, r, self.conditioning_length) for r in rows]
+        if self.conditioning_candidates > 1:
+            return torch.stack(clips, dim=0), contains_self
+        return clips[0], contains_self
+
+    def get_item_lengths(self):
+        """ Audio length in samples of every item, used by BucketingBatchSampler. """
+        # Deliberately does not populate self.shards: memmaps must not be pickled into DataLoader workers.
+        return np.concatenate([np.asarray(PackedShard(p).index[:, INDEX_WAV_LENGTH]) for p in self.paths])
+
+    def set_bucket_sampler(self, sampler):
+        """ Called with the BucketingBatchSampler when length bucketing is enabled, see substitute_index(). """
+        self.bucket_sampler = sampler
+
+    def substitute_index(self, index, fallback):
+        """
+        Picks the item to load in place of `index` when it cannot be used. With length bucketing this is an item from
+        the same length bucket, so that the batch is still only padded to its bucket maximum. After many consecutive
+        failures (e.g. a bucket full of over-long clips), or without bucketing, it is `fallback`.
+        """
+        if self.bucket_sampler is not None and self.skipped_items <= 50:
+            return self.bucket_sampler.random_bucket_peer(index)
+        return fallback
+
+    def __getitem__(self, index):
+        self.skipped_items += 1
+        shards = self._get_shards()
+        shard_id, i = self._locate(index)
+        shard = shards[shard_id]
+        wav_len = shard.wav_length(i)
+        tseq = shard.get_text(i)
+        if wav_len > self.max_wav_len or tseq.shape[0] > self.max_text_len:
+            if self.debug_failures:
+                print(f"error loading {shard.get_strings(i)[0]}: ranges are out of bounds; {wav_len}, {tseq.shape[0]}")
+            return self[self.substitute_index(index, random.randint(0, len(self)-1))]
+        skipped_items, self.skipped_items = self.skipped_items, 0
+
+        path, text = shard.get_strings(i)
+        wav = shard.get_wav(i)
+        type = shard.get_type(i) if self.types is None else self.types[shard_id]
+        orig_text_len = tseq.shape[0]
+        if wav_len != self.max_wav_len:
+            wav = F.pad(wav, (0, self.max_wav_len - wav_len))
+        if orig_text_len != self.max_text_len:
+            tseq = F.pad(tseq, (0, self.max_text_len - orig_text_len))
+        res = {
+            'real_text': text,
+            'padded_text': tseq,
+            'text_lengths': torch.tensor(orig_text_len, dtype=torch.long),
+            'wav': wav,
+            'wav_lengths': torch.tensor(wav_len, dtype=torch.long),
+            'filenames': path,
+            'skipped_items': skipped_items,
+            'type': type,
+        }
+        if self.load_conditioning:
+            res['conditioning'], res['conditioning_contains_self'] = self.get_conditioning(shard, i)
+        if self.load_aligned_codes:
+            aligned_codes = shard.get_codes(i)
+            res['aligned_codes_lengths'] = aligned_codes.shape[0]
+            res['aligned_codes'] = F.pad(aligned_codes, (0, self.max_aligned_codes - aligned_codes.shape[0]))
+        return res
+
+    def __len__(self):
+        return self.total_clips
+
+
+if __name__ == '__main__':
+    batch_sz = 16
+    params = {
+        'mode': 'packed_paired_voice_audio',
+        'path': ['y:/packed/libritts_train_clean_100'],
+        'phase': 'train',
+        'n_workers': 0,
+        'batch_size': batch_sz,
+        'max_wav_length': 255995,
+        'max_text_length': 200,
+        'sample_rate': 22050,
+        'load_conditioning': True,
+        'num_conditioning_candidates': 2,
+        'conditioning_length': 44000,
+        'load_aligned_codes': False,
+    }
+    from data import create_dataset, create_dataloader
+
+    ds = create_dataset(params)
+    dl = create_dataloader(ds, params)
+    for i, b in tqdm(enumerate(dl)):
+        for ib in range(batch_sz):
+            print(f'{i} {ib} {b["real_text"][ib]}')
+            torchaudio.save(f'{i}_clip_{ib}_wav.wav', b['wav'][ib], 22050)
+        if i > 5:
+            break
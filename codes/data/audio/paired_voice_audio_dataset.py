@@ -1,7 +1,10 @@
+import math
 import os
 import random
 import sys
+from multiprocessing.pool import ThreadPool
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.utils.data
@@ -136,9 +139,11 @@ class TextWavLoader(torch.utils.data.Dataset):
         self.load_conditioning = opt_get(hparams, ['load_conditioning'], False)
         self.conditioning_candidates = opt_get(hparams, ['num_conditioning_candidates'], 1)
         self.conditioning_length = opt_get(hparams, ['conditioning_length'], 44100)
+        self.similar_clip_index = opt_get(hparams, ['similar_clip_index'], None)
         self.debug_failures = opt_get(hparams, ['debug_loading_failures'], False)
         self.load_aligned_codes = opt_get(hparams, ['load_aligned_codes'], False)
         self.aligned_codes_to_audio_ratio = opt_get(hparams, ['aligned_codes_ratio'], 443)
+        self.item_lengths_cache = opt_get(hparams, ['item_lengths_cache'], None)
         self.audiopaths_and_text = []
         for p, fm, type in zip(self.path, fetcher_mode, self.types):
             if fm == 'lj' or fm == 'libritts':
@@ -169,7 +174,12 @@ class TextWavLoader(torch.utils.data.Dataset):
             self.tokenizer = VoiceBpeTokenizer(opt_get(hparams, ['tokenizer_vocab'], '../experiments/bpe_lowercase_asr_256.json'))
         else:
             self.tokenizer = CharacterTokenizer()
+        text_token_cache = opt_get(hparams, ['text_token_cache'], None)
+        if text_token_cache is not None:
+            from data.audio.text_token_cache import CachedTokenizer
+            self.tokenizer = CachedTokenizer(self.tokenizer, text_token_cache, getattr(self.tokenizer, 'vocab_file', None))
         self.skipped_items = 0  # records how many items are skipped when accessing an index.
+        self.bucket_sampler = None
 
     def get_wav_text_pair(self, audiopath_and_text):
         # separate filename and text
@@ -188,6 +198,53 @@ class TextWavLoader(torch.utils.data.Dataset):
         assert not torch.any(tokens == 0)
         return tokens
 
+    def get_item_lengths(self):
+        """
+        Audio length in samples (at sample_rate) of every item, used by BucketingBatchSampler. Lengths are read from the
+        audio file headers once and cached in `item_lengths_cache`, which defaults to a file next to the first dataset
+        index. Files that cannot be read are given a length of 0; they are skipped when loaded anyway.
+        """
+        cache_path = self.item_lengths_cache or f'{self.path[0]}.item_lengths.npz'
+        known = {}
+        if os.path.exists(cache_path):
+            cached = np.load(cache_path)
+            known = dict(zip(cached['paths'].tolist(), cached['lengths'].tolist()))
+        missing = sorted(set(apt[0] for apt in self.audiopaths_and_text if apt[0] not in known))
+        if len(missing) > 0:
+            print(f'Reading the lengths of {len(missing)} audio files for length bucketing..')
+            with ThreadPool(16) as pool:
+                lengths = list(tqdm(pool.imap(self._read_item_length, missing, chunksize=64), total=len(missing)))
+            known.update(zip(missing, lengths))
+            np.savez(cache_path, paths=np.asarray(list(known.keys())), lengths=np.asarray(list(known.values()), dtype=np.int64))
+        return [known[apt[0]] for apt in self.audiopaths_and_text]
+
+    def _read_item_length(self, path):
+        try:
+            info = torchaudio.info(path)
+            if info.num_frames > 0:
+                return int(math.ceil(info.num_frames * self.sample_rate / info.sample_rate))
+        except (OSError, RuntimeError):
+            pass
+        # Some backends cannot read the length of every format (e.g. some mp3s) from its header.
+        try:
+            return load_audio(path, self.sample_rate).shape[-1]
+        except (OSError, EOFError, ValueError, RuntimeError, TypeError):
+            return 0
+
+    def set_bucket_sampler(self, sampler):
+        """ Called with the BucketingBatchSampler when length bucketing is enabled, see substitute_index(). """
+        self.bucket_sampler = sampler
+
+    def substitute_index(self, index, fallback):
+        """
+        Picks the item to load in place of `index` when it cannot be used. With length bucketing this is an item from
+        the same length bucket, so that the batch is still only padded to its bucket maximum. After many consecutive
+        failures (e.g. a bucket full of over-long clips), or without bucketing, it is `fallback`.
+        """
+        if self.bucket_sampler is not None and self.skipped_items <= 50:
+            return self.bucket_sampler.random_bucket_peer(index)
+        return fallback
+
     def __getitem__(self, index):
         self.skipped_items += 1
         try:
@@ -198,19 +255,17 @@ class TextWavLoader(torch.utils.data.Dataset):
                 # Ultra short clips are also useless (and can cause problems within some models).
                 raise ValueError
             cond, cond_is_self = load_similar_clips(self.audiopaths_and_text[index][0], self.conditioning_length, self.sample_rate,
-                                      n=self.conditioning_candidates) if self.load_conditioning else (None, False)
+                                      n=self.conditioning_candidates, clip_index=self.similar_clip_index) if self.load_conditioning else (None, False)
         except:
             if self.skipped_items > 100:
                 raise  # Rethrow if we have nested too far.
             if self.debug_failures:
                 print(f"error loading {self.audiopaths_and_text[index][0]} {sys.exc_info()}")
-            return self[(index+1) % len(self)]
+            return self[self.substitute_index(index, (index+1) % len(self))]
 
         if self.load_aligned_codes:
             aligned_codes = self.audiopaths_and_text[index][3]
 
-        actually_skipped_items = self.skipped_items
-        self.skipped_items = 0
         if wav is None or \
             (self.max_wav_len is not None and wav.shape[-1] > self.max_wav_len) or \
             (self.max_text_len is not None and tseq.shape[0] > self.max_text_len):
@@ -219,9 +274,13 @@ class TextWavLoader(torch.utils.data.Dataset):
             if self.debug_failures:
                 print(f"error loading {path}: ranges are out of bounds; {wav.shape[-1]}, {tseq.shape[0]}")
             rv = random.randint(0,len(self)-1)
-            return self[rv]
+            return self[self.substitute_index(index, rv)]
+        actually_skipped_items = self.skipped_items
+        self.skipped_items = 0
         orig_output = wav.shape[-1]
         orig_text_len = tseq.shape[0]
+        if self.load_aligned_codes:
+            orig_aligned_codes_len = aligned_codes.shape[0]
         if wav.shape[-1] != self.max_wav_len:
             wav = F.pad(wav, (0, self.max_wav_len - wav.shape[-1]))
             if self.load_aligned_codes:
@@ -244,6 +303,7 @@ class TextWavLoader(torch.utils.data.Dataset):
             res['conditioning_contains_self'] = cond_is_self
         if self.load_aligned_codes:
             res['aligned_codes'] = aligned_codes
+            res['aligned_codes_lengths'] = orig_aligned_codes_len
         return res
 
     def __len__(self):
@@ -255,6 +315,8 @@ class PairedVoiceDebugger:
         self.total_items = 0
         self.loaded_items = 0
         self.self_conditioning_items = 0
+        self.real_samples = 0
+        self.padded_samples = 0
 
     def get_state(self):
         return {'total_items': self.total_items,
@@ -270,6 +332,8 @@ class PairedVoiceDebugger:
     def update(self, batch):
         self.total_items += batch['wav'].shape[0]
         self.loaded_items += batch['skipped_items'].sum().item()
+        self.real_samples += batch['wav_lengths'].sum().item()
+        self.padded_samples += batch['wav'].shape[0] * batch['wav'].shape[-1]
         if 'conditioning' in batch.keys():
             self.self_conditioning_items += batch['conditioning_contains_self'].sum().item()
 
@@ -278,6 +342,7 @@ class PairedVoiceDebugger:
             'total_samples_loaded': self.total_items,
             'percent_skipped_samples': (self.loaded_items - self.total_items) / self.loaded_items,
             'percent_conditioning_is_self': self.self_conditioning_items / self.loaded_items,
+            'padding_ratio': 1 - self.real_samples / max(self.padded_samples, 1),
         }
 
 
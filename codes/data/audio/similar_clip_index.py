@@ -0,0 +1,154 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+def similar_clip_index_files(prefix):
+    return {
+        'meta': f'{prefix}.json',
+        'paths': f'{prefix}.paths.bin',
+        'path_offsets': f'{prefix}.path_offsets.npy',
+        'hashes': f'{prefix}.hashes.npy',
+        'hash_ids': f'{prefix}.hash_ids.npy',
+        'indptr': f'{prefix}.indptr.npy',
+        'neighbors': f'{prefix}.neighbors.npy',
+    }
+
+
+def normalize_clip_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def hash_clip_path(path):
+    return int.from_bytes(hashlib.blake2b(normalize_clip_path(path).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def write_similar_clip_index(prefix, paths, neighbors):
+    """
+    Writes a similar clip index. paths is a list of clip paths; clip IDs are positions in this list. neighbors is a list
+    (parallel to paths) of lists of clip IDs which are acceptable conditioning candidates for that clip.
+    """
+    files = similar_clip_index_files(prefix)
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+
+    encoded = [normalize_clip_path(p).encode('utf-8') for p in paths]
+    offsets = np.zeros((len(encoded)+1,), dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    with open(files['paths'], 'wb') as f:
+        for e in encoded:
+            f.write(e)
+    np.save(files['path_offsets'], offsets)
+
+    hashes = np.asarray([hash_clip_path(p) for p in paths], dtype=np.uint64)
+    order = np.argsort(hashes, kind='stable')
+    np.save(files['hashes'], hashes[order])
+    np.save(files['hash_ids'], order.astype(np.int64))
+
+    indptr = np.zeros((len(neighbors)+1,), dtype=np.int64)
+    np.cumsum([len(n) for n in neighbors], out=indptr[1:])
+    flat = np.fromiter((c for n in neighbors for c in n), dtype=np.int64, count=int(indptr[-1]))
+    np.save(files['indptr'], indptr)
+    np.save(files['neighbors'], flat)
+
+    with open(files['meta'], 'w', encoding='utf-8') as f:
+        json.dump({'num_clips': len(paths), 'num_edges': int(indptr[-1])}, f, indent=2)
+
+
+def build_index_from_similarities(roots, prefix):
+    """
+    Compiles every 'similarities.pth' file found under roots (as written by phase_3_generate_similarities.py) into a
+    single global index.
+    """
+    paths = []
+    ids = {}
+    neighbors = []
+
+    def get_id(p):
+        p = normalize_clip_path(p)
+        if p not in ids:
+            ids[p] = len(paths)
+            paths.append(p)
+            neighbors.append([])
+        return ids[p]
+
+    sim_files = []
+    for root in roots:
+        for dirpath, _, fnames in os.walk(root):
+            if 'similarities.pth' in fnames:
+                sim_files.append(os.path.join(dirpath, 'similarities.pth'))
+    for sim_file in tqdm(sim_files):
+        base = os.path.dirname(sim_file)
+        similarities = torch.load(sim_file)
+        for fname, similar in similarities.items():
+            clip_id = get_id(os.path.join(base, fname))
+            neighbors[clip_id] = [get_id(os.path.join(base, s)) for s in similar]
+    write_similar_clip_index(prefix, paths, neighbors)
+    print(f'Indexed {len(paths)} clips from {len(sim_files)} similarity files into {prefix}.')
+
+
+class SimilarClipIndex:
+    """
+    Memory-mapped global map from a clip to the clips which are suitable conditioning inputs for it, stored as CSR
+    arrays. Because every array is an np.memmap, the index is shared by the page cache across DataLoader workers rather
+    than being unpickled per item (or copied per worker).
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.files = similar_clip_index_files(prefix)
+        self.path_offsets = np.load(self.files['path_offsets'], mmap_mode='r')
+        self.paths = np.memmap(self.files['paths'], dtype=np.uint8, mode='r') if self.path_offsets[-1] > 0 else np.zeros((0,), dtype=np.uint8)
+        self.hashes = np.load(self.files['hashes'], mmap_mode='r')
+        self.hash_ids = np.load(self.files['hash_ids'], mmap_mode='r')
+        self.indptr = np.load(self.files['indptr'], mmap_mode='r')
+        self.neighbors = np.load(self.files['neighbors'], mmap_mode='r')
+
+    def __len__(self):
+        return self.indptr.shape[0] - 1
+
+    def path_of(self, clip_id):
+        return bytes(self.paths[self.path_offsets[clip_id]:self.path_offsets[clip_id+1]]).decode('utf-8')
+
+    def id_of(self, path):
+        """ Returns the clip ID for path, or None if it is not in the index. """
+        h = np.uint64(hash_clip_path(path))
+        pos = int(np.searchsorted(self.hashes, h))
+        norm = normalize_clip_path(path)
+        while pos < len(self.hashes) and self.hashes[pos] == h:
+            clip_id = int(self.hash_ids[pos])
+            if self.path_of(clip_id) == norm:
+                return clip_id
+            pos += 1
+        return None
+
+    def neighbor_ids(self, clip_id):
+        return self.neighbors[self.indptr[clip_id]:self.indptr[clip_id+1]]
+
+    def similar_paths(self, path):
+        """ Returns the paths of the clips similar to path, or an empty list if there are none. """
+        clip_id = self.id_of(path)
+        if clip_id is None:
+            return []
+        return [self.path_of(int(n)) for n in self.neighbor_ids(clip_id)]
+
+
+_open_indices = {}
+
+
+def get_similar_clip_index(prefix):
+    """ Opens the index at prefix once per process. """
+    if prefix not in _open_indices:
+        _open_indices[prefix] = SimilarClipIndex(prefix)
+    return _open_indices[prefix]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', nargs='+', required=True, help='Root directories to search for similarities.pth files.')
+    parser.add_argument('--output', required=True, help='Prefix of the index files to write.')
+    args = parser.parse_args()
+    build_index_from_similarities(args.path, args.output)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from data.audio.voice_tokenizer import vocab_fingerprint
+
+
+# Column layout of the cache index. Rows are sorted by (key, check) so that lookups are a binary search; offsets and
+# lengths are in tokens. The check hash tells apart texts whose keys collide.
+INDEX_KEY = 0
+INDEX_CHECK = 1
+INDEX_OFFSET = 2
+INDEX_LENGTH = 3
+INDEX_COLUMNS = 4
+
+
+def text_token_cache_files(prefix):
+    return {
+        'meta': f'{prefix}.json',
+        'index': f'{prefix}.index.npy',
+        'tokens': f'{prefix}.tokens.bin',
+    }
+
+
+def text_key(text):
+    """ 64-bit hash of the raw (uncleaned) text, stored as int64. """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def text_check(text):
+    """ A second 64-bit hash of the raw text, independent of text_key(). """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8, person=b'text_check').digest(),
+                          'little', signed=True)
+
+
+class TextTokenCacheWriter:
+    """
+    Writes a text token cache: the tokenized form of every text in a corpus, stored back to back as int16 in a flat binary
+    file, plus an int64 index keyed by a hash of the raw text. The companion reader is TextTokenCache.
+    """
+    def __init__(self, prefix, vocab_file):
+        self.prefix = prefix
+        self.files = text_token_cache_files(prefix)
+        self.vocab_file = vocab_file
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        self.handle = open(self.files['tokens'], 'wb')
+        self.offset = 0
+        self.index = []
+
+    def add(self, text, tokens):
+        tokens = np.asarray(tokens, dtype=np.int64)
+        # Tokens are stored as int16, which larger vocabs would silently wrap.
+        assert len(tokens) == 0 or (tokens.min() >= 0 and tokens.max() < 2**15), f'Token IDs of {text!r} do not fit in int16.'
+        tokens = tokens.astype(np.int16)
+        self.handle.write(tokens.tobytes())
+        self.index.append((text_key(text), text_check(text), self.offset, len(tokens)))
+        self.offset += len(tokens)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.handle.close()
+        index = np.asarray(self.index, dtype=np.int64).reshape(-1, INDEX_COLUMNS)
+        # Sort by (key, check) and drop duplicate texts, keeping the first occurrence. lexsort is stable.
+        index = index[np.lexsort((index[:, INDEX_CHECK], index[:, INDEX_KEY]))]
+        duplicate = np.zeros((index.shape[0],), dtype=bool)
+        duplicate[1:] = (index[1:, INDEX_KEY] == index[:-1, INDEX_KEY]) & (index[1:, INDEX_CHECK] == index[:-1, INDEX_CHECK])
+        index = index[~duplicate]
+        np.save(self.files['index'], index)
+        with open(self.files['meta'], 'w', encoding='utf-8') as f:
+            json.dump({'tokenizer_vocab': self.vocab_file,
+                       'vocab_fingerprint': vocab_fingerprint(self.vocab_file),
+                       'num_texts': int(index.shape[0]),
+                       'tokens_dtype': 'int16'}, f, indent=2)
+        return index.shape[0]
+
+
+class TextTokenCache:
+    """
+    Read-only view of a cache written by TextTokenCacheWriter. Lookups binary search the memory-mapped index and slice
+    the memory-mapped tokens, so no text cleaning or BPE encoding is done for cached texts.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.files = text_token_cache_files(prefix)
+        with open(self.files['meta'], 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.index = np.load(self.files['index'], mmap_mode='r')
+        if os.path.getsize(self.files['tokens']) == 0:
+            self.tokens = np.zeros((0,), dtype=self.meta['tokens_dtype'])
+        else:
+            self.tokens = np.memmap(self.files['tokens'], dtype=self.meta['tokens_dtype'], mode='r')
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def get(self, text):
+        """ Returns the cached tokens of `text`, or None when it is not in the cache. """
+        key, check = text_key(text), text_check(text)
+        keys = self.index[:, INDEX_KEY]
+        i = int(np.searchsorted(keys, key))
+        # Texts whose keys collide sit next to each other; the check hash picks the right one.
+        while i < len(keys) and keys[i] == key:
+            if self.index[i, INDEX_CHECK] == check:
+                offset, length = int(self.index[i, INDEX_OFFSET]), int(self.index[i, INDEX_LENGTH])
+                return np.asarray(self.tokens[offset:offset+length], dtype=np.int32).tolist()
+            i += 1
+        return None
+
+
+class CachedTokenizer:
+    """
+    Wraps a VoiceBpeTokenizer or CharacterTokenizer so that encode() is served from text token caches built by
+    scripts/audio/preparation/build_text_token_cache.py, falling back to live tokenization for texts that are not cached.
+
+    Caches that were built with a different vocab than `vocab_file` are ignored with a warning. Like
+    PackedPairedVoiceDataset, the memmaps are opened lazily so that each DataLoader worker gets its own mappings.
+    """
+    def __init__(self, tokenizer, cache_prefixes, vocab_file):
+        if not isinstance(cache_prefixes, list):
+            cache_prefixes = [cache_prefixes]
+        self.tokenizer = tokenizer
+        fingerprint = vocab_fingerprint(vocab_file)
+        self.cache_prefixes = []
+        for prefix in cache_prefixes:
+            with open(text_token_cache_files(prefix)['meta'], 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta['vocab_fingerprint'] != fingerprint:
+                print(f'Ignoring text token cache {prefix}: it was built with a different tokenizer vocab than '
+                      f'{vocab_file}. Rebuild it with scripts/audio/preparation/build_text_token_cache.py.')
+                continue
+            self.cache_prefixes.append(prefix)
+        self.caches = None
+
+    def _get_caches(self):
+        if self.caches is None:
+            self.caches = [TextTokenCache(p) for p in self.cache_prefixes]
+        return self.caches
+
+    def __getstate__(self):
+        # Memmaps must not be pickled into DataLoader workers.
+        state = self.__dict__.copy()
+        state['caches'] = None
+        return state
+
+    def encode(self, txt):
+        for cache in self._get_caches():
+            tokens = cache.get(txt)
+            if tokens is not None:
+                return tokens
+        return self.tokenizer.encode(txt)
+
+    def decode(self, seq):
+        return self.tokenizer.decode(seq)
@@ -9,6 +9,7 @@ import torchaudio
 from audio2numpy import open_audio
 from tqdm import tqdm
 
+from data.audio.similar_clip_index import get_similar_clip_index, normalize_clip_path
 from data.util import find_files_of_type, is_audio_file, load_paths_from_cache
 from models.audio.tts.tacotron2.taco_utils import load_wav_to_torch
 from utils.util import opt_get
@@ -46,10 +47,14 @@ def load_audio(audiopath, sampling_rate):
     return audio.unsqueeze(0)
 
 
-def load_similar_clips(path, sample_length, sample_rate, n=3, fallback_to_self=True):
+def load_similar_clips(path, sample_length, sample_rate, n=3, fallback_to_self=True, clip_index=None):
     sim_path = os.path.join(os.path.dirname(path), 'similarities.pth')
     candidates = []
-    if os.path.exists(sim_path):
+    if clip_index is not None:
+        # A compiled SimilarClipIndex replaces the per-directory similarities.pth lookup.
+        path = normalize_clip_path(path)
+        candidates = get_similar_clip_index(clip_index).similar_paths(path)
+    elif os.path.exists(sim_path):
         similarities = torch.load(sim_path)
         fname = os.path.basename(path)
         if fname in similarities.keys():
@@ -120,6 +125,7 @@ class UnsupervisedAudioDataset(torch.utils.data.Dataset):
         # "Extra samples" are other audio clips pulled from wav files in the same directory as the 'clip' wav file.
         self.extra_samples = opt_get(opt, ['extra_samples'], 0)
         self.extra_sample_len = opt_get(opt, ['extra_sample_length'], 44000)
+        self.similar_clip_index = opt_get(opt, ['similar_clip_index'], None)
 
         self.debug_loading_failures = opt_get(opt, ['debug_loading_failures'], True)
 
@@ -135,7 +141,8 @@ class UnsupervisedAudioDataset(torch.utils.data.Dataset):
         if self.extra_samples <= 0:
             return None, 0
         audiopath = self.audiopaths[index]
-        return load_similar_clips(audiopath, self.extra_sample_len, self.sampling_rate, n=self.extra_samples)
+        return load_similar_clips(audiopath, self.extra_sample_len, self.sampling_rate, n=self.extra_samples,
+                                  clip_index=self.similar_clip_index)
 
     def __getitem__(self, index):
         try:
@@ -1,3 +1,4 @@
+import hashlib
 import re
 
 import torch
@@ -11,25 +12,40 @@ from models.audio.tts.tacotron2 import load_filepaths_and_text
 from models.audio.tts.tacotron2.text.cleaners import english_cleaners
 
 
+CHARACTER_TOKENIZER_FINGERPRINT = 'character_tokenizer'
+
+_REPLACEMENT_PUNCTUATION = {
+    '{': '(', '}': ')',
+    '[': '(', ']': ')',
+    '`': '\'', '—': '-',
+    '—': '-', '`': '\'',
+    'ʼ': '\''
+}
+_REPLACE_PUNCTUATION_RE = re.compile("|".join([re.escape(k) for k in sorted(_REPLACEMENT_PUNCTUATION, key=len, reverse=True)]), flags=re.DOTALL)
+# TODO: some of these are spoken ('@', '%', '+', etc). Integrate them into the cleaners.
+_EXTRANEOUS_RE = re.compile(r'^[@#%_=\$\^&\*\+\\]$')
+
+
 def remove_extraneous_punctuation(word):
-    replacement_punctuation = {
-        '{': '(', '}': ')',
-        '[': '(', ']': ')',
-        '`': '\'', '—': '-',
-        '—': '-', '`': '\'',
-        'ʼ': '\''
-    }
-    replace = re.compile("|".join([re.escape(k) for k in sorted(replacement_punctuation, key=len, reverse=True)]), flags=re.DOTALL)
-    word = replace.sub(lambda x: replacement_punctuation[x.group(0)], word)
-
-    # TODO: some of these are spoken ('@', '%', '+', etc). Integrate them into the cleaners.
-    extraneous = re.compile(r'^[@#%_=\$\^&\*\+\\]$')
-    word = extraneous.sub('', word)
+    word = _REPLACE_PUNCTUATION_RE.sub(lambda x: _REPLACEMENT_PUNCTUATION[x.group(0)], word)
+    word = _EXTRANEOUS_RE.sub('', word)
     return word
 
 
+def vocab_fingerprint(vocab_file):
+    """
+    Identifies the tokenizer that pre-tokenized data was built with: the hash of the BPE vocab file, or a constant for the
+    character tokenizer (vocab_file=None). Changing the vocab file in any way changes the fingerprint.
+    """
+    if vocab_file is None:
+        return CHARACTER_TOKENIZER_FINGERPRINT
+    with open(vocab_file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
 class VoiceBpeTokenizer:
     def __init__(self, vocab_file):
+        self.vocab_file = vocab_file
         if vocab_file is not None:
             self.tokenizer = Tokenizer.from_file(vocab_file)
 
@@ -43,6 +59,14 @@ class VoiceBpeTokenizer:
         txt = txt.replace(' ', '[SPACE]')
         return self.tokenizer.encode(txt).ids
 
+    def encode_batch(self, txts):
+        """
+        Encodes a list of strings at once. Text cleaning still runs per string, but BPE encoding is batched (and
+        parallelized) by the tokenizers library.
+        """
+        txts = [self.preprocess_text(txt).replace(' ', '[SPACE]') for txt in txts]
+        return [e.ids for e in self.tokenizer.encode_batch(txts)]
+
     def decode(self, seq):
         if isinstance(seq, torch.Tensor):
             seq = seq.cpu().numpy()
@@ -2,13 +2,64 @@
 Modified from torch.utils.data.distributed.DistributedSampler
 Support enlarging the dataset for *iteration-oriented* training, for saving time when restart the
 dataloader after each epoch
+
+All samplers here are deterministic functions of (seed, epoch, position) and can be started at an arbitrary position
+within an epoch via set_start(), which is how training resumes mid-epoch without replaying or skipping data.
 """
 import math
-import torch
+import random
+
+import numpy as np
 from torch.utils.data.sampler import Sampler
 import torch.distributed as dist
 
 
+class FeistelPermutation:
+    """Pseudo-random bijection on [0, n), evaluated lazily for any set of positions.
+
+    This stands in for torch.randperm(n) on very large datasets: nothing of size n is ever materialized, so creating a
+    new permutation per epoch is free and seeking to position p of an epoch is O(1).
+
+    Implemented as a balanced Feistel network over the smallest even number of bits covering n, with cycle-walking to
+    map values that land outside of [0, n) back into range.
+    """
+    MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+    MIX2 = np.uint64(0x94d049bb133111eb)
+
+    def __init__(self, n, seed, rounds=6):
+        self.n = n
+        bits = max(2, int(math.ceil(math.log2(max(n, 2)))))
+        bits += bits % 2
+        self.half_bits = np.uint64(bits // 2)
+        self.mask = np.uint64((1 << (bits // 2)) - 1)
+        rng = np.random.default_rng(seed)
+        self.keys = [np.uint64(k) for k in rng.integers(0, 2**63 - 1, size=rounds, dtype=np.int64)]
+
+    def _round(self, r, key):
+        z = (r ^ key) * self.MIX1
+        z ^= z >> np.uint64(31)
+        z *= self.MIX2
+        z ^= z >> np.uint64(29)
+        return z & self.mask
+
+    def _encrypt(self, v):
+        left = v >> self.half_bits
+        right = v & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self.half_bits) | right
+
+    def __call__(self, positions):
+        if self.n == 0:
+            return np.zeros((0,), dtype=np.int64)
+        v = self._encrypt(np.asarray(positions, dtype=np.uint64))
+        out_of_range = v >= self.n
+        while out_of_range.any():
+            v[out_of_range] = self._encrypt(v[out_of_range])
+            out_of_range = v >= self.n
+        return v.astype(np.int64)
+
+
 class DistIterSampler(Sampler):
     """Sampler that restricts data loading to a subset of the dataset.
 
@@ -25,9 +76,12 @@ class DistIterSampler(Sampler):
         num_replicas (optional): Number of processes participating in
             distributed training.
         rank (optional): Rank of the current process within num_replicas.
+        seed (optional): Combined with the epoch to seed the permutation.
     """
 
-    def __init__(self, dataset, num_replicas=None, rank=None, ratio=100):
+    CHUNK_SIZE = 65536
+
+    def __init__(self, dataset, num_replicas=None, rank=None, ratio=100, seed=0):
         if num_replicas is None:
             if not dist.is_available():
                 raise RuntimeError("Requires distributed package to be available")
@@ -39,27 +93,152 @@ class DistIterSampler(Sampler):
         self.dataset = dataset
         self.num_replicas = num_replicas
         self.rank = rank
+        self.seed = seed
         self.epoch = 0
+        self.start = 0
         self.num_samples = int(math.ceil(len(self.dataset) * ratio / self.num_replicas))
         self.total_size = self.num_samples * self.num_replicas
 
     def __iter__(self):
         # deterministically shuffle based on epoch
-        g = torch.Generator()
-        g.manual_seed(self.epoch)
-        indices = torch.randperm(self.total_size, generator=g).tolist()
-
+        perm = FeistelPermutation(self.total_size, (self.seed, self.epoch))
         dsize = len(self.dataset)
-        indices = [v % dsize for v in indices]
+        start, self.start = self.start, 0  # Only the first iteration after set_start() is offset.
+        for chunk_start in range(start, self.num_samples, self.CHUNK_SIZE):
+            # subsample: this rank gets every num_replicas'th position of the permutation.
+            positions = np.arange(chunk_start, min(chunk_start + self.CHUNK_SIZE, self.num_samples), dtype=np.int64)
+            indices = perm(positions * self.num_replicas + self.rank) % dsize
+            yield from indices.tolist()
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, position):
+        """Causes the next iteration to begin at sample `position` of the current epoch."""
+        self.start = position
+
+
+class BucketingBatchSampler(Sampler):
+    """Batch sampler which groups items of similar length together to minimize padding.
+
+    Items are sorted by length and split into `num_buckets` equally sized buckets. Each bucket gets its own batch size:
+    `batch_size`, reduced if necessary so that `batch_size * bucket_max_length <= max_batch_samples`. Batches are
+    therefore only ever padded to their bucket's maximum length (see LengthTrimmingCollate), and long-clip batches
+    never exceed the memory budget of short-clip batches.
+
+    Batches are shuffled within buckets and then across buckets, deterministically from `seed` and the epoch. Both
+    shuffles are FeistelPermutations, so only the length-sorted order of the dataset is ever held in memory.
+
+    Arguments:
+        lengths: Per-item lengths (e.g. audio samples), indexable by dataset index.
+        batch_size: Maximum number of items in a batch.
+        max_batch_samples (optional): Maximum of (items in batch * padded length) for any batch.
+        num_buckets: Number of length buckets.
+        num_replicas (optional): Number of processes participating in distributed training.
+        rank (optional): Rank of the current process within num_replicas.
+    """
+
+    def __init__(self, lengths, batch_size, max_batch_samples=None, num_buckets=10, seed=0, drop_last=True,
+                 num_replicas=1, rank=0):
+        lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_batch_samples = max_batch_samples
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+        self._cached_permutations = None
 
-        # subsample
-        indices = indices[self.rank:self.total_size:self.num_replicas]
-        assert len(indices) == self.num_samples
+        order = np.argsort(lengths, kind='stable')
+        self.order = order.astype(np.int32) if len(order) < 2**31 else order
+        # Position of every item in the length-sorted order, used to find its bucket.
+        self.positions = np.empty_like(self.order)
+        self.positions[self.order] = np.arange(len(order), dtype=self.order.dtype)
+        bounds = np.linspace(0, len(order), num_buckets + 1).astype(np.int64)
+        self.bucket_starts, self.bucket_sizes, self.bucket_batch_sizes, self.bucket_max_lengths = [], [], [], []
+        self.real_samples = 0
+        bucket_batches = []
+        for b_start, b_end in zip(bounds[:-1], bounds[1:]):
+            if b_end <= b_start:
+                continue
+            max_length = int(lengths[order[b_end-1]])
+            bs = batch_size
+            if max_batch_samples is not None:
+                bs = max(1, min(bs, int(max_batch_samples // max(max_length, 1))))
+            size = int(b_end - b_start)
+            self.bucket_starts.append(int(b_start))
+            self.bucket_sizes.append(size)
+            self.bucket_batch_sizes.append(bs)
+            self.bucket_max_lengths.append(max_length)
+            self.real_samples += int(lengths[order[b_start:b_end]].sum())
+            bucket_batches.append(size // bs if drop_last else int(math.ceil(size / bs)))
+        self.bucket_batch_offsets = np.cumsum([0] + bucket_batches)
+        self.total_batches = int(self.bucket_batch_offsets[-1])
+        # Every rank must step the same number of times.
+        self.num_batches = self.total_batches // self.num_replicas
 
-        return iter(indices)
+    def _permutations(self, epoch):
+        if self._cached_permutations is None or self._cached_permutations[0] != epoch:
+            self._cached_permutations = (epoch, FeistelPermutation(self.total_batches, (self.seed, epoch)),
+                                         [FeistelPermutation(size, (self.seed, epoch, bucket))
+                                          for bucket, size in enumerate(self.bucket_sizes)])
+        return self._cached_permutations[1:]
+
+    def get_batch(self, epoch, batch_num):
+        """Returns the dataset indices in global batch `batch_num` of `epoch`."""
+        batch_perm, bucket_perms = self._permutations(epoch)
+        batch_id = int(batch_perm([batch_num])[0])
+        bucket = int(np.searchsorted(self.bucket_batch_offsets, batch_id, side='right')) - 1
+        local_batch = batch_id - int(self.bucket_batch_offsets[bucket])
+        bs, size = self.bucket_batch_sizes[bucket], self.bucket_sizes[bucket]
+        positions = np.arange(local_batch * bs, min((local_batch + 1) * bs, size), dtype=np.int64)
+        return self.order[self.bucket_starts[bucket] + bucket_perms[bucket](positions)].tolist()
+
+    def random_bucket_peer(self, index):
+        """Returns a random item from the length bucket of dataset item `index`, e.g. to stand in for it when it cannot be
+        loaded without exceeding the bucket's padded length."""
+        position = int(self.positions[index])
+        bucket = int(np.searchsorted(self.bucket_starts, position, side='right')) - 1
+        return int(self.order[self.bucket_starts[bucket] + random.randrange(self.bucket_sizes[bucket])])
+
+    def padding_ratio(self):
+        """Upper bound on the fraction of collated audio which will be padding over an epoch."""
+        padded = sum(l * s for l, s in zip(self.bucket_max_lengths, self.bucket_sizes))
+        return 1 - self.real_samples / max(padded, 1)
+
+    def __iter__(self):
+        epoch = self.epoch
+        start, self.start = self.start, 0  # Only the first iteration after set_start() is offset.
+        for b in range(start, self.num_batches):
+            yield self.get_batch(epoch, b * self.num_replicas + self.rank)
 
     def __len__(self):
-        return self.num_samples
+        return self.num_batches
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+    def set_start(self, position):
+        """Causes the next iteration to begin at batch `position` of the current epoch."""
+        self.start = position
+
+
+class DistBucketingBatchSampler(BucketingBatchSampler):
+    """BucketingBatchSampler which splits batches between the processes in a distributed run. All processes compute the
+    same batch order and each takes every num_replicas'th batch."""
+
+    def __init__(self, lengths, batch_size, num_replicas=None, rank=None, **kwargs):
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            rank = dist.get_rank()
+        super().__init__(lengths, batch_size, num_replicas=num_replicas, rank=rank, **kwargs)
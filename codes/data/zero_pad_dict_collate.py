@@ -1,5 +1,6 @@
 import torch
 import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
 
 
 class ZeroPadDictCollate():
@@ -42,4 +43,25 @@ class ZeroPadDictCollate():
                     collated[key] = torch.stack([b[key] for b in batch])
             else:
                 collated[key] = self.collate_into_list(batch, key)
-        return collated
\ No newline at end of file
+        return collated
+
+
+class LengthTrimmingCollate():
+    """
+    Wraps another collate function (the torch default if none is given) and trims tensors that datasets pad to a fixed
+    maximum length down to the longest item actually in the batch, using each tensor's companion length key. Paired
+    with BucketingBatchSampler, this means batches are only padded to their bucket maximum.
+    """
+    DEFAULT_LENGTH_KEYS = {'wav': 'wav_lengths', 'padded_text': 'text_lengths', 'aligned_codes': 'aligned_codes_lengths'}
+
+    def __init__(self, collate_fn=None, length_keys=None):
+        self.collate_fn = collate_fn if collate_fn is not None else default_collate
+        self.length_keys = length_keys if length_keys is not None else self.DEFAULT_LENGTH_KEYS
+
+    def __call__(self, batch):
+        collated = self.collate_fn(batch)
+        for key, length_key in self.length_keys.items():
+            if key in collated.keys() and length_key in collated.keys():
+                maxlen = int(torch.as_tensor(collated[length_key]).max())
+                collated[key] = collated[key][..., :maxlen].contiguous()
+        return collated
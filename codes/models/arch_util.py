@@ -8,6 +8,7 @@ import torch.nn.functional as F
 import torch.nn.utils.spectral_norm as SpectralNorm
 from math import sqrt
 
+from models.attention_backends import attention, get_attention_backend
 from utils.util import checkpoint
 import maybe_bnb as mbnb
 
@@ -607,6 +608,10 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
+        if get_attention_backend() != 'math':
+            attn_mask = None if mask is None else mask.repeat(self.n_heads, 1, 1).bool()
+            attn_bias = qk_bias if torch.is_tensor(qk_bias) else None
+            return attention(q, k, v, attn_bias=attn_bias, attn_mask=attn_mask).reshape(bs, -1, length)
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = torch.einsum(
             "bct,bcs->bts", q * scale, k * scale
@@ -641,6 +646,10 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
+        if get_attention_backend() != 'math':
+            attn_mask = None if mask is None else mask.repeat(self.n_heads, 1, 1).bool()
+            return attention(q.reshape(bs * self.n_heads, ch, length), k.reshape(bs * self.n_heads, ch, length),
+                             v.reshape(bs * self.n_heads, ch, length), attn_mask=attn_mask).reshape(bs, -1, length)
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = torch.einsum(
             "bct,bcs->bts",
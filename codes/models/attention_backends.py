@@ -0,0 +1,173 @@
+"""
+Kernels behind the QKVAttention modules in models/arch_util.py and models/diffusion/unet_diffusion.py.
+
+The original implementation of those modules (the 'math' backend) materializes the full (b*h, t, t) attention matrix
+and a float32 copy of it for the softmax, which bounds the sequence length and batch size that can be trained.
+Alternatives:
+- 'sdpa': torch.nn.functional.scaled_dot_product_attention, which dispatches to fused flash/memory-efficient kernels
+  where the inputs allow it.
+- 'chunked': processes queries in blocks of CHUNK_SIZE, so only a (b*h, CHUNK_SIZE, t) slice of the attention matrix
+  exists at any time. Runs anywhere. Note that autograd retains every block for backward, so the savings only apply to
+  inference and to checkpointed blocks (the default for AttentionBlock).
+- 'auto': 'sdpa' when available, else 'chunked'.
+
+'math' is the default so that existing models keep their numerics. Configs opt in to another backend with the top level
+'attention_backend' option, e.g. `attention_backend: auto`.
+
+All backends take channel-first q, k and v of shape (n, c, t), as used by the QKVAttention modules.
+"""
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+
+BACKENDS = ['auto', 'sdpa', 'chunked', 'math']
+CHUNK_SIZE = 1024
+_backend = 'math'
+
+
+def set_attention_backend(name):
+    global _backend
+    assert name in BACKENDS, f'Unknown attention backend {name}. Options: {BACKENDS}'
+    _backend = name
+
+
+def get_attention_backend():
+    """ Returns the backend in use: one of 'sdpa', 'chunked' or 'math'. """
+    if _backend == 'auto':
+        return 'sdpa' if hasattr(F, 'scaled_dot_product_attention') else 'chunked'
+    return _backend
+
+
+def _mask_to_bias(attn_mask, attn_bias, dtype):
+    if attn_mask is None:
+        return attn_bias if attn_bias is None else attn_bias.to(dtype)
+    bias = torch.zeros(attn_mask.shape, dtype=dtype, device=attn_mask.device).masked_fill(attn_mask.logical_not(), -math.inf)
+    if attn_bias is not None:
+        bias = bias + attn_bias.to(dtype)
+    return bias
+
+
+def chunked_attention(q, k, v, attn_bias=None, chunk_size=None):
+    """
+    Softmax attention computed one block of queries at a time. attn_bias must broadcast against (n, t, s). Matches the
+    'math' backend numerically, including its float32 softmax.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    scale = 1 / math.sqrt(math.sqrt(q.shape[1]))
+    k = k * scale
+    out = []
+    for i in range(0, q.shape[-1], chunk_size):
+        weight = torch.einsum("bct,bcs->bts", q[:, :, i:i+chunk_size] * scale, k)
+        if attn_bias is not None:
+            weight = weight + attn_bias[..., i:i+chunk_size, :]
+        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+        out.append(torch.einsum("bts,bcs->bct", weight, v))
+    return torch.cat(out, dim=-1)
+
+
+def attention(q, k, v, attn_bias=None, attn_mask=None):
+    """
+    Computes softmax(q^T k / sqrt(c) + attn_bias) v^T with the configured backend.
+
+    :param q, k, v: (n, c, t) tensors.
+    :param attn_bias: optional additive bias broadcastable to (n, t, s).
+    :param attn_mask: optional boolean mask broadcastable to (n, t, s). False entries are not attended to.
+    :return: an (n, c, t) tensor.
+    """
+    if get_attention_backend() == 'sdpa':
+        if attn_bias is None:
+            mask = attn_mask
+        else:
+            mask = _mask_to_bias(attn_mask, attn_bias, q.dtype)
+        out = F.scaled_dot_product_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), attn_mask=mask)
+        return out.transpose(1, 2)
+    return chunked_attention(q, k, v, _mask_to_bias(attn_mask, attn_bias, q.dtype))
+
+
+def _parity_cases(device):
+    from models.arch_util import QKVAttention, QKVAttentionLegacy, RelativeQKBias
+    from models.diffusion.unet_diffusion import QKVAttention as UnetQKVAttention, \
+        QKVAttentionLegacy as UnetQKVAttentionLegacy
+    b, heads, ch, t = 2, 4, 32, 300
+    qkv = torch.randn(b, heads * ch * 3, t, device=device)
+    causal = torch.ones(t, t, dtype=torch.bool, device=device).tril().unsqueeze(0).repeat(b, 1, 1)
+    bias = RelativeQKBias(16).to(device)(t)
+    key_mask = torch.ones(b, t, device=device)
+    key_mask[1, t//2:] = 0
+    for cls in [QKVAttention, QKVAttentionLegacy]:
+        yield cls.__name__, cls(heads), (qkv,), {}
+        yield f'{cls.__name__}+mask', cls(heads), (qkv, causal), {}
+    yield 'QKVAttentionLegacy+mask+RelativeQKBias', QKVAttentionLegacy(heads), (qkv, causal, bias), {}
+    for cls in [UnetQKVAttention, UnetQKVAttentionLegacy]:
+        yield f'unet.{cls.__name__}', cls(heads), (qkv,), {}
+        yield f'unet.{cls.__name__}+mask', cls(heads), (qkv, key_mask), {}
+
+
+def check_attention_parity(device='cpu', atol=1e-4):
+    """ Checks every backend against the 'math' backend on each attention module. Returns the largest error. """
+    previous = _backend
+    worst = 0
+    try:
+        with torch.no_grad():
+            for name, module, args, kwargs in _parity_cases(device):
+                set_attention_backend('math')
+                expected = module(*args, **kwargs)
+                for backend in ['sdpa', 'chunked']:
+                    set_attention_backend(backend)
+                    err = (module(*args, **kwargs) - expected).abs().max().item()
+                    assert err < atol, f'{name} with {backend} differs from the reference by {err}'
+                    worst = max(worst, err)
+    finally:
+        set_attention_backend(previous)
+    return worst
+
+
+def benchmark_attention_backends(device='cuda', batch_size=4, heads=8, head_channels=64, lengths=(1024, 4096, 8192),
+                                 dtype=torch.float16, trials=5):
+    """ Reports forward+backward time and peak memory of a QKVAttentionLegacy for each backend and sequence length. """
+    from models.arch_util import QKVAttentionLegacy
+    if torch.device(device).type != 'cuda':
+        dtype = torch.float32
+    module = QKVAttentionLegacy(heads)
+    previous = _backend
+    results = {}
+    try:
+        for t in lengths:
+            for backend in ['math', 'sdpa', 'chunked']:
+                set_attention_backend(backend)
+                qkv = torch.randn(batch_size, heads * head_channels * 3, t, device=device, dtype=dtype, requires_grad=True)
+                try:
+                    if torch.device(device).type == 'cuda':
+                        torch.cuda.synchronize()
+                        torch.cuda.reset_peak_memory_stats()
+                    module(qkv).sum().backward()  # Warmup.
+                    start = time.perf_counter()
+                    for _ in range(trials):
+                        module(qkv).sum().backward()
+                    if torch.device(device).type == 'cuda':
+                        torch.cuda.synchronize()
+                        peak = torch.cuda.max_memory_allocated() / 2**20
+                    else:
+                        peak = float('nan')
+                    elapsed = (time.perf_counter() - start) / trials
+                    results[(t, backend)] = (elapsed, peak)
+                    print(f'length={t} backend={backend}: {elapsed*1000:.1f}ms/iter, peak memory {peak:.0f}MB')
+                except RuntimeError as e:  # Usually OOM for the math backend.
+                    results[(t, backend)] = None
+                    print(f'length={t} backend={backend}: failed ({str(e).splitlines()[0]})')
+                del qkv
+    finally:
+        set_attention_backend(previous)
+    return results
+
+
+if __name__ == '__main__':
+    import maybe_bnb
+    maybe_bnb.populate(False, False, False, embedding=None)
+    # The attention modules import this module by name; use that instance so that backend switches reach them.
+    from models.attention_backends import check_attention_parity, benchmark_attention_backends
+    dev = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print(f'Largest deviation from the reference implementation: {check_attention_parity(dev)}')
+    benchmark_attention_backends(dev, lengths=(1024, 4096, 8192) if dev == 'cuda' else (512, 2048))
@@ -10,7 +10,8 @@ import torchaudio
 import torchvision
 import maybe_bnb as mbnb
 
-from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear
+from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear, \
+    uniform_conditioning_free, select_conditioning
 from models.diffusion.unet_diffusion import TimestepBlock
 from models.lucidrains.x_transformers import Encoder, Attention, RMSScaleShiftNorm, RotaryEmbedding, \
     FeedForward
@@ -115,6 +116,8 @@ class ConditioningEncoder(nn.Module):
 
 
 class TransformerDiffusionWithPointConditioning(nn.Module):
+    supports_conditioning_free_mask = True
+
     def __init__(
             self,
             in_channels=256,
@@ -265,16 +268,45 @@ class TransformerDiffusionWithPointConditioning(nn.Module):
         cond = F.interpolate(cond_enc, size=(N,), mode='linear', align_corners=True).permute(0,2,1)
         return cond
 
-    def forward(self, x, timesteps, conditioning_input=None, cond_left=None, cond_right=None, conditioning_free=False, cond_start=0):
+    def precompute_conditioning(self, x, **model_kwargs):
+        """
+        Sampling loop hook, see GaussianDiffusion._precompute_conditioning(). The conditioning only stops depending on
+        the timestep when time_proj is disabled, and only stops being random across steps with new_cond or explicit
+        cond_left/cond_right. In that case it is replaced with precomputed_cond.
+        """
+        cond_left = model_kwargs.get('cond_left')
+        if self.conditioning_encoder.time_proj or (model_kwargs.get('conditioning_input') is None and cond_left is None) or \
+                (cond_left is None and not self.new_cond):
+            return model_kwargs
+        model_kwargs['precomputed_cond'] = self.process_conditioning(model_kwargs.pop('conditioning_input', None), None,
+                                                                     x.shape[-1], model_kwargs.pop('cond_start', 0),
+                                                                     model_kwargs.pop('cond_left', None),
+                                                                     model_kwargs.pop('cond_right', None))
+        return model_kwargs
+
+    def forward(self, x, timesteps, conditioning_input=None, cond_left=None, cond_right=None, conditioning_free=False, cond_start=0,
+                precomputed_cond=None):
         unused_params = []
 
         time_emb = self.time_embed(timestep_embedding(timesteps, self.time_embed_dim))
 
-        if conditioning_free:
+        conditioning_free = uniform_conditioning_free(conditioning_free)
+        if torch.is_tensor(conditioning_free) and precomputed_cond is not None:
+            cond = select_conditioning(conditioning_free, lambda rows: precomputed_cond[rows], self.unconditioned_embedding)
+        elif torch.is_tensor(conditioning_free):
+            # Per-sample classifier-free guidance: only the conditioned samples go through the conditioning encoder.
+            rows_of = lambda t, rows: t[rows] if t is not None else None
+            cond = select_conditioning(conditioning_free, lambda rows: self.process_conditioning(
+                rows_of(conditioning_input, rows), time_emb[rows], x.shape[-1], cond_start, rows_of(cond_left, rows),
+                rows_of(cond_right, rows)), self.unconditioned_embedding)
+        elif conditioning_free:
             cond = self.unconditioned_embedding
             cond = cond.repeat(1,x.shape[-1],1)
         else:
-            cond = self.process_conditioning(conditioning_input, time_emb, x.shape[-1], cond_start, cond_left, cond_right)
+            if precomputed_cond is not None:
+                cond = precomputed_cond
+            else:
+                cond = self.process_conditioning(conditioning_input, time_emb, x.shape[-1], cond_start, cond_left, cond_right)
             # Mask out the conditioning branch for whole batch elements, implementing something similar to classifier-free guidance.
             if self.training and self.unconditioned_percentage > 0:
                 unconditioned_batches = torch.rand((cond.shape[0], 1, 1),
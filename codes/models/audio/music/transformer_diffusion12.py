@@ -208,10 +208,28 @@ class TransformerDiffusion(nn.Module):
             code_emb = F.interpolate(code_emb.permute(0,2,1), size=expected_seq_len, mode='nearest').permute(0,2,1)
         return code_emb
 
+    def precompute_conditioning(self, x, **model_kwargs):
+        """
+        Sampling loop hook, see GaussianDiffusion._precompute_conditioning(). Replaces codes with
+        precomputed_code_embeddings.
+        """
+        if model_kwargs.get('codes') is None:
+            return model_kwargs
+        codes = model_kwargs.pop('codes')
+        model_kwargs.pop('conditioning_input', None)  # Unused by this model, and not accepted alongside precomputed embeddings.
+        model_kwargs['precomputed_code_embeddings'] = self.embed_codes(codes, x.shape[-1])
+        return model_kwargs
+
+    def embed_codes(self, codes, expected_seq_len):
+        """ timestep_independent() for codes as they are passed to forward(), i.e. before permute_codes is applied. """
+        if self.permute_codes:
+            codes = codes.permute(0,2,1)
+        return self.timestep_independent(codes, expected_seq_len)
+
     def forward(self, x, timesteps, codes=None, conditioning_input=None, precomputed_code_embeddings=None, conditioning_free=False):
         if precomputed_code_embeddings is not None:
             assert codes is None and conditioning_input is None, "Do not provide precomputed embeddings and the other parameters. It is unclear what you want me to do here."
-        if self.permute_codes:
+        if self.permute_codes and codes is not None:
             codes = codes.permute(0,2,1)
 
         unused_params = []
@@ -245,6 +263,18 @@ class TransformerDiffusion(nn.Module):
         return out
 
 
+def _precompute_truth_mel_conditioning(model, x, model_kwargs):
+    """
+    precompute_conditioning() for the wrappers below, which compute the codes of the diffusion model from truth_mel
+    through model.timestep_independent().
+    """
+    if model_kwargs.get('truth_mel') is None:
+        return model_kwargs
+    model_kwargs.pop('conditioning_input', None)
+    model_kwargs['precomputed_code_embeddings'] = model.timestep_independent(model_kwargs.pop('truth_mel'), x.shape[-1])
+    return model_kwargs
+
+
 class TransformerDiffusionWithQuantizer(nn.Module):
     def __init__(self, quantizer_dims=[1024], quantizer_codebook_size=256, quantizer_codebook_groups=2,
                  freeze_quantizer_until=20000, **kwargs):
@@ -268,7 +298,21 @@ class TransformerDiffusionWithQuantizer(nn.Module):
                     self.quantizer.min_gumbel_temperature,
                 )
 
-    def forward(self, x, timesteps, truth_mel, conditioning_input=None, disable_diversity=False, conditioning_free=False):
+    def timestep_independent(self, truth_mel, expected_seq_len):
+        proj, _ = self.quantizer(truth_mel, return_decoder_latent=True)
+        return self.diff.embed_codes(proj.permute(0,2,1), expected_seq_len)
+
+    def precompute_conditioning(self, x, **model_kwargs):
+        return _precompute_truth_mel_conditioning(self, x, model_kwargs)
+
+    def forward(self, x, timesteps, truth_mel=None, conditioning_input=None, disable_diversity=False, conditioning_free=False,
+                precomputed_code_embeddings=None):
+        if precomputed_code_embeddings is not None:
+            diff = self.diff(x, timesteps, precomputed_code_embeddings=precomputed_code_embeddings, conditioning_free=conditioning_free)
+            if disable_diversity:
+                return diff
+            return diff, torch.zeros((), device=diff.device)
+
         quant_grad_enabled = self.internal_step > self.freeze_quantizer_until
         with torch.set_grad_enabled(quant_grad_enabled):
             proj, diversity_loss = self.quantizer(truth_mel, return_decoder_latent=True)
@@ -343,7 +387,18 @@ class TransformerDiffusionWithPretrainedVqvae(nn.Module):
             p.DO_NOT_TRAIN = True
             p.requires_grad = False
 
-    def forward(self, x, timesteps, truth_mel, conditioning_input=None, disable_diversity=False, conditioning_free=False):
+    def timestep_independent(self, truth_mel, expected_seq_len):
+        with torch.no_grad():
+            _, proj = self.quantizer.infer(truth_mel)
+        return self.diff.embed_codes(proj.permute(0,2,1), expected_seq_len)
+
+    def precompute_conditioning(self, x, **model_kwargs):
+        return _precompute_truth_mel_conditioning(self, x, model_kwargs)
+
+    def forward(self, x, timesteps, truth_mel=None, conditioning_input=None, disable_diversity=False, conditioning_free=False,
+                precomputed_code_embeddings=None):
+        if precomputed_code_embeddings is not None:
+            return self.diff(x, timesteps, precomputed_code_embeddings=precomputed_code_embeddings, conditioning_free=conditioning_free)
         with torch.no_grad():
             reconstructed, proj = self.quantizer.infer(truth_mel)
             proj = proj.permute(0,2,1)
@@ -402,7 +457,7 @@ class TransformerDiffusionWithMultiPretrainedVqvae(nn.Module):
             p.DO_NOT_TRAIN = True
             p.requires_grad = False
 
-    def forward(self, x, timesteps, truth_mel, conditioning_input=None, disable_diversity=False, conditioning_free=False):
+    def quantize(self, truth_mel):
         with torch.no_grad():
             proj = []
             partition_size = truth_mel.shape[1] // len(self.quantizers)
@@ -410,8 +465,19 @@ class TransformerDiffusionWithMultiPretrainedVqvae(nn.Module):
                 mel_partition = truth_mel[:, i*partition_size:(i+1)*partition_size]
                 _, p = q.infer(mel_partition)
                 proj.append(p.permute(0,2,1))
-            proj = torch.cat(proj, dim=-1)
+            return torch.cat(proj, dim=-1)
+
+    def timestep_independent(self, truth_mel, expected_seq_len):
+        return self.diff.embed_codes(self.quantize(truth_mel), expected_seq_len)
 
+    def precompute_conditioning(self, x, **model_kwargs):
+        return _precompute_truth_mel_conditioning(self, x, model_kwargs)
+
+    def forward(self, x, timesteps, truth_mel=None, conditioning_input=None, disable_diversity=False, conditioning_free=False,
+                precomputed_code_embeddings=None):
+        if precomputed_code_embeddings is not None:
+            return self.diff(x, timesteps, precomputed_code_embeddings=precomputed_code_embeddings, conditioning_free=conditioning_free)
+        proj = self.quantize(truth_mel)
         diff = self.diff(x, timesteps, codes=proj, conditioning_input=conditioning_input, conditioning_free=conditioning_free)
         return diff
 
@@ -470,7 +536,16 @@ class TransformerDiffusionWithCheaterLatent(nn.Module):
         else:
             self.encoder = UpperEncoder(256, 1024, 256).eval()
 
-    def forward(self, x, timesteps, truth_mel, conditioning_input=None, disable_diversity=False, conditioning_free=False):
+    def timestep_independent(self, truth_mel, expected_seq_len):
+        return self.diff.embed_codes(self.encoder(truth_mel).permute(0,2,1), expected_seq_len)
+
+    def precompute_conditioning(self, x, **model_kwargs):
+        return _precompute_truth_mel_conditioning(self, x, model_kwargs)
+
+    def forward(self, x, timesteps, truth_mel=None, conditioning_input=None, disable_diversity=False, conditioning_free=False,
+                precomputed_code_embeddings=None):
+        if precomputed_code_embeddings is not None:
+            return self.diff(x, timesteps, precomputed_code_embeddings=precomputed_code_embeddings, conditioning_free=conditioning_free)
         unused_parameters = []
         encoder_grad_enabled = self.freeze_encoder_until is not None and self.internal_step > self.freeze_encoder_until
         if not encoder_grad_enabled:
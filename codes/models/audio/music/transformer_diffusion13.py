@@ -176,7 +176,22 @@ class TransformerDiffusion(nn.Module):
         self.preprocessed = (s_prior_diffused, t_prior, torch.tensor([resolution] * x.shape[0], dtype=torch.long, device=x.device))
         return s
 
-    def forward(self, x, timesteps, prior_timesteps=None, x_prior=None, resolution=None, conditioning_input=None, conditioning_free=False):
+    def precompute_conditioning(self, x, **model_kwargs):
+        """
+        Sampling loop hook, see GaussianDiffusion._precompute_conditioning(). Replaces conditioning_input with
+        precomputed_code_embeddings.
+        """
+        conditioning_input = model_kwargs.get('conditioning_input')
+        if conditioning_input is None:
+            conditioning_input = model_kwargs.get('x_prior')
+        if model_kwargs.get('resolution') is None or conditioning_input is None:
+            return model_kwargs
+        model_kwargs.pop('conditioning_input', None)
+        model_kwargs['precomputed_code_embeddings'] = self.conditioning_encoder(conditioning_input, model_kwargs['resolution'])
+        return model_kwargs
+
+    def forward(self, x, timesteps, prior_timesteps=None, x_prior=None, resolution=None, conditioning_input=None, conditioning_free=False,
+                precomputed_code_embeddings=None):
         """
         Predicts the previous diffusion timestep of x, given a partially diffused low-resolution prior and a conditioning
         input.
@@ -192,6 +207,7 @@ class TransformerDiffusion(nn.Module):
             resolution: Integer indicating the operating resolution level. '0' is the highest resolution.
             conditioning_input: A semi-related (un-aligned) conditioning input which is used to guide diffusion. Similar to a class input, but hooked to a learned conditioning encoder.
             conditioning_free: Whether or not to ignore the conditioning input.
+            precomputed_code_embeddings: The encoded conditioning_input, as returned by precompute_conditioning().
         """
         conditioning_input = x_prior if conditioning_input is None else conditioning_input
 
@@ -211,6 +227,8 @@ class TransformerDiffusion(nn.Module):
 
         if conditioning_free:
             code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1)
+        elif precomputed_code_embeddings is not None:
+            code_emb = precomputed_code_embeddings
         else:
             MIN_COND_LEN = 200
             MAX_COND_LEN = 1200
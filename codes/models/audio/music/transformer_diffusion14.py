@@ -99,20 +99,35 @@ class TransformerDiffusion(nn.Module):
         }
         return groups
 
-    def forward(self, x, timesteps, prior=None, conditioning_free=False):
+    def timestep_independent(self, prior, expected_seq_len):
+        code_emb = self.input_converter(prior)
+
+        # Mask out the conditioning branch for whole batch elements, implementing something similar to classifier-free guidance.
+        if self.training and self.unconditioned_percentage > 0:
+            unconditioned_batches = torch.rand((code_emb.shape[0], 1, 1),
+                                               device=code_emb.device) < self.unconditioned_percentage
+            code_emb = torch.where(unconditioned_batches, self.unconditioned_embedding.repeat(prior.shape[0], 1, 1),
+                                   code_emb)
+
+        return F.interpolate(code_emb, size=expected_seq_len, mode='nearest')
+
+    def precompute_conditioning(self, x, **model_kwargs):
+        """
+        Sampling loop hook, see GaussianDiffusion._precompute_conditioning(). Replaces prior with
+        precomputed_code_embeddings.
+        """
+        if model_kwargs.get('prior') is None:
+            return model_kwargs
+        model_kwargs['precomputed_code_embeddings'] = self.timestep_independent(model_kwargs.pop('prior'), x.shape[-1])
+        return model_kwargs
+
+    def forward(self, x, timesteps, prior=None, conditioning_free=False, precomputed_code_embeddings=None):
         if conditioning_free:
             code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
+        elif precomputed_code_embeddings is not None:
+            code_emb = precomputed_code_embeddings
         else:
-            code_emb = self.input_converter(prior)
-
-            # Mask out the conditioning branch for whole batch elements, implementing something similar to classifier-free guidance.
-            if self.training and self.unconditioned_percentage > 0:
-                unconditioned_batches = torch.rand((code_emb.shape[0], 1, 1),
-                                                   device=code_emb.device) < self.unconditioned_percentage
-                code_emb = torch.where(unconditioned_batches, self.unconditioned_embedding.repeat(x.shape[0], 1, 1),
-                                       code_emb)
-
-            code_emb = F.interpolate(code_emb, size=x.shape[-1], mode='nearest')
+            code_emb = self.timestep_independent(prior, x.shape[-1])
 
         with torch.autocast(x.device.type, enabled=self.enable_fp16):
             blk_emb = self.time_embed(timestep_embedding(timesteps, self.time_embed_dim))
@@ -143,7 +158,23 @@ class TransformerDiffusionWithCheaterLatent(nn.Module):
         self.diff = TransformerDiffusion(**kwargs)
         self.encoder = ResEncoder16x(256, 1024, 256, checkpointing_enabled=checkpoint_encoder)
 
-    def forward(self, x, timesteps, truth_mel, conditioning_free=False, cheater=None):
+    def precompute_conditioning(self, x, **model_kwargs):
+        """
+        Sampling loop hook, see GaussianDiffusion._precompute_conditioning(). Replaces truth_mel (or cheater) with
+        precomputed_code_embeddings.
+        """
+        cheater = model_kwargs.pop('cheater', None)
+        if cheater is None:
+            if model_kwargs.get('truth_mel') is None:
+                return model_kwargs
+            cheater = self.encoder(model_kwargs['truth_mel'])
+        model_kwargs.pop('truth_mel', None)
+        model_kwargs['precomputed_code_embeddings'] = self.diff.timestep_independent(cheater, x.shape[-1])
+        return model_kwargs
+
+    def forward(self, x, timesteps, truth_mel=None, conditioning_free=False, cheater=None, precomputed_code_embeddings=None):
+        if precomputed_code_embeddings is not None:
+            return self.diff(x, timesteps, conditioning_free=conditioning_free, precomputed_code_embeddings=precomputed_code_embeddings)
         unused_parameters = []
         encoder_grad_enabled = self.freeze_encoder_until is not None and self.internal_step > self.freeze_encoder_until
         if not encoder_grad_enabled:
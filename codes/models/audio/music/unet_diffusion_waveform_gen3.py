@@ -4,7 +4,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear
+from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear, \
+    uniform_conditioning_free, select_conditioning
 from models.diffusion.unet_diffusion import TimestepEmbedSequential, \
     Downsample, Upsample, TimestepBlock
 from scripts.audio.gen.use_diffuse_tts import ceil_multiple
@@ -151,6 +152,7 @@ class DiffusionWaveformGen(nn.Module):
     :param channel_mult: channel multiplier for each level of the UNet.
     :param dims: determines if the signal is 1D, 2D, or 3D.
     """
+    supports_conditioning_free_mask = True
 
     def __init__(
             self,
@@ -309,6 +311,7 @@ class DiffusionWaveformGen(nn.Module):
         :param timesteps: a 1-D batch of timesteps.
         :param codes: an aligned latent or sequence of tokens providing useful data about the sample to be produced.
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+                                  May also be an [N] bool mask selecting the samples this applies to.
         :return: an [N x C x ...] Tensor of outputs.
         """
         # Fix input size to the proper multiple of 2 so we don't get alignment errors going down and back up the U-net.
@@ -320,7 +323,11 @@ class DiffusionWaveformGen(nn.Module):
         time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
 
         # Note: this block does not need to repeated on inference, since it is not timestep-dependent.
-        if conditioning_free:
+        conditioning_free = uniform_conditioning_free(conditioning_free)
+        if torch.is_tensor(conditioning_free):
+            code_emb = select_conditioning(conditioning_free, lambda rows: self.mel_converter(codes[rows]),
+                                           self.unconditioned_embedding)
+        elif conditioning_free:
             code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, 1)
         else:
             code_emb = self.mel_converter(codes)
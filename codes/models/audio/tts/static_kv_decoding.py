@@ -0,0 +1,187 @@
+"""
+Autoregressive decoding for the HuggingFace GPT-2 stacks built by build_hf_gpt_transformer(), without going through
+HF generate().
+
+Keys and values live in a cache which is allocated once at its final size, so each step writes one column in place
+instead of concatenating (and reallocating) the entire past. Prompts of different lengths are left-padded into a single
+batch; the padding is masked out of attention and, because positional embeddings are added by the caller before the
+transformer (the GPT-2 position embedding is nulled out), does not shift any sequence's positions.
+"""
+import time
+
+import torch
+import torch.nn.functional as F
+
+
+class StaticKVCacheGPT2:
+    """
+    Runs the blocks of an HF GPT2Model against a preallocated KV cache. Reuses the GPT2Model's weights directly, so it
+    always reflects the current state of the model it was built from.
+    """
+    def __init__(self, gpt):
+        self.gpt = gpt
+        self.config = gpt.config
+        self.heads = self.config.n_head
+        self.head_dim = self.config.n_embd // self.heads
+        self.keys = None
+        self.values = None
+        self.valid = None
+        self.length = 0
+
+    def allocate(self, batch_size, max_length, dtype, device):
+        """ Resets the cache for a new batch. Storage is only reallocated when it is too small or has the wrong type. """
+        shape = (len(self.gpt.h), batch_size, self.heads, max_length, self.head_dim)
+        if self.keys is None or self.keys.dtype != dtype or self.keys.device != torch.device(device) or \
+                any(have < want for have, want in zip(self.keys.shape, shape)):
+            self.keys = torch.empty(shape, dtype=dtype, device=device)
+            self.values = torch.empty(shape, dtype=dtype, device=device)
+            self.valid = torch.zeros(shape[1], shape[3], dtype=torch.bool, device=device)
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.valid[:batch_size, :max_length] = False
+        self.length = 0
+
+    def _scale(self, layer):
+        scale = self.head_dim ** -.5 if self.config.scale_attn_weights else 1
+        if self.config.scale_attn_by_inverse_layer_idx:
+            scale = scale / (layer + 1)
+        return scale
+
+    def forward(self, emb, valid):
+        """
+        Appends emb (b,t,d) to the sequences in the cache and returns the final hidden states for those positions.
+        valid (b,t) is False for padding positions, which are never attended to.
+        """
+        b, t, _ = emb.shape
+        start, end = self.length, self.length + t
+        assert b == self.batch_size and end <= self.max_length, 'KV cache overflow'
+        self.valid[:b, start:end] = valid
+        # Query i may see key j if j is not padding and j <= i. Every query also sees itself, which keeps fully masked
+        # rows (left padding) from producing NaNs; their outputs are never attended to or read.
+        key_pos = torch.arange(end, device=emb.device)
+        query_pos = torch.arange(start, end, device=emb.device)
+        mask = self.valid[:b, None, None, :end] & (key_pos[None, :] <= query_pos[:, None])
+        mask = mask | (key_pos[None, :] == query_pos[:, None])
+
+        x = self.gpt.drop(emb)
+        for l, block in enumerate(self.gpt.h):
+            h = block.ln_1(x)
+            q, k, v = block.attn.c_attn(h).split(self.config.n_embd, dim=2)
+            q, k, v = [z.view(b, t, self.heads, self.head_dim).transpose(1, 2) for z in (q, k, v)]
+            self.keys[l, :b, :, start:end] = k
+            self.values[l, :b, :, start:end] = v
+            a = F.scaled_dot_product_attention(q, self.keys[l, :b, :, :end], self.values[l, :b, :, :end],
+                                               attn_mask=mask, scale=self._scale(l))
+            a = a.transpose(1, 2).reshape(b, t, self.config.n_embd)
+            x = x + block.attn.resid_dropout(block.attn.c_proj(a))
+            x = x + block.mlp(block.ln_2(x))
+        self.length = end
+        return self.gpt.ln_f(x)
+
+
+def sample_logits(logits, do_sample=True, temperature=1.0, top_k=None, top_p=None):
+    """ Picks one token per row of logits (b,v) with optional temperature, top-k and nucleus (top-p) filtering. """
+    if not do_sample:
+        return logits.argmax(dim=-1)
+    logits = logits.float() / max(temperature, 1e-5)
+    if top_k is not None and top_k > 0:
+        kth = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth, -float('inf'))
+    if top_p is not None and top_p < 1:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        cum_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # Remove tokens once the cumulative probability of the tokens before them exceeds top_p; always keep the first.
+        remove = (cum_probs - sorted_logits.softmax(dim=-1)) > top_p
+        logits = logits.masked_fill(remove.scatter(1, sorted_indices, remove), -float('inf'))
+    return torch.multinomial(logits.softmax(dim=-1), 1).squeeze(-1)
+
+
+@torch.no_grad()
+def decode(decoder, prompt_emb, prompt_valid, embed_fn, head_fn, stop_token, max_new_tokens, stop_check_interval=8,
+           **sampling_kwargs):
+    """
+    Generates up to max_new_tokens tokens for each left-padded prompt in prompt_emb (b,p,d).
+
+    embed_fn(tokens, step) embeds the tokens (b,) generated at step (0-based) into (b,1,d). head_fn maps final hidden
+    states (b,d) to logits. Each sequence stops at its first stop_token; later positions are filled with stop_token.
+    Returns a (b,n) long tensor where n is the number of steps taken.
+    """
+    b = prompt_emb.shape[0]
+    decoder.allocate(b, prompt_emb.shape[1] + max_new_tokens, prompt_emb.dtype, prompt_emb.device)
+    hidden = decoder.forward(prompt_emb, prompt_valid)[:, -1]
+    finished = torch.zeros((b,), dtype=torch.bool, device=prompt_emb.device)
+    step_valid = torch.ones((b, 1), dtype=torch.bool, device=prompt_emb.device)
+    tokens = torch.full((b, max_new_tokens), stop_token, dtype=torch.long, device=prompt_emb.device)
+    steps = 0
+    for step in range(max_new_tokens):
+        next_tokens = sample_logits(head_fn(hidden), **sampling_kwargs)
+        next_tokens = next_tokens.masked_fill(finished, stop_token)
+        tokens[:, step] = next_tokens
+        finished = finished | (next_tokens == stop_token)
+        steps = step + 1
+        # Checking for completion forces a host sync, so only do it periodically. Extra steps are discarded below.
+        if steps % stop_check_interval == 0 and finished.all():
+            break
+        if steps < max_new_tokens:
+            hidden = decoder.forward(embed_fn(next_tokens, step), step_valid)[:, -1]
+    tokens = tokens[:, :steps]
+    if finished.all():
+        # Trim to the latest stop token, as HF generate() does.
+        first_stop = (tokens == stop_token).int().argmax(dim=-1)
+        tokens = tokens[:, :int(first_stop.max()) + 1]
+    return tokens
+
+
+def benchmark_kv_cache_decoding(device='cuda', batch_size=8, text_length=100, new_tokens=250, layers=8, model_dim=512,
+                                heads=8, trials=3, checkpoint=None, model_kwargs={}):
+    """
+    Compares decoding throughput of UnifiedVoice.inference_speech (HF generate) against
+    UnifiedVoice.inference_speech_kv_cache, and checks that greedy decodes agree. Uses a randomly initialized model
+    unless a checkpoint is given; model_kwargs must then match the checkpoint's UnifiedVoice arguments.
+    """
+    import maybe_bnb
+    maybe_bnb.populate(False, False, False, embedding=None)
+    from models.audio.tts.unified_voice2 import UnifiedVoice
+    # Leave headroom in the mel positions; the HF path can otherwise run past the end of the GPT-2 causal mask.
+    kwargs = {'layers': layers, 'model_dim': model_dim, 'heads': heads, 'max_text_tokens': text_length,
+              'max_mel_tokens': new_tokens + 8, 'checkpointing': False}
+    kwargs.update(model_kwargs)
+    model = UnifiedVoice(**kwargs)
+    if checkpoint is not None:
+        model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    model = model.to(device).eval()
+    # Disable stop tokens (which random models rarely emit anyway) so both paths decode the same number of tokens.
+    with torch.no_grad():
+        model.mel_head.bias[model.stop_mel_token] = -1e4
+    cond = torch.randn(batch_size, 80, 400, device=device)
+    text = torch.randint(1, 255, (batch_size, text_length), device=device)
+
+    def sync():
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize()
+
+    def timed(fn):
+        fn()  # Warmup.
+        sync()
+        start = time.perf_counter()
+        for _ in range(trials):
+            out = fn()
+        sync()
+        return out, (time.perf_counter() - start) / trials
+
+    with torch.no_grad():
+        hf_codes, hf_time = timed(lambda: model.inference_speech(cond, text, do_sample=False, num_beams=1,
+                                                                 max_new_tokens=new_tokens))
+        kv_codes, kv_time = timed(lambda: model.inference_speech_kv_cache(cond, text, max_new_tokens=new_tokens,
+                                                                          do_sample=False))
+    n = min(hf_codes.shape[1], kv_codes.shape[1])
+    agreement = (hf_codes[:, :n] == kv_codes[:, :n]).float().mean().item()
+    hf_tps, kv_tps = hf_codes.numel() / hf_time, kv_codes.numel() / kv_time
+    print(f'HF generate: {hf_tps:.1f} tokens/sec. Static KV cache: {kv_tps:.1f} tokens/sec ({kv_tps / hf_tps:.2f}x). '
+          f'Greedy agreement: {agreement*100:.1f}%')
+    return {'hf_tokens_per_sec': hf_tps, 'kv_cache_tokens_per_sec': kv_tps, 'greedy_agreement': agreement}
+
+
+if __name__ == '__main__':
+    # Pass a trained UnifiedVoice checkpoint (and its model arguments) to check parity on real weights.
+    benchmark_kv_cache_decoding('cuda' if torch.cuda.is_available() else 'cpu', checkpoint=None)
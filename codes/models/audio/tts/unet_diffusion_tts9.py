@@ -412,14 +412,49 @@ class DiffusionTts(nn.Module):
             pc = (cm-x.shape[-1])/x.shape[-1]
             x = F.pad(x, (0,cm-x.shape[-1]))
             # Also fix aligned_latent, which is aligned to x.
-            if is_latent(aligned_conditioning):
+            if aligned_conditioning is None:
+                pass
+            elif is_latent(aligned_conditioning):
                 aligned_conditioning = torch.cat([aligned_conditioning,
                                                   self.aligned_latent_padding_embedding.repeat(x.shape[0], 1, int(pc * aligned_conditioning.shape[-1]))], dim=-1)
             else:
                 aligned_conditioning = F.pad(aligned_conditioning, (0,int(pc*aligned_conditioning.shape[-1])))
         return x, aligned_conditioning
 
-    def forward(self, x, timesteps, aligned_conditioning, conditioning_input, lr_input=None, conditioning_free=False):
+    def timestep_independent(self, aligned_conditioning, conditioning_input):
+        """
+        Computes the conditioning embedding from an aligned_conditioning which has already been permuted and padded by
+        forward().
+        """
+        cond_emb = self.contextual_embedder(conditioning_input)
+        if len(cond_emb.shape) == 3:  # Just take the first element.
+            cond_emb = cond_emb[:, :, 0]
+        if is_latent(aligned_conditioning):
+            code_emb = self.latent_converter(aligned_conditioning)
+        else:
+            code_emb = self.code_converter(aligned_conditioning)
+        cond_emb = cond_emb.unsqueeze(-1).repeat(1, 1, code_emb.shape[-1])
+        return self.conditioning_conv(torch.cat([cond_emb, code_emb], dim=1))
+
+    def precompute_conditioning(self, x, **model_kwargs):
+        """
+        Sampling loop hook, see GaussianDiffusion._precompute_conditioning(). Replaces aligned_conditioning and
+        conditioning_input with precomputed_code_embeddings.
+        """
+        aligned_conditioning = model_kwargs.get('aligned_conditioning')
+        if aligned_conditioning is None or model_kwargs.get('conditioning_input') is None:
+            return model_kwargs
+        if is_latent(aligned_conditioning):
+            aligned_conditioning = aligned_conditioning.permute(0, 2, 1)
+        _, aligned_conditioning = self.fix_alignment(x, aligned_conditioning)
+        model_kwargs.pop('aligned_conditioning')
+        with autocast(x.device.type, enabled=self.enable_fp16):
+            model_kwargs['precomputed_code_embeddings'] = self.timestep_independent(aligned_conditioning,
+                                                                                    model_kwargs.pop('conditioning_input'))
+        return model_kwargs
+
+    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_input=None, lr_input=None, conditioning_free=False,
+                precomputed_code_embeddings=None):
         """
         Apply the model to an input batch.
 
@@ -429,9 +464,11 @@ class DiffusionTts(nn.Module):
         :param conditioning_input: a full-resolution audio clip that is used as a reference to the style you want decoded.
         :param lr_input: for super-sampling models, a guidance audio clip at a lower sampling rate.
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+        :param precomputed_code_embeddings: Embeddings returned from self.precompute_conditioning(), used in place of
+                                            aligned_conditioning and conditioning_input.
         :return: an [N x C x ...] Tensor of outputs.
         """
-        assert conditioning_input is not None
+        assert conditioning_input is not None or precomputed_code_embeddings is not None
         if self.super_sampling_enabled:
             assert lr_input is not None
             if self.training and self.super_sampling_max_noising_factor > 0:
@@ -441,7 +478,7 @@ class DiffusionTts(nn.Module):
             x = torch.cat([x, lr_input], dim=1)
 
         # Shuffle aligned_latent to BxCxS format
-        if is_latent(aligned_conditioning):
+        if aligned_conditioning is not None and is_latent(aligned_conditioning):
             aligned_conditioning = aligned_conditioning.permute(0, 2, 1)
 
         # Fix input size to the proper multiple of 2 so we don't get alignment errors going down and back up the U-net.
@@ -456,16 +493,10 @@ class DiffusionTts(nn.Module):
             # Note: this block does not need to repeated on inference, since it is not timestep-dependent.
             if conditioning_free:
                 code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, 1)
+            elif precomputed_code_embeddings is not None:
+                code_emb = precomputed_code_embeddings
             else:
-                cond_emb = self.contextual_embedder(conditioning_input)
-                if len(cond_emb.shape) == 3:  # Just take the first element.
-                    cond_emb = cond_emb[:, :, 0]
-                if is_latent(aligned_conditioning):
-                    code_emb = self.latent_converter(aligned_conditioning)
-                else:
-                    code_emb = self.code_converter(aligned_conditioning)
-                cond_emb = cond_emb.unsqueeze(-1).repeat(1, 1, code_emb.shape[-1])
-                code_emb = self.conditioning_conv(torch.cat([cond_emb, code_emb], dim=1))
+                code_emb = self.timestep_independent(aligned_conditioning, conditioning_input)
             # Mask out the conditioning branch for whole batch elements, implementing something similar to classifier-free guidance.
             if self.training and self.unconditioned_percentage > 0:
                 unconditioned_batches = torch.rand((code_emb.shape[0], 1, 1),
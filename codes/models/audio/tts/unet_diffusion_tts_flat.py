@@ -7,7 +7,8 @@ import torch.nn.functional as F
 from torch import autocast
 import maybe_bnb as mbnb
 
-from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear
+from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear, \
+    uniform_conditioning_free, select_conditioning
 from models.diffusion.unet_diffusion import TimestepEmbedSequential, TimestepBlock, QKVAttentionLegacy
 from models.lucidrains.x_transformers import RelativePositionBias
 from trainer.networks import register_model
@@ -156,6 +157,8 @@ class DiffusionLayer(TimestepBlock):
 
 
 class DiffusionTtsFlat(nn.Module):
+    supports_conditioning_free_mask = True
+
     def __init__(
             self,
             model_channels=512,
@@ -291,6 +294,18 @@ class DiffusionTtsFlat(nn.Module):
             mel_pred = mel_pred * unconditioned_batches.logical_not()
             return expanded_code_emb, mel_pred
 
+    def precompute_conditioning(self, x, **model_kwargs):
+        """
+        Sampling loop hook, see GaussianDiffusion._precompute_conditioning(). Replaces aligned_conditioning and
+        conditioning_input with precomputed_aligned_embeddings.
+        """
+        if model_kwargs.get('aligned_conditioning') is None or model_kwargs.get('conditioning_input') is None or \
+                model_kwargs.get('return_code_pred', False):
+            return model_kwargs
+        model_kwargs['precomputed_aligned_embeddings'] = self.timestep_independent(model_kwargs.pop('aligned_conditioning'),
+                                                                                   model_kwargs.pop('conditioning_input'),
+                                                                                   x.shape[-1], False)
+        return model_kwargs
 
     def forward(self, x, timesteps, aligned_conditioning=None, conditioning_input=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False):
         """
@@ -302,13 +317,23 @@ class DiffusionTtsFlat(nn.Module):
         :param conditioning_input: a full-resolution audio clip that is used as a reference to the style you want decoded.
         :param precomputed_aligned_embeddings: Embeddings returned from self.timestep_independent()
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+                                  May also be an [N] bool mask selecting the samples this applies to.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert precomputed_aligned_embeddings is not None or (aligned_conditioning is not None and conditioning_input is not None)
         assert not (return_code_pred and precomputed_aligned_embeddings is not None)  # These two are mutually exclusive.
 
         unused_params = list(self.mel_head.parameters())
-        if conditioning_free:
+        conditioning_free = uniform_conditioning_free(conditioning_free)
+        if torch.is_tensor(conditioning_free):
+            assert not return_code_pred
+            if precomputed_aligned_embeddings is not None:
+                conditioned_fn = lambda rows: precomputed_aligned_embeddings[rows]
+            else:
+                conditioned_fn = lambda rows: self.timestep_independent(aligned_conditioning[rows], conditioning_input[rows],
+                                                                        x.shape[-1], False)
+            code_emb = select_conditioning(conditioning_free, conditioned_fn, self.unconditioned_embedding)
+        elif conditioning_free:
             code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
             unused_params.extend(list(self.code_converter.parameters()) + list(self.code_embedding.parameters()))
             unused_params.extend(list(self.latent_conditioner.parameters()))
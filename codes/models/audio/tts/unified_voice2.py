@@ -8,6 +8,7 @@ from transformers.models.gpt2.modeling_gpt2 import GPT2Attention
 from transformers.utils.model_parallel_utils import get_device_map, assert_device_map
 
 from models.arch_util import AttentionBlock
+from models.audio.tts.static_kv_decoding import StaticKVCacheGPT2, decode
 from models.audio.tts.transformer_builders import build_hf_gpt_transformer
 from models.lucidrains.x_transformers import RotaryEmbedding, apply_rotary_pos_emb
 from trainer.networks import register_model
@@ -345,6 +346,19 @@ class UnifiedVoice(nn.Module):
                 mel_input_tokens[b, actual_end:] = self.stop_mel_token
         return mel_input_tokens
 
+    def get_conditioning(self, speech_conditioning_input):
+        """
+        Encodes conditioning MELs (b,80,s) or (b,n,80,s) into conditioning embeddings (b,n,d), or (b,1,d) when
+        average_conditioning_embeddings is set. All n clips are folded into the batch and encoded in a single pass.
+        """
+        speech_conditioning_input = speech_conditioning_input.unsqueeze(1) if len(speech_conditioning_input.shape) == 3 else speech_conditioning_input
+        b, n = speech_conditioning_input.shape[:2]
+        conds = self.conditioning_encoder(speech_conditioning_input.reshape(b*n, *speech_conditioning_input.shape[2:]))
+        conds = conds.view(b, n, -1)
+        if self.average_conditioning_embeddings:
+            conds = conds.mean(dim=1).unsqueeze(1)
+        return conds
+
     def get_logits(self, speech_conditioning_inputs, first_inputs, first_head, second_inputs=None, second_head=None, get_attns=False, return_latent=False):
         if second_inputs is not None:
             emb = torch.cat([speech_conditioning_inputs, first_inputs, second_inputs], dim=1)
@@ -401,13 +415,7 @@ class UnifiedVoice(nn.Module):
             raw_mels = raw_mels[:, :, :max_mel_len*4]
         mel_codes = self.set_mel_padding(mel_codes, wav_lengths)
 
-        speech_conditioning_input = speech_conditioning_input.unsqueeze(1) if len(speech_conditioning_input.shape) == 3 else speech_conditioning_input
-        conds = []
-        for j in range(speech_conditioning_input.shape[1]):
-            conds.append(self.conditioning_encoder(speech_conditioning_input[:, j]))
-        conds = torch.stack(conds, dim=1)
-        if self.average_conditioning_embeddings:
-            conds = conds.mean(dim=1).unsqueeze(1)
+        conds = self.get_conditioning(speech_conditioning_input)
 
         text_inputs, text_targets = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
         text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
@@ -447,13 +455,7 @@ class UnifiedVoice(nn.Module):
         max_text_len = text_lengths.max()
         text_inputs = F.pad(text_inputs[:, :max_text_len], (0,1), value=self.stop_text_token)
 
-        speech_conditioning_input = speech_conditioning_input.unsqueeze(1) if len(speech_conditioning_input.shape) == 3 else speech_conditioning_input
-        conds = []
-        for j in range(speech_conditioning_input.shape[1]):
-            conds.append(self.conditioning_encoder(speech_conditioning_input[:, j]))
-        conds = torch.stack(conds, dim=1)
-        if self.average_conditioning_embeddings:
-            conds = conds.mean(dim=1).unsqueeze(1)
+        conds = self.get_conditioning(speech_conditioning_input)
 
         text_inputs, text_targets = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
         text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs) + self.text_solo_embedding
@@ -475,13 +477,7 @@ class UnifiedVoice(nn.Module):
         if raw_mels is not None:
             raw_mels = raw_mels[:, :, :max_mel_len*4]
 
-        speech_conditioning_input = speech_conditioning_input.unsqueeze(1) if len(speech_conditioning_input.shape) == 3 else speech_conditioning_input
-        conds = []
-        for j in range(speech_conditioning_input.shape[1]):
-            conds.append(self.conditioning_encoder(speech_conditioning_input[:, j]))
-        conds = torch.stack(conds, dim=1)
-        if self.average_conditioning_embeddings:
-            conds = conds.mean(dim=1).unsqueeze(1)
+        conds = self.get_conditioning(speech_conditioning_input)
 
         mel_codes, mel_targets = self.build_aligned_inputs_and_targets(mel_codes, self.start_mel_token, self.stop_mel_token)
         if raw_mels is not None:
@@ -494,7 +490,12 @@ class UnifiedVoice(nn.Module):
         loss_mel = F.cross_entropy(mel_logits, mel_targets.long())
         return loss_mel.mean()
 
-    def inference_speech(self, speech_conditioning_input, text_inputs, return_attentions=False, **hf_generate_kwargs):
+    def inference_speech(self, speech_conditioning_input, text_inputs, return_attentions=False, cond_latents=None,
+                         **hf_generate_kwargs):
+        """
+        Generates mel codes with HF generate(). cond_latents, if specified, are the output of get_conditioning() and
+        replace speech_conditioning_input, which may then be None.
+        """
         if self.max_mel_tokens == -1:  # Assume if this is the case, max_mel_tokens=-1 also
             seq_length = 2002  # Arbitrary default.
         else:
@@ -516,13 +517,7 @@ class UnifiedVoice(nn.Module):
         text_inputs, text_targets = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
         text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
 
-        speech_conditioning_input = speech_conditioning_input.unsqueeze(1) if len(speech_conditioning_input.shape) == 3 else speech_conditioning_input
-        conds = []
-        for j in range(speech_conditioning_input.shape[1]):
-            conds.append(self.conditioning_encoder(speech_conditioning_input[:, j]))
-        conds = torch.stack(conds, dim=1)
-        if self.average_conditioning_embeddings:
-            conds = conds.mean(dim=1).unsqueeze(1)
+        conds = cond_latents if cond_latents is not None else self.get_conditioning(speech_conditioning_input)
 
         emb = torch.cat([conds, text_emb], dim=1)
         self.inference_model.store_mel_emb(emb)
@@ -537,6 +532,69 @@ class UnifiedVoice(nn.Module):
         else:
             return gen.sequences[:, fake_inputs.shape[1]:]
 
+    def inference_speech_kv_cache(self, speech_conditioning_input, text_inputs, text_lengths=None, max_new_tokens=None,
+                                  num_return_sequences=1, do_sample=True, temperature=1.0, top_k=None, top_p=None,
+                                  cond_latents=None):
+        """
+        Equivalent of inference_speech() which decodes with a preallocated KV cache (see static_kv_decoding.py) rather
+        than HF generate(). Prompts may have different text lengths: pass text_lengths and each one is left-padded
+        into the batch. Every sequence stops at its own stop_mel_token.
+
+        speech_conditioning_input: MEL float tensor, (b,80,s) or (b,n,80,s)
+        text_inputs: long tensor, (b,t)
+        text_lengths: long tensor, (b,). Defaults to t for every element.
+        cond_latents: Optional output of get_conditioning(), used in place of speech_conditioning_input.
+
+        Returns mel codes (b*num_return_sequences, n), padded with stop_mel_token.
+        """
+        if not hasattr(self, 'kv_cache_decoder'):
+            self.kv_cache_decoder = StaticKVCacheGPT2(self.gpt)
+        b = text_inputs.shape[0]
+        if text_lengths is None:
+            text_lengths = torch.full((b,), text_inputs.shape[1], dtype=torch.long, device=text_inputs.device)
+
+        conds = cond_latents if cond_latents is not None else self.get_conditioning(speech_conditioning_input)
+        if conds.shape[0] != b:
+            conds = conds.expand(b, -1, -1)  # One voice for the whole batch.
+        num_conds = conds.shape[1]
+
+        # Same prompt layout as inference_speech(): [conds, start_text, text, stop_text, <mel prompt>]. The mel prompt
+        # is num_conds tokens, the last of which is start_mel_token.
+        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+        text_inputs[torch.arange(b, device=text_inputs.device), text_lengths] = self.stop_text_token
+        text_inputs = F.pad(text_inputs, (1, 0), value=self.start_text_token)
+        text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+        mel_prompt = torch.full((b, num_conds), 1, dtype=torch.long, device=text_inputs.device)
+        mel_prompt[:, -1] = self.start_mel_token
+        mel_emb = self.mel_embedding(mel_prompt) + self.mel_pos_embedding(mel_prompt)
+
+        prompt_lengths = (num_conds + text_lengths + 2 + num_conds).tolist()
+        prompt_len = max(prompt_lengths)
+        prompt = torch.zeros((b, prompt_len, self.model_dim), dtype=text_emb.dtype, device=text_emb.device)
+        prompt_valid = torch.zeros((b, prompt_len), dtype=torch.bool, device=text_emb.device)
+        for i, length in enumerate(prompt_lengths):
+            t = length - 2 * num_conds
+            prompt[i, prompt_len - length:] = torch.cat([conds[i], text_emb[i, :t], mel_emb[i]], dim=0)
+            prompt_valid[i, prompt_len - length:] = True
+        if num_return_sequences > 1:
+            prompt = prompt.repeat_interleave(num_return_sequences, 0)
+            prompt_valid = prompt_valid.repeat_interleave(num_return_sequences, 0)
+
+        # GPT2InferenceModel embeds generated tokens at mel position attention_mask.shape[1]-mel_len, which counts the
+        # token being embedded, so the first one lands at num_conds+1 rather than directly after the prompt. Models are
+        # sampled that way with inference_speech(), so this reproduces the offset rather than the training alignment.
+        first_pos = num_conds + 1
+        if max_new_tokens is None:
+            max_new_tokens = self.max_mel_tokens - first_pos if self.max_mel_tokens != -1 else 2000
+        if self.max_mel_tokens != -1:
+            mel_pos = self.mel_pos_embedding.emb.weight
+            embed_fn = lambda tokens, step: (self.mel_embedding(tokens) + mel_pos[first_pos + step]).unsqueeze(1)
+        else:
+            embed_fn = lambda tokens, step: self.mel_embedding(tokens).unsqueeze(1)
+        head_fn = lambda hidden: self.mel_head(self.final_norm(hidden))
+        return decode(self.kv_cache_decoder, prompt, prompt_valid, embed_fn, head_fn, self.stop_mel_token,
+                      max_new_tokens, do_sample=do_sample, temperature=temperature, top_k=top_k, top_p=top_p)
+
 
     # Turns the (utterly insane) output of HF.generate() into a far more sane output:
     # [tensors(B,H,S,S)]. Outer=layers, B=batch,H=head,S=sequence
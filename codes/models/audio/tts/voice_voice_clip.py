@@ -94,10 +94,14 @@ class VoiceCLIP(nn.Module):
         loss = (F.cross_entropy(sim, labels) + F.cross_entropy(sim.t(), labels)) / 2
         return loss
 
-    def inference(self, speech_mels):
+    def embed(self, speech_mels):
+        """ Returns L2-normalized latents; their dot products are the similarities computed by inference(), unscaled. """
         emb = self.encoder(speech_mels)
         latent = self.to_latent(emb)
-        latent = F.normalize(latent, p=2, dim=-1)
+        return F.normalize(latent, p=2, dim=-1)
+
+    def inference(self, speech_mels):
+        latent = self.embed(speech_mels)
         temp = self.temperature.exp()
         sim = einsum('i d, j d -> i j', latent, latent) * temp
         return sim
@@ -6,6 +6,7 @@ Docstrings have been added, as well as DDIM sampling and a new collection of bet
 """
 
 import enum
+import functools
 import math
 import random
 
@@ -157,6 +158,15 @@ class GaussianDiffusion:
     :param rescale_timesteps: if True, pass floating point timesteps into the
                               model so that they are always scaled like in the
                               original paper (0 to 1000).
+    :param batched_conditioning_free: if True, models which set
+                                      supports_conditioning_free_mask evaluate
+                                      both branches of classifier-free guidance
+                                      in a single forward pass over a doubled
+                                      batch. Other models are called twice.
+    :param cache_conditioning: if True, the sampling loops call
+                               precompute_conditioning() on models which define
+                               it once per loop and reuse the result at every
+                               step. See _precompute_conditioning().
     """
 
     def __init__(
@@ -170,6 +180,8 @@ class GaussianDiffusion:
         conditioning_free=False,
         conditioning_free_k=1,
         ramp_conditioning_free=True,
+        batched_conditioning_free=True,
+        cache_conditioning=True,
     ):
         self.model_mean_type = ModelMeanType(model_mean_type)
         self.model_var_type = ModelVarType(model_var_type)
@@ -178,6 +190,8 @@ class GaussianDiffusion:
         self.conditioning_free = conditioning_free
         self.conditioning_free_k = conditioning_free_k
         self.ramp_conditioning_free = ramp_conditioning_free
+        self.batched_conditioning_free = batched_conditioning_free
+        self.cache_conditioning = cache_conditioning
 
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
@@ -218,6 +232,32 @@ class GaussianDiffusion:
             / (1.0 - self.alphas_cumprod)
         )
 
+        # Derived tables which would otherwise be recomputed on every call to the functions that use them.
+        self.one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
+        self.log_betas = np.log(betas)
+        self.recip_posterior_mean_coef1 = 1.0 / self.posterior_mean_coef1
+        self.posterior_mean_coef2_over_coef1 = self.posterior_mean_coef2 / self.posterior_mean_coef1
+        self.fixed_large_variance = np.append(self.posterior_variance[1], betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+
+        # Device-resident copies of the schedule tables above, keyed by (name, device, dtype). See _extract().
+        self._device_tables = {}
+
+    def _extract(self, name, timesteps, broadcast_shape, dtype=th.float32):
+        """
+        Equivalent to _extract_into_tensor(getattr(self, name), ...), but gathers from a copy of the table which is
+        uploaded to the timesteps' device once and then cached, rather than copied host-to-device on every call.
+        """
+        key = (name, timesteps.device, dtype)
+        table = self._device_tables.get(key, None)
+        if table is None:
+            table = th.from_numpy(getattr(self, name)).to(device=timesteps.device, dtype=dtype)
+            self._device_tables[key] = table
+        res = table[timesteps]
+        while len(res.shape) < len(broadcast_shape):
+            res = res[..., None]
+        return res.expand(broadcast_shape)
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -227,11 +267,11 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
         mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
+            self._extract('sqrt_alphas_cumprod', t, x_start.shape) * x_start
         )
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
+        variance = self._extract('one_minus_alphas_cumprod', t, x_start.shape)
+        log_variance = self._extract(
+            'log_one_minus_alphas_cumprod', t, x_start.shape
         )
         return mean, variance, log_variance
 
@@ -253,8 +293,8 @@ class GaussianDiffusion:
             mask = (t < 0)
             t[mask] = 0
         result = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
+            self._extract('sqrt_alphas_cumprod', t, x_start.shape) * x_start
+            + self._extract('sqrt_one_minus_alphas_cumprod', t, x_start.shape)
             * noise
         )
         if allow_negatives:
@@ -270,12 +310,12 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            self._extract('posterior_mean_coef1', t, x_t.shape) * x_start
+            + self._extract('posterior_mean_coef2', t, x_t.shape) * x_t
         )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        posterior_variance = self._extract('posterior_variance', t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            'posterior_log_variance_clipped', t, x_t.shape
         )
         assert (
             posterior_mean.shape[0]
@@ -285,6 +325,43 @@ class GaussianDiffusion:
         )
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
 
+    def _precompute_conditioning(self, model, x, model_kwargs):
+        """
+        Computes the timestep-independent conditioning of a sampling loop once, up front.
+
+        Models may define `precompute_conditioning(x, **model_kwargs)`, where x is the (noise) input of the loop. It
+        returns a new model_kwargs dict in which raw conditioning inputs are replaced by their embeddings. forward()
+        must accept the returned kwargs for both the conditioned and the conditioning-free (classifier-free guidance)
+        branches, and must produce the same outputs it would have produced from the original kwargs. Models should
+        return kwargs they cannot cache from unchanged.
+        """
+        if model_kwargs is None:
+            model_kwargs = {}
+        if not (self.cache_conditioning and hasattr(model, 'precompute_conditioning')):
+            return model_kwargs
+        with th.no_grad():
+            return model.precompute_conditioning(x, **model_kwargs)
+
+    def _conditioning_free_outputs(self, model, x, t, model_kwargs):
+        """
+        Returns the conditioned and conditioning-free outputs of the model for classifier-free guidance.
+
+        Models with supports_conditioning_free_mask accept `conditioning_free` as a per-sample [N] bool mask. They are
+        evaluated once on a 2N batch: x, the timesteps and every model_kwargs tensor with a leading batch dimension are
+        repeated, and the second half is conditioning-free. Other models are called twice.
+        """
+        ts = self._scale_timesteps(t)
+        if not (self.batched_conditioning_free and getattr(model, 'supports_conditioning_free_mask', False)):
+            return model(x, ts, **model_kwargs), model(x, ts, conditioning_free=True, **model_kwargs)
+        B = x.shape[0]
+
+        def double(v):
+            return th.cat([v, v], dim=0) if th.is_tensor(v) and v.dim() > 0 and v.shape[0] == B else v
+
+        mask = th.arange(2 * B, device=x.device) >= B
+        out = model(double(x), double(ts), conditioning_free=mask, **{k: double(v) for k, v in model_kwargs.items()})
+        return out[:B], out[B:]
+
     def p_mean_variance(
         self, model, x, t, clip_denoised=True, denoised_fn=None, model_kwargs=None
     ):
@@ -313,9 +390,10 @@ class GaussianDiffusion:
 
         B, C = x.shape[:2]
         assert t.shape == (B,) or t.shape == (B,1,x.shape[-1])
-        model_output = model(x, self._scale_timesteps(t), **model_kwargs)
         if self.conditioning_free:
-            model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
+            model_output, model_output_no_conditioning = self._conditioning_free_outputs(model, x, t, model_kwargs)
+        else:
+            model_output = model(x, self._scale_timesteps(t), **model_kwargs)
 
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
@@ -326,10 +404,10 @@ class GaussianDiffusion:
                 model_log_variance = model_var_values
                 model_variance = th.exp(model_log_variance)
             else:
-                min_log = _extract_into_tensor(
-                    self.posterior_log_variance_clipped, t, x.shape
+                min_log = self._extract(
+                    'posterior_log_variance_clipped', t, x.shape
                 )
-                max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+                max_log = self._extract('log_betas', t, x.shape)
                 # The model_var_values is [-1, 1] for [min_var, max_var].
                 frac = (model_var_values + 1) / 2
                 model_log_variance = frac * max_log + (1 - frac) * min_log
@@ -339,20 +417,20 @@ class GaussianDiffusion:
                 # for fixedlarge, we set the initial (log-)variance like so
                 # to get a better decoder log likelihood.
                 ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
+                    'fixed_large_variance',
+                    'fixed_large_log_variance',
                 ),
                 ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
+                    'posterior_variance',
+                    'posterior_log_variance_clipped',
                 ),
             }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         if self.conditioning_free:
             if self.ramp_conditioning_free:
-                assert t.shape[0] == 1  # This should only be used in inference.
+                assert (t == t[0]).all()  # This should only be used in inference, where the batch shares a timestep.
                 cfk = self.conditioning_free_k * (1 - self._scale_timesteps(t).float().mean().item() / self.num_timesteps)
             else:
                 cfk = self.conditioning_free_k
@@ -401,25 +479,25 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract('sqrt_recip_alphas_cumprod', t, x_t.shape) * x_t
+            - self._extract('sqrt_recipm1_alphas_cumprod', t, x_t.shape) * eps
         )
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
         return (  # (xprev - coef2*x_t) / coef1
-            _extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape) * xprev
-            - _extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t.shape
+            self._extract('recip_posterior_mean_coef1', t, x_t.shape) * xprev
+            - self._extract(
+                'posterior_mean_coef2_over_coef1', t, x_t.shape
             )
             * x_t
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
+            self._extract('sqrt_recip_alphas_cumprod', t, x_t.shape) * x_t
             - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        ) / self._extract('sqrt_recipm1_alphas_cumprod', t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
@@ -454,7 +532,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
@@ -596,11 +674,12 @@ class GaussianDiffusion:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        model_kwargs = self._precompute_conditioning(model, img, model_kwargs)
         indices = list(range(self.num_timesteps))[::-1]
 
         orig_img = img
         for i in tqdm(indices):
-            t = th.tensor([i] * shape[0], device=device)
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
             mask = torch.zeros_like(img)
             if causal:
                 t = causal_timestep_adjustment(t, shape[-1], self.num_timesteps, causal_slope * self._get_scale_ratio(), add_jitter=False).unsqueeze(1)
@@ -639,11 +718,12 @@ class GaussianDiffusion:
         shape = guidance_input.shape
         if noise is None:
             noise = th.randn(*shape, device=device)
+        model_kwargs = self._precompute_conditioning(model, noise, model_kwargs)
         indices = list(range(self.num_timesteps))[::-1]
 
         img = noise
         for i in tqdm(indices):
-            t = th.tensor([i] * shape[0], device=device)
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
             with th.no_grad():
                 out = self.p_sample(
                     model,
@@ -675,13 +755,14 @@ class GaussianDiffusion:
         shape = truth.shape
         if noise is None:
             noise = th.randn(*shape, device=device)
+        model_kwargs = self._precompute_conditioning(model, noise, model_kwargs)
         indices = list(range(self.num_timesteps))[::-1]
 
         img = noise
         #perp = self.num_timesteps
         logperp = 0
         for i in tqdm(indices):
-            t = th.tensor([i] * shape[0], device=device)
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
             with th.no_grad():
                 out = self.p_sample(
                     model,
@@ -734,8 +815,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract('alphas_cumprod', t, x.shape)
+        alpha_bar_prev = self._extract('alphas_cumprod_prev', t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -747,7 +828,7 @@ class GaussianDiffusion:
             out["pred_xstart"] * th.sqrt(alpha_bar_prev)
             + th.sqrt(1 - alpha_bar_prev - sigma ** 2) * eps
         )
-        if len(t.shape) == 2:
+        if len(t.shape) == 1:
             nonzero_mask = (
                 (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
             )  # no noise when t == 0
@@ -781,10 +862,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract('sqrt_recip_alphas_cumprod', t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract('sqrt_recipm1_alphas_cumprod', t, x.shape)
+        alpha_bar_next = self._extract('alphas_cumprod_next', t, x.shape)
 
         # Equation 12. reversed
         mean_pred = (
@@ -852,11 +933,12 @@ class GaussianDiffusion:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        model_kwargs = self._precompute_conditioning(model, img, model_kwargs)
         indices = list(range(self.num_timesteps))[::-1]
 
         orig_img = img
         for i in tqdm(indices):
-            t = th.tensor([i] * shape[0], device=device)
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
             c_mask = torch.zeros_like(img)
             if causal:
                 t = causal_timestep_adjustment(t, shape[-1], self.num_timesteps, causal_slope * self._get_scale_ratio(), add_jitter=False).unsqueeze(1)
@@ -910,6 +992,7 @@ class GaussianDiffusion:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        model_kwargs = self._precompute_conditioning(model, img, model_kwargs)
         indices = list(range(self.num_timesteps))[::-1]
 
         if progress:
@@ -920,7 +1003,7 @@ class GaussianDiffusion:
 
         orig_img = img
         for i in indices:
-            t = th.tensor([i] * shape[0], device=device)
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
             mask = torch.zeros_like(img)
             if causal:
                 t = causal_timestep_adjustment(t, shape[-1], self.num_timesteps, causal_slope * self._get_scale_ratio(), add_jitter=False).unsqueeze(1)
@@ -944,6 +1027,247 @@ class GaussianDiffusion:
                     img[mask] = orig_img[mask]  # For causal diffusion, keep resetting these predictions until they are unmasked.
                 orig_img = orig_img
 
+    def sample_loop_fn(self, sampler, order=2):
+        """
+        Returns the sampling loop named by `sampler`, one of 'p_sample', 'ddim', 'dpm++' or 'unipc'. All of them accept
+        the arguments of p_sample_loop(). `order` only applies to the multistep solvers.
+        """
+        if sampler == 'p_sample':
+            return self.p_sample_loop
+        elif sampler == 'ddim':
+            return self.ddim_sample_loop
+        elif sampler in ['dpm++', 'unipc']:
+            return functools.partial(self.dpm_solver_sample_loop, solver=sampler, order=order)
+        raise NotImplementedError(f'Unknown sampler {sampler}')
+
+    def _ode_schedule(self, index):
+        """
+        Returns (alpha, sigma, lambda) of the diffusion ODE at the given timestep index, where x_t = alpha*x_0 + sigma*eps
+        and lambda is the half log-SNR.
+        """
+        alpha = math.sqrt(self.alphas_cumprod[index])
+        sigma = math.sqrt(1.0 - self.alphas_cumprod[index])
+        return alpha, sigma, math.log(alpha / sigma)
+
+    def _dpm_solver_pp_update(self, x, x0s, lambdas, index, order):
+        """
+        One multistep DPM-Solver++ step (Lu et al. 2022) in data prediction form from the timestep of the last entry in
+        `lambdas` to the timestep `index`. `x0s` and `lambdas` hold the model x_0 predictions and half log-SNRs of
+        previous timesteps, most recent last.
+        """
+        alpha_t, sigma_t, lambda_t = self._ode_schedule(index)
+        sigma_s = math.sqrt(1 / (1 + math.exp(2 * lambdas[-1])))
+        h = lambda_t - lambdas[-1]
+        phi_1 = math.expm1(-h)
+        m0 = x0s[-1]
+        x_t = (sigma_t / sigma_s) * x - (alpha_t * phi_1) * m0
+        if order == 2:
+            r0 = (lambdas[-1] - lambdas[-2]) / h
+            x_t = x_t - (0.5 * alpha_t * phi_1 / r0) * (m0 - x0s[-2])
+        elif order == 3:
+            r0 = (lambdas[-1] - lambdas[-2]) / h
+            r1 = (lambdas[-2] - lambdas[-3]) / h
+            d1_0 = (m0 - x0s[-2]) / r0
+            d1_1 = (x0s[-2] - x0s[-3]) / r1
+            d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+            d2 = (d1_0 - d1_1) / (r0 + r1)
+            phi_2 = phi_1 / h + 1
+            phi_3 = phi_2 / h - 0.5
+            x_t = x_t + (alpha_t * phi_2) * d1 - (alpha_t * phi_3) * d2
+        return x_t
+
+    def _unipc_update(self, x, x0s, lambdas, index, order, x0_t=None):
+        """
+        One UniPC step (Zhao et al. 2023, B(h)=expm1(h) variant) in data prediction form, with the same arguments as
+        _dpm_solver_pp_update(). Without `x0_t` this is the UniP predictor. Given the model's x_0 prediction at the
+        predicted point, it returns the UniC corrected point instead, which costs no additional model evaluations.
+        """
+        alpha_t, sigma_t, lambda_t = self._ode_schedule(index)
+        sigma_s = math.sqrt(1 / (1 + math.exp(2 * lambdas[-1])))
+        h = lambda_t - lambdas[-1]
+        m0 = x0s[-1]
+        rks = [(lambdas[-(i + 1)] - lambdas[-1]) / h for i in range(1, order)] + [1.0]
+        d1s = [(x0s[-(i + 1)] - m0) / rks[i - 1] for i in range(1, order)]
+
+        hh = -h
+        h_phi_1 = math.expm1(hh)
+        h_phi_k = h_phi_1 / hh - 1
+        b_h = math.expm1(hh)
+        factorial_i = 1
+        R, b = [], []
+        for i in range(1, order + 1):
+            R.append([rk ** (i - 1) for rk in rks])
+            b.append(h_phi_k * factorial_i / b_h)
+            factorial_i *= i + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial_i
+        R, b = np.array(R), np.array(b)
+
+        x_t = (sigma_t / sigma_s) * x - (alpha_t * h_phi_1) * m0
+        if x0_t is None:
+            if order == 1:
+                return x_t
+            rhos = [0.5] if order == 2 else np.linalg.solve(R[:-1, :-1], b[:-1])
+            return x_t - (alpha_t * b_h) * sum(float(rho) * d1 for rho, d1 in zip(rhos, d1s))
+        rhos = [0.5] if order == 1 else np.linalg.solve(R, b)
+        correction = sum((float(rho) * d1 for rho, d1 in zip(rhos[:-1], d1s)), float(rhos[-1]) * (x0_t - m0))
+        return x_t - (alpha_t * b_h) * correction
+
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        causal=False,
+        causal_slope=1,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=True,
+        solver='dpm++',
+        order=2,
+        guidance_input=None,
+        guidance_mask=None,
+    ):
+        """
+        Generate samples from the model with a multistep ODE solver.
+
+        Same usage as p_sample_loop(), plus:
+        :param solver: 'dpm++' for DPM-Solver++ or 'unipc' for UniPC.
+        :param order: the solver order, 1-3. Order 1 is DDIM with eta=0.
+        :param guidance_input: if specified, the regions of the sample selected by guidance_mask are fixed to this input,
+                               noised to the level of each timestep. See ddim_sample_loop_with_guidance().
+        :param guidance_mask: the mask of the regions given by guidance_input.
+        """
+        final = None
+        for sample in self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            causal=causal,
+            causal_slope=causal_slope,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            solver=solver,
+            order=order,
+            guidance_input=guidance_input,
+            guidance_mask=guidance_mask,
+        ):
+            final = sample
+        return final["sample"]
+
+    def dpm_solver_sample_loop_with_guidance(
+        self,
+        model,
+        guidance_input,
+        mask,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        solver='dpm++',
+        order=2,
+    ):
+        """
+        Multistep ODE solver counterpart of ddim_sample_loop_with_guidance().
+        """
+        return self.dpm_solver_sample_loop(model, guidance_input.shape, noise=noise, clip_denoised=clip_denoised,
+                                           denoised_fn=denoised_fn, model_kwargs=model_kwargs,
+                                           device=guidance_input.device, solver=solver, order=order,
+                                           guidance_input=guidance_input, guidance_mask=mask)
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        causal=False,
+        causal_slope=1,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=True,
+        solver='dpm++',
+        order=2,
+        guidance_input=None,
+        guidance_mask=None,
+    ):
+        """
+        Use a multistep ODE solver to sample from the model and yield intermediate samples from each timestep.
+
+        The model is evaluated once per timestep of this diffusion (so a SpacedDiffusion with N timesteps costs N
+        function evaluations, like DDIM), and only its x_0 prediction is used: learned variances are discarded, while
+        classifier-free guidance, clip_denoised and denoised_fn apply as usual through p_mean_variance(). The last
+        evaluation returns its x_0 prediction. The solver order is lowered for the first and last steps.
+
+        Same usage as dpm_solver_sample_loop().
+        """
+        assert solver in ['dpm++', 'unipc'], f'Unknown solver {solver}'
+        assert 1 <= order <= 3
+        assert not causal, 'Causal diffusion is not supported by the ODE solvers.'
+        assert cond_fn is None, 'cond_fn is not supported by the ODE solvers.'
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is None:
+            noise = th.randn(*shape, device=device)
+        img = noise
+        model_kwargs = self._precompute_conditioning(model, img, model_kwargs)
+        indices = list(range(self.num_timesteps))[::-1]
+
+        def guide(x, index):
+            if guidance_input is None:
+                return x
+            if index is None:
+                guidance = guidance_input
+            else:
+                guidance = self.q_sample(guidance_input, th.full((shape[0],), index, device=device, dtype=th.long), noise=noise)
+            return x * guidance_mask.logical_not() + guidance * guidance_mask
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        update = self._dpm_solver_pp_update if solver == 'dpm++' else self._unipc_update
+        steps = list(range(self.num_timesteps))[::-1]
+        x0s, lambdas = [], []
+        x_prev, step_order = None, 1
+        img = guide(img, steps[0])
+        for k, i in enumerate(indices):
+            t = th.full((shape[0],), i, device=device, dtype=th.long)
+            with th.no_grad():
+                out = self.p_mean_variance(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                )
+            x0 = out["pred_xstart"]
+            if solver == 'unipc' and x_prev is not None:
+                img = guide(self._unipc_update(x_prev, x0s, lambdas, i, step_order, x0_t=x0), i)
+            x0s = (x0s + [x0])[-order:]
+            lambdas = (lambdas + [self._ode_schedule(i)[2]])[-order:]
+
+            if k == len(steps) - 1:
+                sample = guide(x0, None)
+            else:
+                step_order = min(order, k + 1, len(steps) - 1 - k)
+                x_prev = img
+                sample = guide(update(img, x0s, lambdas, steps[k + 1], step_order), steps[k + 1])
+            yield {"sample": sample, "pred_xstart": x0}
+            img = sample
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
     ):
@@ -1246,6 +1570,200 @@ def graph_causal_timestep_adjustment_by_timestep():
         plt.savefig(f'{t}.png')
         plt.clf()
 
+def benchmark_schedule_tables(device='cuda', batch_size=16, channels=100, length=400, train_steps=100, sampling_steps=200):
+    """
+    Measures the effect of device-resident schedule tables on training step time (as performed by
+    GaussianDiffusionInjector) and on a full p_sample_loop. The baseline re-uploads each table on every lookup, as
+    _extract_into_tensor does.
+    """
+    import time
+    from models.diffusion.respace import SpacedDiffusion, space_timesteps
+
+    class UncachedSpacedDiffusion(SpacedDiffusion):
+        def _extract(self, name, timesteps, broadcast_shape, dtype=th.float32):
+            return _extract_into_tensor(getattr(self, name), timesteps, broadcast_shape)
+
+    class TinyModel(th.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.conv = th.nn.Conv1d(channels, channels * 2, 3, padding=1)
+
+        def forward(self, x, t, **kwargs):
+            return self.conv(x)
+
+    def sync():
+        if th.device(device).type == 'cuda':
+            th.cuda.synchronize()
+
+    model = TinyModel().to(device)
+    x = th.randn(batch_size, channels, length, device=device).clamp(-1, 1)
+    diffusion_args = {'model_mean_type': 'epsilon', 'model_var_type': 'learned_range', 'loss_type': 'mse',
+                      'betas': get_named_beta_schedule('linear', 4000)}
+    for name, cls in [('uncached', UncachedSpacedDiffusion), ('cached', SpacedDiffusion)]:
+        train_diffusion = cls(use_timesteps=space_timesteps(4000, [4000]), **diffusion_args)
+        sync()
+        start = time.perf_counter()
+        for _ in range(train_steps):
+            t = th.randint(0, 4000, (batch_size,), device=device)
+            train_diffusion.training_losses(model, x, t)['loss'].mean().backward()
+        sync()
+        train_time = (time.perf_counter() - start) / train_steps
+
+        infer_diffusion = cls(use_timesteps=space_timesteps(4000, [sampling_steps]), **diffusion_args)
+        with th.no_grad():
+            sync()
+            start = time.perf_counter()
+            infer_diffusion.p_sample_loop(model, x.shape, device=device)
+            sync()
+        infer_time = time.perf_counter() - start
+        print(f'{name}: training step {train_time*1000:.2f}ms; {sampling_steps}-step p_sample_loop {infer_time*1000:.1f}ms')
+
+
+def benchmark_conditioning_free(device='cuda', batch_size=1, channels=100, length=400, model_channels=512,
+                                sampling_steps=100):
+    """
+    Measures p_sample_loop and ddim_sample_loop latency with classifier-free guidance evaluated by two model calls per
+    step against one call on a doubled batch, and checks that both produce the same samples.
+    """
+    import time
+    from models.diffusion.nn import uniform_conditioning_free, select_conditioning, timestep_embedding
+    from models.diffusion.respace import SpacedDiffusion, space_timesteps
+
+    class TinyGuidedModel(th.nn.Module):
+        supports_conditioning_free_mask = True
+
+        def __init__(self):
+            super().__init__()
+            self.cond_encoder = th.nn.Conv1d(channels, model_channels, 3, padding=1)
+            self.unconditioned_embedding = th.nn.Parameter(th.randn(1, model_channels, 1))
+            self.inp = th.nn.Conv1d(channels, model_channels, 3, padding=1)
+            self.trunk = th.nn.Sequential(*[th.nn.Sequential(th.nn.Conv1d(model_channels, model_channels, 3, padding=1),
+                                                             th.nn.SiLU()) for _ in range(8)])
+            self.out = th.nn.Conv1d(model_channels, channels * 2, 3, padding=1)
+
+        def forward(self, x, t, conditioning_input=None, conditioning_free=False):
+            conditioning_free = uniform_conditioning_free(conditioning_free)
+            if th.is_tensor(conditioning_free):
+                cond = select_conditioning(conditioning_free, lambda rows: self.cond_encoder(conditioning_input[rows]),
+                                           self.unconditioned_embedding)
+            elif conditioning_free:
+                cond = self.unconditioned_embedding
+            else:
+                cond = self.cond_encoder(conditioning_input)
+            h = self.inp(x) + cond + timestep_embedding(t, model_channels).unsqueeze(-1)
+            return self.out(self.trunk(h))
+
+    def sync():
+        if th.device(device).type == 'cuda':
+            th.cuda.synchronize()
+
+    model = TinyGuidedModel().to(device).eval()
+    shape = (batch_size, channels, length)
+    noise = th.randn(shape, device=device)
+    model_kwargs = {'conditioning_input': th.randn(shape, device=device)}
+    results = {}
+    for name, batched in [('two calls', False), ('batched', True)]:
+        diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [sampling_steps]), model_mean_type='epsilon',
+                                   model_var_type='learned_range', loss_type='mse',
+                                   betas=get_named_beta_schedule('linear', 4000), conditioning_free=True,
+                                   conditioning_free_k=2, ramp_conditioning_free=batch_size == 1,
+                                   batched_conditioning_free=batched)
+        for loop in ['p_sample_loop', 'ddim_sample_loop']:
+            with th.no_grad():
+                getattr(diffuser, loop)(model, shape, noise=noise, model_kwargs=model_kwargs, progress=False)  # Warmup.
+                th.manual_seed(0)
+                sync()
+                start = time.perf_counter()
+                sample = getattr(diffuser, loop)(model, shape, noise=noise, model_kwargs=model_kwargs, progress=False)
+                sync()
+            results[(name, loop)] = (time.perf_counter() - start, sample)
+    for loop in ['p_sample_loop', 'ddim_sample_loop']:
+        (before, a), (after, b) = results[('two calls', loop)], results[('batched', loop)]
+        print(f'{loop} ({sampling_steps} steps, batch {batch_size}): two calls {before*1000:.1f}ms; batched '
+              f'{after*1000:.1f}ms; max difference {(a - b).abs().max().item():.2e}')
+    return results
+
+
+def benchmark_conditioning_cache(model, shape, model_kwargs, sampling_steps=50, conditioning_free=True, device='cuda'):
+    """
+    Measures the per-step latency of ddim_sample_loop on `model` with and without precompute_conditioning(), and checks
+    that both produce the same samples.
+    """
+    import time
+    from models.diffusion.respace import SpacedDiffusion, space_timesteps
+
+    def sync():
+        if th.device(device).type == 'cuda':
+            th.cuda.synchronize()
+
+    model = model.to(device).eval()
+    noise = th.randn(shape, device=device)
+    model_kwargs = {k: v.to(device) if th.is_tensor(v) else v for k, v in model_kwargs.items()}
+    results = {}
+    for name, cached in [('uncached', False), ('cached', True)]:
+        diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [sampling_steps]), model_mean_type='epsilon',
+                                   model_var_type='learned_range', loss_type='mse',
+                                   betas=get_named_beta_schedule('linear', 4000), conditioning_free=conditioning_free,
+                                   conditioning_free_k=2, cache_conditioning=cached)
+        with th.no_grad():
+            diffuser.ddim_sample_loop(model, shape, noise=noise, model_kwargs=dict(model_kwargs), progress=False)  # Warmup.
+            sync()
+            start = time.perf_counter()
+            sample = diffuser.ddim_sample_loop(model, shape, noise=noise, model_kwargs=dict(model_kwargs), progress=False)
+            sync()
+        results[name] = ((time.perf_counter() - start) / sampling_steps, sample)
+    (before, a), (after, b) = results['uncached'], results['cached']
+    print(f'{type(model).__name__}: {before*1000:.2f}ms/step uncached; {after*1000:.2f}ms/step cached; '
+          f'max difference {(a - b).abs().max().item():.2e}')
+    return results
+
+
+def benchmark_ode_solvers(nfes=(5, 10, 20, 50), orders=(1, 2, 3), schedule='linear'):
+    """
+    Measures the error of ddim_sample_loop and the multistep ODE solvers against the exact probability flow ODE solution
+    for Gaussian data, whose optimal denoiser is known in closed form. See trainer/eval for quality-vs-NFE on real
+    models (scripts/diffusion/diffusion_sampler_nfe_sweep.py).
+    """
+    from models.diffusion.respace import SpacedDiffusion, space_timesteps
+
+    betas = get_named_beta_schedule(schedule, 4000)
+    alphas_cumprod = th.tensor(GaussianDiffusion(betas=betas, model_mean_type='epsilon', model_var_type='learned_range',
+                                                 loss_type='mse').alphas_cumprod)
+    mu, std = .3, .5
+
+    class GaussianOracle(th.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.dummy = th.nn.Parameter(th.zeros(1))
+
+        def forward(self, x, t):
+            alpha_bar = alphas_cumprod[t].view(-1, 1, 1)
+            alpha, sigma = alpha_bar.sqrt(), (1 - alpha_bar).sqrt()
+            x0 = mu + alpha * std ** 2 / (alpha_bar * std ** 2 + sigma ** 2) * (x - alpha * mu)
+            eps = (x - alpha * x0) / sigma
+            return th.cat([eps, th.zeros_like(eps)], dim=1).float()
+
+    model = GaussianOracle()
+    noise = th.randn(1, 4, 256, dtype=th.float64)
+    for nfe in nfes:
+        diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [nfe]), model_mean_type='epsilon',
+                                   model_var_type='learned_range', loss_type='mse', betas=betas)
+        # The ODE preserves (x_t - alpha_t*mu) / sqrt(alpha_t^2*std^2 + sigma_t^2). All samplers end with the x_0
+        # prediction at the last timestep.
+        a_T, a_0 = math.sqrt(diffuser.alphas_cumprod[-1]), math.sqrt(diffuser.alphas_cumprod[0])
+        z = (noise - a_T * mu) / math.sqrt(a_T ** 2 * std ** 2 + 1 - a_T ** 2)
+        x_0 = a_0 * mu + math.sqrt(a_0 ** 2 * std ** 2 + 1 - a_0 ** 2) * z
+        exact = (mu + a_0 * std ** 2 / (a_0 ** 2 * std ** 2 + 1 - a_0 ** 2) * (x_0 - a_0 * mu)).float()
+        errors = {'ddim': diffuser.ddim_sample_loop(model, noise.shape, noise=noise.float(), clip_denoised=False,
+                                                    progress=False)}
+        for solver in ['dpm++', 'unipc']:
+            for order in orders:
+                errors[f'{solver}{order}'] = diffuser.dpm_solver_sample_loop(model, noise.shape, noise=noise.float(),
+                                                                             clip_denoised=False, progress=False,
+                                                                             solver=solver, order=order)
+        print(f'NFE {nfe}: ' + ', '.join(f'{k} {(v - exact).abs().max().item():.2e}' for k, v in errors.items()))
+
+
 if __name__ == '__main__':
     #test_causal_training_losses()
     #graph_causal_timestep_adjustment()
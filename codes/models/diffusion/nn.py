@@ -133,6 +133,35 @@ def timestep_embedding(timesteps, dim, max_period=10000):
     return embedding
 
 
+def uniform_conditioning_free(conditioning_free):
+    """
+    Models which support classifier-free guidance in a single pass accept `conditioning_free` either as a bool for the
+    whole batch or as a per-sample [N] bool mask. This reduces a mask which is uniform across the batch to a bool.
+    """
+    if th.is_tensor(conditioning_free):
+        if conditioning_free.all():
+            return True
+        if not conditioning_free.any():
+            return False
+    return conditioning_free
+
+
+def select_conditioning(conditioning_free, conditioned_fn, unconditioned):
+    """
+    Builds the conditioning for a batch where only some samples are conditioning-free.
+
+    :param conditioning_free: an [N] bool mask, True for the samples which ignore their conditioning.
+    :param conditioned_fn: computes the conditioning of the samples at the given [M] row indices.
+    :param unconditioned: the conditioning-free embedding, broadcastable to the conditioning of one sample.
+    :return: the conditioning of all N samples.
+    """
+    rows = conditioning_free.logical_not().nonzero().squeeze(1)
+    cond = conditioned_fn(rows)
+    out = unconditioned.to(cond.dtype).expand(conditioning_free.shape[0], *cond.shape[1:]).clone()
+    out[rows] = cond
+    return out
+
+
 def checkpoint(func, inputs, params, flag):
     """
     Evaluate a function without caching intermediate activations, allowing for
@@ -84,6 +84,7 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        self._timestep_map_tensors = {}
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -106,7 +107,7 @@ class SpacedDiffusion(GaussianDiffusion):
             return model
         mod = _WrappedAutoregressiveModel if autoregressive else _WrappedModel
         return mod(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps, self._timestep_map_tensors
         )
 
     def _scale_timesteps(self, t):
@@ -118,30 +119,48 @@ class SpacedDiffusion(GaussianDiffusion):
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps, map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        # Wrappers are created per call, so the device copies of timestep_map are owned by the SpacedDiffusion.
+        self.map_tensors = map_tensors if map_tensors is not None else {}
+
+    def _map_tensor(self, ts):
+        key = (ts.device, ts.dtype)
+        if key not in self.map_tensors:
+            self.map_tensors[key] = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        return self.map_tensors[key]
+
+    @property
+    def supports_conditioning_free_mask(self):
+        return getattr(self.model, 'supports_conditioning_free_mask', False)
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = self._map_tensor(ts)[ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, new_ts, **kwargs)
 
 
 class _WrappedAutoregressiveModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps, map_tensors=None):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        # Wrappers are created per call, so the device copies of timestep_map are owned by the SpacedDiffusion.
+        self.map_tensors = map_tensors if map_tensors is not None else {}
+
+    def _map_tensor(self, ts):
+        key = (ts.device, ts.dtype)
+        if key not in self.map_tensors:
+            self.map_tensors[key] = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        return self.map_tensors[key]
 
     def __call__(self, x, x0, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = self._map_tensor(ts)[ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, x0, new_ts, **kwargs)
\ No newline at end of file
@@ -9,6 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision  # For debugging, not actually used.
 
+from models.attention_backends import attention, get_attention_backend
 from models.diffusion.fp16_util import convert_module_to_f16, convert_module_to_f32
 from models.diffusion.nn import (
     conv_nd,
@@ -375,6 +376,11 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
+        if rel_pos is None and get_attention_backend() != 'math':
+            if mask is not None:
+                # Masking the weights after the softmax is the same as masking the values.
+                v = v * mask.repeat(self.n_heads, 1).unsqueeze(1)
+            return attention(q, k, v).reshape(bs, -1, length)
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts", q * scale, k * scale
@@ -415,6 +421,12 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
+        if rel_pos is None and get_attention_backend() != 'math':
+            q, k, v = [z.reshape(bs * self.n_heads, ch, length) for z in (q, k, v)]
+            if mask is not None:
+                # Multiplying the weights by the mask before the softmax is the same as multiplying the keys.
+                k = k * mask.repeat(self.n_heads, 1).unsqueeze(1)
+            return attention(q, k, v).reshape(bs, -1, length)
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts",
@@ -1,14 +1,17 @@
 import argparse
 import logging
-import os
 import os.path as osp
+import json
+import math
+import queue
 import subprocess
+import threading
 import time
 
+import numpy as np
+
 import torch
 import torch.utils.data as data
-import torchvision.transforms.functional as F
-from PIL import Image
 from tqdm import tqdm
 
 from trainer.ExtensibleTrainer import ExtensibleTrainer
@@ -17,70 +20,145 @@ import utils.util as util
 from data import create_dataloader
 
 
-class FfmpegBackedVideoDataset(data.Dataset):
-    '''Pulls frames from a video one at a time using FFMPEG.'''
-
-    def __init__(self, opt, working_dir):
+class FfmpegFrameReader:
+    """
+    Decodes a video with a single ffmpeg process which streams raw rgb24 frames over a pipe. A background thread reads
+    frames into a queue holding at most `prefetch` of them, so decoding overlaps with whatever consumes the frames.
+    Iterating yields (H, W, 3) uint8 numpy arrays.
+    """
+    def __init__(self, video, frame_rate, start_at, end_at, prefetch=16):
+        self.video = video
+        self.frame_rate = frame_rate
+        self.start_at = start_at
+        self.frame_count = int((end_at - start_at) * frame_rate)
+        self.prefetch = prefetch
+        probe = json.loads(subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+                                           'stream=width,height', '-of', 'json', video],
+                                          capture_output=True, check=True).stdout)['streams'][0]
+        self.width, self.height = int(probe['width']), int(probe['height'])
+
+    def _read(self, proc, frames):
+        frame_bytes = self.width * self.height * 3
+        try:
+            for _ in range(self.frame_count):
+                buf = bytearray(frame_bytes)
+                if proc.stdout.readinto(buf) < frame_bytes:
+                    break
+                frames.put(np.frombuffer(buf, dtype=np.uint8).reshape(self.height, self.width, 3))
+        finally:
+            frames.put(None)
+
+    def __iter__(self):
+        # The fps filter samples the source frame nearest to each of start_at + i / frame_rate.
+        cmd = ['ffmpeg', '-v', 'error', '-ss', str(self.start_at), '-i', self.video, '-vf', f'fps={self.frame_rate}',
+               '-frames:v', str(self.frame_count), '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:']
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        frames = queue.Queue(maxsize=self.prefetch)
+        reader = threading.Thread(target=self._read, args=(proc, frames), daemon=True)
+        reader.start()
+        try:
+            while True:
+                frame = frames.get()
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            proc.kill()
+            # Unblock the reader if it is waiting on a full queue.
+            while reader.is_alive():
+                try:
+                    frames.get(timeout=.1)
+                except queue.Empty:
+                    pass
+            proc.stdout.close()
+            proc.wait()
+
+
+class FfmpegFrameWriter:
+    """
+    Encodes frames with a single ffmpeg process fed raw frames over a pipe. Frames are handed to a background thread
+    through a queue holding at most `queue_size` of them, so encoding overlaps with producing the next frames.
+    """
+    def __init__(self, output_path, width, height, frame_rate, crf, pix_fmt='bgr24', queue_size=16):
+        self.width = width
+        self.height = height
+        # Encoding command line (for image files):
+        # ffmpeg -framerate 30 -i %08d.png -c:v libx265 -crf 12 -preset slow -pix_fmt yuv444p test.mkv
+        cmd = ['ffmpeg', '-y', '-v', 'error', '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-s', f'{width}x{height}',
+               '-framerate', str(frame_rate), '-i', 'pipe:', '-c:v', 'libx265', '-crf', str(crf), '-preset', 'slow',
+               '-pix_fmt', 'yuv444p', output_path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        try:
+            while True:
+                frame = self.frames.get()
+                if frame is None:
+                    break
+                self.proc.stdin.write(frame.tobytes())
+        except Exception as e:
+            self.error = e
+            # Keep draining so that writers are never blocked on a dead encoder.
+            while self.frames.get() is not None:
+                pass
+        finally:
+            self.proc.stdin.close()
+
+    def write(self, frame):
+        """ Queues a (height, width, 3) uint8 frame for encoding. """
+        assert frame.shape == (self.height, self.width, 3), f'Expected a {self.height}x{self.width} frame, got {frame.shape}'
+        self.frames.put(np.ascontiguousarray(frame))
+
+    def close(self, wait=True):
+        """ Ends the stream. With wait=False, the encode finishes in the background; call wait() before exiting. """
+        self.frames.put(None)
+        if wait:
+            self.wait()
+
+    def wait(self):
+        self.thread.join()
+        ret = self.proc.wait()
+        if self.error is not None or ret != 0:
+            raise RuntimeError(f'ffmpeg encode failed with exit code {ret}: {self.error}')
+
+
+class FfmpegBackedVideoDataset(data.IterableDataset):
+    '''Streams frames from a video, in order, through one persistent FFMPEG decode pipe.'''
+
+    def __init__(self, opt):
         super(FfmpegBackedVideoDataset, self).__init__()
         self.opt = opt
         self.video = self.opt['video_file']
-        self.working_dir = working_dir
         self.frame_rate = self.opt['frame_rate']
         self.start_at = self.opt['start_at_seconds']
         self.end_at = self.opt['end_at_seconds']
         self.force_multiple = self.opt['force_multiple']
-        self.frame_count = (self.end_at - self.start_at) * self.frame_rate
-        # The number of (original) video frames that will be stored on the filesystem at a time.
-        self.max_working_files = 20
+        self.frame_count = int((self.end_at - self.start_at) * self.frame_rate)
+        # The number of decoded frames that are buffered ahead of the model.
+        self.prefetch = util.opt_get(opt, ['prefetch_frames'], 16)
 
         self.data_type = self.opt['data_type']
         self.vertical_splits = self.opt['vertical_splits'] if 'vertical_splits' in opt.keys() else 1
+        self.vertical_splits = max(self.vertical_splits or 1, 1)
+
+    def get_item(self, frame, split_index):
+        img_LQ = torch.from_numpy(frame).permute(2, 0, 1).float() / 255
+        c, h, w = img_LQ.shape
+        w_per_split = int(w / self.vertical_splits)
+        left = w_per_split * split_index
+        img_LQ = img_LQ[:, :, left:left + w_per_split]
+        c, h, w = img_LQ.shape
 
-    def get_time_for_it(self, it):
-        secs = it / self.frame_rate + self.start_at
-        mins = int(secs / 60)
-        hours = int(mins / 60)
-        secs = secs - (mins * 60) - (hours * 3600)
-        mins = mins % 60
-        return '%02d:%02d:%06.3f' % (hours, mins, secs)
-
-    def __getitem__(self, index):
-        if self.vertical_splits > 0:
-            actual_index = int(index / self.vertical_splits)
-        else:
-            actual_index = index
-
-        # Extract the frame. Command template: `ffmpeg -ss 17:00.0323 -i <video file>.mp4 -vframes 1 destination.png`
-        working_file_name = osp.join(self.working_dir, "working_%d.png" % (actual_index % self.max_working_files,))
-        vid_time = self.get_time_for_it(actual_index)
-        ffmpeg_args = ['ffmpeg', '-y', '-ss', vid_time, '-i', self.video, '-vframes', '1', working_file_name]
-        process = subprocess.Popen(ffmpeg_args, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-        process.wait()
-
-        # get LQ image
-        LQ_path = working_file_name
-        img_LQ = Image.open(LQ_path)
-        split_index = (index % self.vertical_splits)
-        if self.vertical_splits > 0:
-            w, h = img_LQ.size
-            w_per_split = int(w / self.vertical_splits)
-            left = w_per_split * split_index
-            img_LQ = F.crop(img_LQ, 0, left, h, w_per_split)
-        img_LQ = F.to_tensor(img_LQ)
-
-        mask = torch.ones(1, img_LQ.shape[1], img_LQ.shape[2])
+        mask = torch.ones(1, h, w)
         ref = torch.cat([img_LQ, mask], dim=0)
 
         if self.force_multiple > 1:
-            assert self.vertical_splits <= 1   # This is not compatible with vertical splits for now.
-            c, h, w = img_LQ.shape
-            h_, w_ = h, w
-            height_removed = h % self.force_multiple
-            width_removed = w % self.force_multiple
-            if height_removed != 0:
-                h_ = self.force_multiple * ((h // self.force_multiple) + 1)
-            if width_removed != 0:
-                w_ = self.force_multiple * ((w // self.force_multiple) + 1)
+            h_ = self.force_multiple * math.ceil(h / self.force_multiple)
+            w_ = self.force_multiple * math.ceil(w / self.force_multiple)
             lq_template = torch.zeros(c,h_,w_)
             lq_template[:,:h,:w] = img_LQ
             ref_template = torch.zeros(c,h_,w_)
@@ -89,29 +167,22 @@ class FfmpegBackedVideoDataset(data.Dataset):
             ref = ref_template
 
         return {'lq': img_LQ, 'lq_fullsize_ref': ref,
-                'lq_center': torch.tensor([img_LQ.shape[1] // 2, img_LQ.shape[2] // 2], dtype=torch.long) }
+                'lq_center': torch.tensor([img_LQ.shape[1] // 2, img_LQ.shape[2] // 2], dtype=torch.long),
+                'lq_size': torch.tensor([h, w], dtype=torch.long)}
+
+    def __iter__(self):
+        assert torch.utils.data.get_worker_info() is None, 'Frames must be streamed from the main process (n_workers=0).'
+        for frame in FfmpegFrameReader(self.video, self.frame_rate, self.start_at, self.end_at, self.prefetch):
+            for split_index in range(self.vertical_splits):
+                yield self.get_item(frame, split_index)
 
     def __len__(self):
         return self.frame_count * self.vertical_splits
 
-def merge_images(files, output_path):
-    """Merges several image files together across the vertical axis
-    """
-    images = [Image.open(f) for f in files]
-    w, h = images[0].size
-
-    result_width = w * len(images)
-    result_height = h
-
-    result = Image.new('RGB', (result_width, result_height))
-    for i in range(len(images)):
-        result.paste(im=images[i], box=(i * w, 0))
-    result.save(output_path)
 
 if __name__ == "__main__":
     #### options
     torch.backends.cudnn.benchmark = True
-    want_just_images = True
     parser = argparse.ArgumentParser()
     parser.add_argument('-opt', type=str, help='Path to options YAML file.', default='../options/use_video_upsample.yml')
     opt = option.parse(parser.parse_args().opt, is_train=False)
@@ -129,7 +200,7 @@ if __name__ == "__main__":
     #### Create test dataset and dataloader
     test_loaders = []
 
-    test_set = FfmpegBackedVideoDataset(opt['dataset'], opt['path']['results_root'])
+    test_set = FfmpegBackedVideoDataset(opt['dataset'])
     test_loader = create_dataloader(test_set, opt['dataset'])
     logger.info('Number of test images in [{:s}]: {:d}'.format(opt['dataset']['name'], len(test_set)))
     test_loaders.append(test_loader)
@@ -152,7 +223,10 @@ if __name__ == "__main__":
         assert opt['dataset']['batch_size'] == 1   # Can only do 1 frame at a time in recurrent mode, by definition.
     scale = opt['scale']
     first_frame = True
-    ffmpeg_proc = None
+    num_splits = test_set.vertical_splits
+    splits = []  # SR outputs of the splits of the frame currently being assembled.
+    writer = None
+    last_writer = None
 
     tq = tqdm(test_loader)
     for data in tq:
@@ -178,40 +252,34 @@ if __name__ == "__main__":
             recurrent_entry = visuals
         visuals = visuals.cpu().float()
         for i in range(visuals.shape[0]):
-            sr_img = util.tensor2img(visuals[i])  # uint8
-
-            # save images
-            save_img_path = osp.join(dataset_dir, '%08d.png' % (frame_counter,))
-            util.save_img(sr_img, save_img_path)
-            frame_counter += 1
-
-            if frame_counter % frames_per_vid == 0:
-                if ffmpeg_proc is not None:
-                    print("Waiting for last encode..")
-                    ffmpeg_proc.wait()
+            # Remove any force_multiple padding, then join the vertical splits of each frame back together.
+            h, w = data['lq_size'][i].tolist()
+            splits.append(util.tensor2img(visuals[i][:, :h * scale, :w * scale]))  # uint8, BGR
+            if len(splits) < num_splits:
+                continue
+            frame = np.concatenate(splits, axis=1)
+            splits = []
+
+            if writer is None:
+                out_path = osp.join(vid_output, "mini_%06d.mkv" % (vid_counter,))
                 print("Encoding minivid %d.." % (vid_counter,))
-                # Perform stitching.
-                num_splits = opt['dataset']['vertical_splits'] if 'vertical_splits' in opt['dataset'].keys() else 1
-                if num_splits > 1:
-                    procs = []
-                    src_imgs_path = osp.join(dataset_dir, "joined")
-                    os.makedirs(src_imgs_path, exist_ok=True)
-                    for i in range(int(frames_per_vid / num_splits)):
-                        to_join = [osp.join(dataset_dir, "%08d.png" % (j,)) for j in range(i * num_splits, i * num_splits + num_splits)]
-                        merge_images(to_join, osp.join(src_imgs_path, "%08d.png" % (i,)))
-                else:
-                    src_imgs_path = dataset_dir
-
-                # Encoding command line:
-                # ffmpeg -framerate 30 -i %08d.png -c:v libx265 -crf 12 -preset slow -pix_fmt yuv444p test.mkv
-                cmd = ['ffmpeg', '-y', '-framerate', str(opt['dataset']['frame_rate']), '-f', 'image2', '-i', osp.join(src_imgs_path, "%08d.png"),
-                       '-c:v', 'libx265', '-crf', str(minivid_crf), '-preset', 'slow', '-pix_fmt', 'yuv444p', osp.join(vid_output, "mini_%06d.mkv" % (vid_counter,))]
-                print(ffmpeg_proc)
-                ffmpeg_proc = subprocess.Popen(cmd)#, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+                writer = FfmpegFrameWriter(out_path, frame.shape[1], frame.shape[0], opt['dataset']['frame_rate'], minivid_crf)
+            writer.write(frame)
+            frame_counter += num_splits
+
+            if frame_counter >= frames_per_vid:
+                # Let this minivid finish encoding while the next one is processed, but wait for the one before it.
+                writer.close(wait=False)
+                if last_writer is not None:
+                    last_writer.wait()
+                last_writer = writer
+                writer = None
                 vid_counter += 1
                 frame_counter = 0
-                print("Done.")
-
 
-            if want_just_images:
-                continue
\ No newline at end of file
+    if writer is not None:
+        writer.close(wait=False)
+    for pending in [last_writer, writer]:
+        if pending is not None:
+            pending.wait()
+    logger.info('Processed {:d} frames in {:.1f}s.'.format(len(test_set) // num_splits, time.time() - test_start_time))
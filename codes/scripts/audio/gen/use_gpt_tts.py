@@ -1,6 +1,8 @@
 import argparse
+import hashlib
 import os
 import random
+from collections import OrderedDict
 
 import torch
 import torch.nn.functional as F
@@ -13,6 +15,7 @@ from data.audio.voice_tokenizer import VoiceBpeTokenizer
 from data.util import is_audio_file, find_files_of_type
 from scripts.audio.gen.speech_synthesis_utils import do_spectrogram_diffusion, \
     load_discrete_vocoder_diffuser, wav_to_mel
+from trainer.checkpoint_writer import atomic_torch_save
 from utils.options import Loader
 from utils.util import load_model_from_config
 
@@ -21,7 +24,7 @@ from utils.util import load_model_from_config
 def load_conditioning_candidates(path, num_conds, sample_rate=22050, cond_length=44100):
     candidates = find_files_of_type('img', path, qualifier=is_audio_file)[0]
     # Sample with replacement. This can get repeats, but more conveniently handles situations where there are not enough candidates.
-    related_mels = []
+    related_clips = []
     for k in range(num_conds):
         rel_clip = load_audio(candidates[k], sample_rate)
         gap = rel_clip.shape[-1] - cond_length
@@ -30,9 +33,10 @@ def load_conditioning_candidates(path, num_conds, sample_rate=22050, cond_length
         elif gap > 0:
             rand_start = random.randint(0, gap)
             rel_clip = rel_clip[:, rand_start:rand_start + cond_length]
-        mel_clip = wav_to_mel(rel_clip.unsqueeze(0)).squeeze(0)
-        related_mels.append(mel_clip)
-    return torch.stack(related_mels, dim=0).unsqueeze(0).cuda(), rel_clip.unsqueeze(0).cuda()
+        related_clips.append(rel_clip)
+    # All clips have the same length, so they are converted to MELs in one batch.
+    related_mels = wav_to_mel(torch.cat(related_clips, dim=0).cuda())
+    return related_mels.unsqueeze(0), rel_clip.unsqueeze(0).cuda()
 
 
 def load_conditioning(path, sample_rate=22050, cond_length=44100):
@@ -43,8 +47,62 @@ def load_conditioning(path, sample_rate=22050, cond_length=44100):
     elif gap > 0:
         rand_start = random.randint(0, gap)
         rel_clip = rel_clip[:, rand_start:rand_start + cond_length]
+    rel_clip = rel_clip.cuda()
     mel_clip = wav_to_mel(rel_clip.unsqueeze(0)).squeeze(0)
-    return mel_clip.unsqueeze(0).cuda(), rel_clip.unsqueeze(0).cuda()
+    return mel_clip.unsqueeze(0), rel_clip.unsqueeze(0)
+
+
+def file_fingerprint(path):
+    """ Identifies a file by its location, size and modification time, without reading it. """
+    st = os.stat(path)
+    return f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'
+
+
+class ConditioningLatentCache:
+    """
+    Cache of conditioning inputs for a UnifiedVoice model, keyed by the fingerprints of the conditioning clips and of
+    the model checkpoint. A hit skips audio decoding, MEL computation and the conditioning encoder. Entries are kept in
+    an in-memory LRU and, when cache_dir is given, on disk so that they survive across runs of this script. Note that the
+    random crop taken from each clip the first time it is seen is reused for as long as it remains cached.
+    """
+    def __init__(self, gpt, model_id='', cache_dir=None, capacity=64):
+        self.gpt = gpt
+        self.model_id = model_id
+        self.cache_dir = cache_dir
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).hexdigest() + '.pth')
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return entry
+
+    def get(self, cond_paths, cond_length=132300):
+        """ Returns (conditioning mels (1,n,80,s), last conditioning clip, conditioning latents). """
+        key = (self.model_id, tuple(file_fingerprint(p) for p in cond_paths), cond_length)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        device = next(self.gpt.parameters()).device
+        if self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+            entry = torch.load(self._disk_path(key), map_location=device)
+            return self._remember(key, tuple(entry))
+        conds = []
+        for cond_path in cond_paths:
+            c, cond_wav = load_conditioning(cond_path, cond_length=cond_length)
+            conds.append(c)
+        conds = torch.stack(conds, dim=1)
+        with torch.no_grad():
+            latents = self.gpt.get_conditioning(conds)
+        if self.cache_dir is not None:
+            atomic_torch_save([conds.cpu(), cond_wav.cpu(), latents.cpu()], self._disk_path(key))
+        return self._remember(key, (conds, cond_wav, latents))
 
 
 def fix_autoregressive_output(codes, stop_token):
@@ -109,6 +167,7 @@ if __name__ == '__main__':
     parser.add_argument('-num_batches', type=int, help='How many batches those samples should be produced over.', default=16)
     parser.add_argument('-num_outputs', type=int, help='Number of outputs to produce.', default=5)
     parser.add_argument('-output_path', type=str, help='Where to store outputs.', default='../results/use_gpt_tts')
+    parser.add_argument('-cond_cache_dir', type=str, help='Where conditioning latents are cached across runs.', default='../results/use_gpt_tts_cond_cache')
     args = parser.parse_args()
     os.makedirs(args.output_path, exist_ok=True)
     # libritts_text = 'fall passed so quickly, there was so much going on around him, the tree quite forgot to look to himself.'
@@ -126,11 +185,8 @@ if __name__ == '__main__':
     text = F.pad(text, (0,1))  # This may not be necessary.
 
     cond_paths = preselected_cond_voices[args.cond_preset]
-    conds = []
-    for cond_path in cond_paths:
-        c, cond_wav = load_conditioning(cond_path, cond_length=132300)
-        conds.append(c)
-    conds = torch.stack(conds, dim=1)  # And just use the last cond_wav for the diffusion model.
+    cond_cache = ConditioningLatentCache(gpt, model_id=file_fingerprint(args.gpt_tts_model_path), cache_dir=args.cond_cache_dir)
+    conds, cond_wav, cond_latents = cond_cache.get(cond_paths)  # And just use the last cond_wav for the diffusion model.
 
     with torch.no_grad():
         print("Performing GPT inference..")
@@ -138,7 +194,7 @@ if __name__ == '__main__':
         ctc_codes = []
         samples_per_batch = args.num_samples//args.num_batches
         for b in tqdm(range(args.num_batches)):
-            codes, attentions = gpt.inference_speech(conds, text, num_beams=1, repetition_penalty=1.0, do_sample=True, top_k=50, top_p=.95,
+            codes, attentions = gpt.inference_speech(conds, text, cond_latents=cond_latents, num_beams=1, repetition_penalty=1.0, do_sample=True, top_k=50, top_p=.95,
                                                      temperature=.9, num_return_sequences=samples_per_batch, length_penalty=1,
                                                      return_attentions=True)
             padding_needed = 250 - codes.shape[1]
@@ -0,0 +1,130 @@
+"""
+Converts paired (audio, transcription) datasets into packed shards readable by the 'packed_paired_voice_audio' dataset
+mode. Every clip is decoded, resampled and tokenized exactly once here so that training workers only have to slice
+memory-mapped arrays. With --similar_clip_index, the conditioning neighbors of every clip (see
+data/audio/similar_clip_index.py) that also made it into the shard are stored with it.
+
+Example:
+python scripts/audio/preparation/build_packed_voice_shards.py --path Y:/clips/books1/transcribed-oco.tsv \
+    --fetcher_mode tsv --output Y:/packed/books1 --load_aligned_codes --similar_clip_index Y:/clips/similarities
+"""
+import argparse
+import functools
+from multiprocessing.pool import Pool
+
+import inflect
+from tqdm import tqdm
+
+from data.audio.packed_paired_dataset import PackedShardWriter
+from data.audio.paired_voice_audio_dataset import load_tsv_type, load_tsv_aligned_codes_type, load_mozilla_cv, \
+    load_voxpopuli, CharacterTokenizer
+from data.audio.similar_clip_index import SimilarClipIndex, normalize_clip_path
+from data.audio.unsupervised_audio_dataset import load_audio
+from models.audio.tts.tacotron2 import load_filepaths_and_text_type
+
+
+def get_fetcher(fetcher_mode, load_aligned_codes):
+    if fetcher_mode == 'lj' or fetcher_mode == 'libritts':
+        return load_filepaths_and_text_type
+    elif fetcher_mode == 'tsv':
+        return load_tsv_aligned_codes_type if load_aligned_codes else load_tsv_type
+    elif fetcher_mode == 'mozilla_cv':
+        return load_mozilla_cv
+    elif fetcher_mode == 'voxpopuli':
+        return load_voxpopuli
+    raise NotImplementedError()
+
+
+# Errors that reject a single clip instead of stopping the build. The english cleaners raise inflect's errors for
+# numbers they cannot spell out. load_wav_to_torch raises TypeError for unsupported sample formats.
+TEXT_ERRORS = (inflect.NumOutOfRangeError, inflect.BadNumValueError, UnicodeError, ValueError)
+AUDIO_ERRORS = (OSError, EOFError, ValueError, RuntimeError, TypeError)
+
+_tokenizer = None
+
+
+def _get_tokenizer(vocab):
+    global _tokenizer
+    if _tokenizer is None:
+        if vocab is not None:
+            from data.audio.voice_tokenizer import VoiceBpeTokenizer
+            _tokenizer = VoiceBpeTokenizer(vocab)
+        else:
+            _tokenizer = CharacterTokenizer()
+    return _tokenizer
+
+
+def process_entry(entry, sample_rate, vocab, min_length, load_aligned_codes):
+    """ Returns (wav, tokens, path, text, type, codes) or None if the clip would be rejected by the paired datasets. """
+    path, text = entry[0], entry[1]
+    codes = entry[2] if load_aligned_codes else None
+    type = entry[-1]
+    if text is None or len(text.strip()) == 0:
+        return None
+    try:
+        tokens = _get_tokenizer(vocab).encode(text)
+    except TEXT_ERRORS:
+        return None
+    try:
+        wav = load_audio(path, sample_rate)
+    except AUDIO_ERRORS:
+        return None
+    # Mirror the rejection rules in TextWavLoader.get_text/__getitem__: UNK/start tokens, stop tokens and ultra short clips.
+    if (vocab is not None and 1 in tokens) or 0 in tokens or wav.shape[-1] < min_length:
+        return None
+    return wav.squeeze(0).numpy(), tokens, path, text, type, None if codes is None else codes.tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', nargs='+', required=True, help='Dataset index files (TSV, LJ-style lists, etc).')
+    parser.add_argument('--fetcher_mode', nargs='+', default=['tsv'], help='One fetcher mode per path, as in paired_voice_audio.')
+    parser.add_argument('--types', nargs='+', type=int, default=None, help='One type per path.')
+    parser.add_argument('--output', required=True, help='Shard prefix. Several files with this prefix are written.')
+    parser.add_argument('--sample_rate', type=int, default=22050)
+    parser.add_argument('--tokenizer_vocab', default='../experiments/bpe_lowercase_asr_256.json',
+                        help='BPE vocab to pre-tokenize with. Pass "none" to use the character tokenizer.')
+    parser.add_argument('--load_aligned_codes', action='store_true', help='Store the aligned codes column of ocotillo TSVs.')
+    parser.add_argument('--max_wav_length', type=int, default=None, help='Drop clips longer than this many samples.')
+    parser.add_argument('--similar_clip_index', default=None, help='SimilarClipIndex prefix to take conditioning neighbors from.')
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+
+    fetcher_modes = args.fetcher_mode if len(args.fetcher_mode) == len(args.path) else args.fetcher_mode * len(args.path)
+    types = args.types if args.types is not None else [0 for _ in args.path]
+    assert len(fetcher_modes) == len(args.path) and len(types) == len(args.path)
+    vocab = None if args.tokenizer_vocab.lower() == 'none' else args.tokenizer_vocab
+
+    entries = []
+    for p, fm, type in zip(args.path, fetcher_modes, types):
+        entries.extend(get_fetcher(fm, args.load_aligned_codes)(p, type))
+    print(f'Packing {len(entries)} clips into {args.output}..')
+
+    writer = PackedShardWriter(args.output, args.sample_rate, vocab)
+    fn = functools.partial(process_entry, sample_rate=args.sample_rate, vocab=vocab, min_length=int(.6 * args.sample_rate),
+                           load_aligned_codes=args.load_aligned_codes)
+    rejected = 0
+    rows = {}
+    with Pool(args.num_workers) as pool:
+        # imap preserves order, which keeps shards reproducible across runs.
+        for result in tqdm(pool.imap(fn, entries, chunksize=16), total=len(entries)):
+            if result is None or (args.max_wav_length is not None and result[0].shape[-1] > args.max_wav_length):
+                rejected += 1
+                continue
+            wav, tokens, path, text, type, codes = result
+            rows[normalize_clip_path(path)] = len(writer)
+            writer.add(wav, tokens, path, text, type=type, codes=codes)
+    neighbors = None
+    if args.similar_clip_index is not None:
+        # Neighbors that were rejected or live outside of this shard cannot be loaded alongside it, so they are dropped.
+        index = SimilarClipIndex(args.similar_clip_index)
+        neighbors = [[] for _ in range(len(writer))]
+        for path, row in rows.items():
+            neighbors[row] = [rows[n] for n in index.similar_paths(path) if n in rows and rows[n] != row]
+        print(f'{sum(1 for n in neighbors if len(n) > 0)} of {len(writer)} clips have conditioning neighbors.')
+    writer.close(neighbors)
+    print(f'Wrote {len(writer)} clips; rejected {rejected}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Normalizes and tokenizes the transcriptions of paired voice datasets and/or the text of HuggingFace corpora into a text
+token cache. Point the 'text_token_cache' option of paired_voice_audio, fast_paired_voice_audio or the
+paired_dataset_args of grand_conjoined_voice at the output prefix and those datasets will slice tokens out of the cache
+rather than running the text cleaners and BPE tokenizer on every item, every epoch. The cache records the vocab it was
+built with and is ignored if that vocab changes.
+
+Example:
+python scripts/audio/preparation/build_text_token_cache.py --path Y:/clips/books1/transcribed-oco.tsv \
+    --fetcher_mode tsv --hf_corpus bookcorpus None --output Y:/text_cache/books
+"""
+import argparse
+import functools
+import itertools
+from multiprocessing.pool import Pool
+
+from tqdm import tqdm
+
+from data.audio.text_token_cache import TextTokenCacheWriter
+from scripts.audio.preparation.build_packed_voice_shards import TEXT_ERRORS, get_fetcher, _get_tokenizer
+
+
+def tokenize_batch(texts, vocab):
+    """ Returns (texts, tokens), where tokens is None for every text the tokenizer cannot handle. """
+    tokenizer = _get_tokenizer(vocab)
+    if hasattr(tokenizer, 'encode_batch'):
+        try:
+            return texts, tokenizer.encode_batch(texts)
+        except TEXT_ERRORS:
+            pass  # Fall through to find the offending texts one at a time.
+    results = []
+    for text in texts:
+        try:
+            results.append(tokenizer.encode(text))
+        except TEXT_ERRORS:
+            results.append(None)
+    return texts, results
+
+
+def batched_texts(args, batch_size):
+    batch = []
+
+    def add(text):
+        batch.append(text)
+        if len(batch) == batch_size:
+            yield list(batch)
+            batch.clear()
+
+    if args.path is not None:
+        fetcher_modes = args.fetcher_mode if len(args.fetcher_mode) == len(args.path) else args.fetcher_mode * len(args.path)
+        for p, fm in zip(args.path, fetcher_modes):
+            for entry in get_fetcher(fm, False)(p, 0):
+                yield from add(entry[1])
+    if args.hf_corpus is not None:
+        from data.text.hf_datasets_wrapper import HfDataset
+        corpi = [args.hf_corpus[i:i+2] for i in range(0, len(args.hf_corpus), 2)]
+        corpus = HfDataset(corpi, cache_path=args.hf_cache_path, dataset_spec_key=args.hf_split)
+        for i in range(len(corpus)):
+            text = corpus[i][args.hf_text_key]
+            if isinstance(text, str):
+                yield from add(text)
+    if batch:
+        yield list(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', nargs='+', default=None, help='Paired dataset index files (TSV, LJ-style lists, etc).')
+    parser.add_argument('--fetcher_mode', nargs='+', default=['tsv'], help='One fetcher mode per path, as in paired_voice_audio.')
+    parser.add_argument('--hf_corpus', nargs='+', default=None, help='HuggingFace corpora as "name config" pairs, as in HfDataset.')
+    parser.add_argument('--hf_cache_path', default=None)
+    parser.add_argument('--hf_split', default='train')
+    parser.add_argument('--hf_text_key', default='text')
+    parser.add_argument('--output', required=True, help='Cache prefix. Several files with this prefix are written.')
+    parser.add_argument('--tokenizer_vocab', default='../experiments/bpe_lowercase_asr_256.json',
+                        help='BPE vocab to tokenize with. Pass "none" to use the character tokenizer.')
+    parser.add_argument('--batch_size', type=int, default=1024, help='Texts handed to encode_batch at once.')
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+    assert args.path is not None or args.hf_corpus is not None
+    vocab = None if args.tokenizer_vocab.lower() == 'none' else args.tokenizer_vocab
+
+    writer = TextTokenCacheWriter(args.output, vocab)
+    fn = functools.partial(tokenize_batch, vocab=vocab)
+    rejected = 0
+    batches = batched_texts(args, args.batch_size)
+    with Pool(args.num_workers) as pool, tqdm() as bar:
+        # Pool.imap would read the entire corpus ahead of the workers, so feed it a bounded window at a time.
+        while True:
+            window = list(itertools.islice(batches, args.num_workers * 4))
+            if not window:
+                break
+            # imap preserves order, which keeps caches reproducible across runs.
+            for texts, tokens in pool.imap(fn, window):
+                for text, toks in zip(texts, tokens):
+                    if toks is None:
+                        rejected += 1
+                        continue
+                    writer.add(text, toks)
+                bar.update(len(texts))
+    num_texts = writer.close()
+    print(f'Cached {num_texts} unique texts; rejected {rejected}.')
+
+
+if __name__ == '__main__':
+    main()
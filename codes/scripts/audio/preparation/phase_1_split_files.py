@@ -8,14 +8,12 @@ Master script that processes all MP3 files found in an input directory. Performs
 import argparse
 import functools
 import os
-from multiprocessing.pool import ThreadPool
+from multiprocessing import Pool
 
-from pydub import AudioSegment
-from pydub.exceptions import CouldntDecodeError
-from pydub.silence import split_on_silence
 from tqdm import tqdm
 
 from data.util import find_audio_files
+from scripts.audio.preparation.silence_splitter import CouldntDecodeError, split_file_on_silence, write_mp3
 
 
 def report_progress(progress_file, file):
@@ -23,26 +21,30 @@ def report_progress(progress_file, file):
         f.write(f'{file}\n')
 
 
-def process_file(file, base_path, output_path, progress_file):
+def process_file(file, base_path, output_path):
+    """
+    Returns (file, status), where status is 'done', 'undecodable' for files that can never be split or 'failed' for
+    errors that a later run may not hit again.
+    """
     # Hyper-parameters; feel free to adjust.
     minimum_duration = 4
     maximum_duration = 20
 
-    # Part 1 is to split a large file into chunks.
-    try:
-        speech = AudioSegment.from_file(file)
-    except CouldntDecodeError as e:
-        print(e)
-        report_progress(progress_file, file)
-        return
+    # Part 1 is to split a large file into chunks. The file is decoded and split in blocks, so memory use does not grow
+    # with its length.
     outdir = os.path.join(output_path, f'{os.path.relpath(file, base_path)[:-4]}').replace('.', '').strip()
     os.makedirs(outdir, exist_ok=True)
-    chunks = split_on_silence(speech, min_silence_len=600, silence_thresh=-40, seek_step=100, keep_silence=50)
-    for i in range(0, len(chunks)):
-        if chunks[i].duration_seconds < minimum_duration or chunks[i].duration_seconds > maximum_duration:
-            continue
-        chunks[i].export(f"{outdir}/{i:05d}.mp3", format='mp3', parameters=["-ac", "1"])
-    report_progress(progress_file, file)
+    try:
+        split_file_on_silence(file, lambda i, audio, sample_rate: write_mp3(f"{outdir}/{i:05d}.mp3", audio, sample_rate),
+                              min_silence_len=600, silence_thresh=-40, seek_step=100, keep_silence=50,
+                              min_duration=minimum_duration, max_duration=maximum_duration)
+    except CouldntDecodeError as e:
+        print(f'Could not decode {file}, skipping it: {e}')
+        return file, 'undecodable'
+    except Exception as e:
+        print(f'Error processing {file}: {e}')
+        return file, 'failed'
+    return file, 'done'
 
 
 if __name__ == '__main__':
@@ -50,7 +52,7 @@ if __name__ == '__main__':
     parser.add_argument('--path', type=str, help='Path to search for files', default='Y:\\clips\\red_rising')
     parser.add_argument('--progress_file', type=str, help='Place to store all files that have already been processed', default='Y:\\clips\\red_rising\\already_processed.txt')
     parser.add_argument('--output_path', type=str, help='Path for output files', default='Y:\\clips\\red_rising_split')
-    parser.add_argument('--num_threads', type=int, help='Number of concurrent workers processing files.', default=4)
+    parser.add_argument('--num_threads', type=int, help='Number of worker processes processing files.', default=4)
     args = parser.parse_args()
 
     processed_files = set()
@@ -64,5 +66,9 @@ if __name__ == '__main__':
     files = files - processed_files
     print(f"Found {len(files)} files to process. Total processing is {100*(orig_len-len(files))/orig_len}% complete.")
 
-    with ThreadPool(args.num_threads) as pool:
-        list(tqdm(pool.imap(functools.partial(process_file, output_path=args.output_path, base_path=args.path, progress_file=args.progress_file), files), total=len(files)))
+    with Pool(args.num_threads) as pool:
+        for file, status in tqdm(pool.imap_unordered(functools.partial(process_file, output_path=args.output_path, base_path=args.path), files), total=len(files)):
+            # Undecodable files are recorded as processed so that reruns do not retry them forever. Other failures
+            # are left out of the progress file so that the next run retries them.
+            if status != 'failed':
+                report_progress(args.progress_file, file)
@@ -1,104 +1,168 @@
 import argparse
-import functools
 import os
 import shutil
 import sys
-from multiprocessing.pool import ThreadPool
 from random import shuffle
+from time import time
 
 import torch
-import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+from scripts.audio.gen.speech_synthesis_utils import get_mel_frontend
 from trainer.injectors.audio_injectors import MelSpectrogramInjector
-from utils.util import find_audio_files, load_audio, load_model_from_config, ceil_multiple
-
-
-class AudioFolderDataset(torch.utils.data.Dataset):
-    def __init__(self, path, sampling_rate, pad_to, skip=0):
-        self.audiopaths = find_audio_files(path)[skip:]
+from utils.util import find_audio_files, load_audio, load_model_from_config
+
+
+class FolderFileStream(torch.utils.data.IterableDataset):
+    """
+    Streams every audio file in a list of folders. Each folder is handled entirely by one loader worker, which yields
+    its files in a random order followed by an end-of-folder marker (path=None) carrying the number of files yielded.
+    Clips are not padded; they are truncated to max_length.
+
+    Once a folder has produced enough clips, the main process calls cap(folder) and the worker reading it stops yielding
+    its files. The flags live in shared memory so that they reach the loader worker processes.
+    """
+    def __init__(self, folders, sampling_rate, max_length):
+        self.folders = folders
+        self.folder_ids = {folder: i for i, folder in enumerate(folders)}
+        self.capped = torch.zeros(len(folders), dtype=torch.bool).share_memory_()
         self.sampling_rate = sampling_rate
-        self.pad_to = pad_to
+        self.max_length = max_length
+
+    def cap(self, folder):
+        self.capped[self.folder_ids[folder]] = True
 
-    def __getitem__(self, index):
+    def load(self, path):
         try:
-            path = self.audiopaths[index]
-            audio_norm = load_audio(path, self.sampling_rate)
+            audio = load_audio(path, self.sampling_rate)
         except:
             print(f"Error loading audio for file {path} {sys.exc_info()}")
-            # Recover gracefully. It really sucks when we outright fail.
-            return self[index+1]
-
-        orig_length = audio_norm.shape[-1]
-        if audio_norm.shape[-1] > self.pad_to:
-            print(f"Warning - {path} has a longer audio clip than is allowed: {audio_norm.shape[-1]}; allowed: {self.pad_to}. "
+            return None
+        if audio.shape[-1] > self.max_length:
+            print(f"Warning - {path} has a longer audio clip than is allowed: {audio.shape[-1]}; allowed: {self.max_length}. "
                   f"Truncating the clip, though this will likely invalidate the prediction.")
-            audio_norm = audio_norm[:self.pad_to]
+            audio = audio[:self.max_length]
+        return audio
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        folders = self.folders if worker is None else self.folders[worker.id::worker.num_workers]
+        for folder in folders:
+            paths = find_audio_files(folder)
+            shuffle(paths)
+            count = 0
+            for path in paths:
+                if self.capped[self.folder_ids[folder]]:
+                    break
+                yield {'folder': folder, 'path': path, 'clip': self.load(path)}
+                count += 1
+            yield {'folder': folder, 'path': None, 'count': count}
+
+
+def get_spec_mags(clips):
+    stft = torch.stft(clips, n_fft=22000, hop_length=1024, return_complex=True)
+    stft = stft[:, -2000:, :]
+    return (stft.real ** 2 + stft.imag ** 2).sqrt()
+
+
+def dynamic_batches(items, batch_samples, max_batch_size):
+    """ Splits length-sorted items into batches whose padded size (clips * longest clip) stays within batch_samples. """
+    batch = []
+    for item in items:
+        if batch and (len(batch) >= max_batch_size or (len(batch) + 1) * item['clip'].shape[-1] > batch_samples):
+            yield batch
+            batch = []
+        batch.append(item)
+    if batch:
+        yield batch
+
+
+class SampleAndFilter:
+    """
+    Copies the clips in each folder which have high-frequency content and which the classifier labels as clean (0) to
+    output_path, up to max_files per folder. A folder is appended to progress_file once all of its files have been
+    classified. cap_folder(folder) is called when a folder reaches max_files, so that its remaining files need not be
+    loaded.
+    """
+    def __init__(self, classifier, output_path, base_path, progress_file, max_files, batch_samples, max_batch_size,
+                 cap_folder=None):
+        self.classifier = classifier
+        self.batch_samples = batch_samples
+        self.max_batch_size = max_batch_size
+        self.output_path = output_path
+        self.base_path = base_path
+        self.progress_file = progress_file
+        self.max_files = max_files
+        self.cap_folder = cap_folder
+        self.spec_injector = get_mel_frontend(MelSpectrogramInjector, {'in': 'clip', 'out': 'mel'}, 'cuda')
+        self.pending = {}  # folder -> files received but not yet classified.
+        self.finished = set()  # folders whose end-of-folder marker has been received.
+        self.copied = {}
+        self.processed_files = 0
+
+    def receive(self, item):
+        folder = item['folder']
+        if item['path'] is None:
+            if item['count'] > 0:  # Empty folders are not recorded as processed.
+                self.finished.add(folder)
+                self.maybe_complete(folder)
         else:
-            padding = self.pad_to - audio_norm.shape[-1]
-            if padding > 0:
-                audio_norm = torch.nn.functional.pad(audio_norm, (0, padding))
-
-        return {
-            'clip': audio_norm,
-            'samples': orig_length,
-            'path': path
-        }
-
-    def __len__(self):
-        return len(self.audiopaths)
-
-
-def process_folder(folder, output_path, base_path, progress_file, max_files):
-    classifier = load_model_from_config(args.classifier_model_opt, model_name='classifier', also_load_savepoint=True).cuda().eval()
-    dataset = AudioFolderDataset(folder, sampling_rate=22050, pad_to=600000)
-    if len(dataset) == 0:
-        return
-    dataloader = DataLoader(dataset, batch_size=32, shuffle=True, num_workers=2, pin_memory=True)
-    spec_injector = MelSpectrogramInjector({'in': 'clip', 'out': 'mel'}, {})
-
-    with torch.no_grad():
-        total_count = 0
-        for batch in tqdm(dataloader):
+            self.pending[folder] = self.pending.get(folder, 0) + 1
+
+    def maybe_complete(self, folder):
+        if folder in self.finished and self.pending.get(folder, 0) == 0:
+            with open(self.progress_file, 'a', encoding='utf-8') as pf:
+                pf.write(folder + "\n")
+            self.finished.discard(folder)
+            self.pending.pop(folder, None)
+            self.copied.pop(folder, None)
+
+    def is_capped(self, folder):
+        return self.copied.get(folder, 0) >= self.max_files
+
+    def classify(self, batch):
+        lengths = torch.tensor([item['clip'].shape[-1] for item in batch])
+        max_len = int(lengths.max())
+        clips = torch.stack([F.pad(item['clip'], (0, max_len - item['clip'].shape[-1])) for item in batch]).cuda()
+        # Average the high frequency magnitudes of each clip over its own frames only, not the padding.
+        mags = get_spec_mags(clips).mean(dim=1)
+        frames = (lengths.cuda() // 1024 + 1).unsqueeze(1)
+        frame_mask = torch.arange(mags.shape[-1], device=mags.device).unsqueeze(0) < frames
+        has_hifreq_data = (mags * frame_mask).sum(dim=-1) / frames.squeeze(1) >= .01
+        if not torch.any(has_hifreq_data):
+            return torch.zeros_like(has_hifreq_data)
+        mels = self.spec_injector({'clip': clips})['mel']
+        labels = torch.argmax(self.classifier(mels), dim=-1)
+        return has_hifreq_data & (labels == 0)
+
+    def process(self, items):
+        """ Classifies a window of items in length-sorted dynamic batches and copies the keepers. """
+        items = sorted(items, key=lambda item: item['clip'].shape[-1] if item['clip'] is not None else 0)
+        # Folders which already reached max_files need no further classification.
+        loadable = [item for item in items if item['clip'] is not None and not self.is_capped(item['folder'])]
+        for batch in dynamic_batches(loadable, self.batch_samples, self.max_batch_size):
             try:
-                max_len = max(batch['samples'])
-                clips = batch['clip'][:, :max_len].cuda()
-                paths = batch['path']
-                mels = spec_injector({'clip': clips})['mel']
-
-                def get_spec_mags(clip):
-                    stft = torch.stft(clip, n_fft=22000, hop_length=1024, return_complex=True)
-                    stft = stft[0, -2000:, :]
-                    return (stft.real ** 2 + stft.imag ** 2).sqrt()
-                no_hifreq_data = get_spec_mags(clips).mean(dim=1) < .01
-                if torch.all(no_hifreq_data):
-                    continue
-
-                labels = torch.argmax(classifier(mels), dim=-1)
-
-                for b in range(clips.shape[0]):
-                    if no_hifreq_data[b]:
-                        continue
-                    if labels[b] != 0:
+                keep = self.classify(batch).cpu()
+                for item, k in zip(batch, keep):
+                    if not k or self.is_capped(item['folder']):
                         continue
-                    dirpath = paths[b].replace(os.path.basename(paths[b]), "")
-                    path = os.path.relpath(dirpath, base_path)
-                    opath = os.path.join(output_path, path)
+                    dirpath = item['path'].replace(os.path.basename(item['path']), "")
+                    path = os.path.relpath(dirpath, self.base_path)
+                    opath = os.path.join(self.output_path, path)
                     os.makedirs(opath, exist_ok=True)
-                    shutil.copy(paths[b], opath)
-                    total_count += 1
-                    if total_count >= max_files:
-                        break
-                if total_count >= max_files:
-                    break
+                    shutil.copy(item['path'], opath)
+                    self.copied[item['folder']] = self.copied.get(item['folder'], 0) + 1
+                    if self.is_capped(item['folder']) and self.cap_folder is not None:
+                        self.cap_folder(item['folder'])
             except:
                 print("Exception encountered. Will ignore and continue. Exception info follows.")
                 print(sys.exc_info())
-
-    with open(progress_file, 'a', encoding='utf-8') as pf:
-        pf.write(folder + "\n")
+        for item in items:
+            self.pending[item['folder']] -= 1
+            self.maybe_complete(item['folder'])
+        self.processed_files += len(items)
 
 
 if __name__ == '__main__':
@@ -107,10 +171,13 @@ if __name__ == '__main__':
                         default='Y:\\clips\\red_rising_split')
     parser.add_argument('--progress_file', type=str, help='Place to store all folders that have already been processed', default='Y:\\clips\\red_rising_filtered\\already_processed.txt')
     parser.add_argument('--output_path', type=str, help='Path where sampled&filtered files are sent', default='Y:\\clips\\red_rising_filtered')
-    parser.add_argument('--num_threads', type=int, help='Number of concurrent workers processing files.', default=6)
+    parser.add_argument('--num_threads', type=int, help='Number of worker processes loading audio files.', default=6)
     parser.add_argument('--max_samples_per_folder', type=int, help='Maximum number of clips that can be extracted from each folder.', default=999999)
     parser.add_argument('--classifier_model_opt', type=str, help='Train/test options file that configures the model used to classify the audio clips.',
                         default='../options/test_noisy_audio_clips_classifier.yml')
+    parser.add_argument('--window', type=int, help='Number of files which are length-sorted together before batching.', default=2048)
+    parser.add_argument('--batch_samples', type=int, help='Maximum number of (padded) audio samples in a batch.', default=32*600000)
+    parser.add_argument('--max_batch_size', type=int, help='Maximum number of clips in a batch.', default=256)
     args = parser.parse_args()
 
     # Build a list of split audio files to process
@@ -130,6 +197,25 @@ if __name__ == '__main__':
         all_split_files = all_split_files - processed
         print(f'All folders: {orig_len}, processed files: {len(processed)}; {len(all_split_files)/orig_len}% of files remain to be processed.')
 
-    with ThreadPool(args.num_threads) as pool:
-        list(tqdm(pool.imap(functools.partial(process_folder, output_path=args.output_path, base_path=args.path,
-                                              progress_file=args.progress_file, max_files=args.max_samples_per_folder), all_split_files), total=len(all_split_files)))
+    classifier = load_model_from_config(args.classifier_model_opt, model_name='classifier', also_load_savepoint=True).cuda().eval()
+    stream = FolderFileStream(list(all_split_files), sampling_rate=22050, max_length=600000)
+    sample_filter = SampleAndFilter(classifier, args.output_path, args.path, args.progress_file, args.max_samples_per_folder,
+                                    args.batch_samples, args.max_batch_size, cap_folder=stream.cap)
+    loader = DataLoader(stream, batch_size=None, num_workers=args.num_threads)
+    start = time()
+    window = []
+    with torch.no_grad():
+        progress = tqdm(unit='file')
+        for item in loader:
+            sample_filter.receive(item)
+            if item['path'] is not None:
+                window.append(item)
+            if len(window) >= args.window:
+                sample_filter.process(window)
+                progress.update(len(window))
+                window = []
+        sample_filter.process(window)
+        progress.update(len(window))
+        progress.close()
+    elapsed = time() - start
+    print(f'Processed {sample_filter.processed_files} files in {elapsed:.1f}s ({sample_filter.processed_files / max(elapsed, 1e-6):.1f} files/sec).')
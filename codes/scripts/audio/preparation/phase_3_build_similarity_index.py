@@ -0,0 +1,215 @@
+"""
+Global replacement for phase_3_generate_similarities.py. Rather than writing a similarities.pth file into every
+directory, this script:
+1. Embeds every clip under --path exactly once, in large batches, with the voice-to-voice CLIP model. Embeddings are
+   appended to a memory-mapped matrix at {output}.embeddings.bin, so re-running after new folders are added only embeds
+   the new clips.
+2. Finds the nearest neighbors of every clip with a blocked matrix multiply / top-k, either within its directory (the
+   behavior of phase_3_generate_similarities.py) or across every clip.
+3. Writes the neighbors as a SimilarClipIndex (see data/audio/similar_clip_index.py) at {output}, which the audio
+   datasets load through their `similar_clip_index` option.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import yaml
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from data.audio.similar_clip_index import normalize_clip_path, write_similar_clip_index
+from data.audio.unsupervised_audio_dataset import load_audio
+from scripts.audio.gen.speech_synthesis_utils import wav_to_mel
+from scripts.audio.preparation.phase_3_generate_similarities import recursively_find_audio_directories
+from utils.options import Loader
+from utils.util import load_model_from_config
+
+
+class ClipEmbeddingStore:
+    """
+    Append-only, memory-mapped (N, dim) float16 matrix of clip embeddings along with the path of each row. The row
+    count in {prefix}.embeddings.json is only advanced after rows and paths are written, so an interrupted append is
+    discarded on the next open.
+    """
+    def __init__(self, prefix, dim):
+        self.prefix = prefix
+        self.meta_file = f'{prefix}.embeddings.json'
+        self.data_file = f'{prefix}.embeddings.bin'
+        self.paths_file = f'{prefix}.embeddings.paths.txt'
+        self.dim = dim
+        self.count = 0
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            assert meta['dim'] == dim, f'{prefix} holds {meta["dim"]}-dimensional embeddings, not {dim}.'
+            self.count = meta['count']
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        # Drop anything written after the last committed row.
+        with open(self.data_file, 'ab') as f:
+            f.truncate(self.count * dim * 2)
+        self.paths = []
+        if self.count > 0:
+            with open(self.paths_file, 'r', encoding='utf-8') as f:
+                self.paths = [l.rstrip('\n') for l in f][:self.count]
+        with open(self.paths_file, 'w', encoding='utf-8') as f:
+            f.writelines(p + '\n' for p in self.paths)
+
+    def append(self, paths, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float16)
+        assert embeddings.shape == (len(paths), self.dim)
+        with open(self.data_file, 'ab') as f:
+            f.write(embeddings.tobytes())
+        with open(self.paths_file, 'a', encoding='utf-8') as f:
+            f.writelines(p + '\n' for p in paths)
+        self.paths.extend(paths)
+        self.count += len(paths)
+        tmp = f'{self.meta_file}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'dim': self.dim, 'count': self.count}, f)
+        os.replace(tmp, self.meta_file)
+
+    def matrix(self):
+        if self.count == 0:
+            return np.zeros((0, self.dim), dtype=np.float16)
+        return np.memmap(self.data_file, dtype=np.float16, mode='r', shape=(self.count, self.dim))
+
+
+class ClipDataset(torch.utils.data.Dataset):
+    def __init__(self, paths, clip_size):
+        self.paths = paths
+        self.clip_size = clip_size
+
+    def __getitem__(self, index):
+        path = self.paths[index]
+        try:
+            clip = load_audio(path, 22050)
+        except:
+            print(f"Error processing {path}. Recovering gracefully.")
+            print(sys.exc_info())
+            return {'clip': torch.zeros(1, self.clip_size), 'path': path, 'ok': False}
+        padding = self.clip_size - clip.shape[1]
+        if padding > 0:
+            clip = F.pad(clip, (0, padding))
+        elif padding < 0:
+            clip = clip[:, :self.clip_size]
+        return {'clip': clip, 'path': path, 'ok': True}
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def embed_new_clips(store, model, paths, clip_size, batch_size, num_workers):
+    """ Embeds the clips in paths which are not already in store. Clips which fail to load are skipped. """
+    known = set(store.paths)
+    new = [p for p in paths if p not in known]
+    print(f'{len(paths) - len(new)} clips are already embedded; embedding {len(new)}.')
+    if not new:
+        return
+    loader = DataLoader(ClipDataset(new, clip_size), batch_size=batch_size, num_workers=num_workers, pin_memory=True)
+    with torch.no_grad():
+        for batch in tqdm(loader):
+            mels = wav_to_mel(batch['clip'].cuda(non_blocking=True))
+            emb = model.embed(mels).float().cpu().numpy()
+            ok = batch['ok'].numpy()
+            store.append([p for p, o in zip(batch['path'], ok) if o], emb[ok])
+
+
+def blocked_topk(embeddings, k, rows=None, groups=None, block_size=4096, device='cuda', max_resident_bytes=2**32):
+    """
+    Finds the k most similar clips (by dot product) of every clip, excluding the clip itself, by multiplying blocks of
+    block_size query rows against blocks of keys and merging the top-k of each block. Keys stay resident on the device
+    when they fit in max_resident_bytes, and are otherwise re-read from embeddings (which may be a memmap) per block.
+
+    :param embeddings: (N, dim) matrix.
+    :param rows: optional rows of embeddings to search among; defaults to all of them. Results index into rows.
+    :param groups: optional group of each clip. Neighbors are restricted to clips with the same group.
+    :return: (len(rows), k) int64 array of neighbors, padded with -1 where there are fewer than k candidates.
+    """
+    rows = np.arange(embeddings.shape[0]) if rows is None else np.asarray(rows)
+    n = len(rows)
+    result = np.full((n, k), -1, dtype=np.int64)
+    if n == 0:
+        return result
+    if groups is None:
+        order = np.arange(n)
+        group_of = np.zeros((n,), dtype=np.int64)
+        bounds = np.array([0, n])
+    else:
+        # Make groups contiguous so that each query block only needs the keys of the groups it spans.
+        order = np.argsort(groups, kind='stable')
+        sorted_groups = np.asarray(groups)[order]
+        bounds = np.concatenate([[0], np.flatnonzero(sorted_groups[1:] != sorted_groups[:-1]) + 1, [n]])
+        group_of = np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+    device_groups = torch.from_numpy(group_of).to(device)
+    dtype = torch.float16 if torch.device(device).type == 'cuda' else torch.float32
+
+    def load(a, b):
+        return torch.from_numpy(np.asarray(embeddings[rows[order[a:b]]], dtype=np.float32)).to(device, dtype)
+
+    resident = load(0, n) if n * embeddings.shape[1] * 2 <= max_resident_bytes else None
+    keys = (lambda a, b: resident[a:b]) if resident is not None else load
+
+    for qa in tqdm(range(0, n, block_size)):
+        qb = min(qa + block_size, n)
+        queries = keys(qa, qb)
+        query_ids = torch.arange(qa, qb, device=device)
+        best_vals = torch.full((qb - qa, k), -float('inf'), device=device)
+        best_ids = torch.full((qb - qa, k), -1, dtype=torch.long, device=device)
+        for ka in range(bounds[group_of[qa]], bounds[group_of[qb - 1] + 1], block_size):
+            kb = min(ka + block_size, bounds[group_of[qb - 1] + 1])
+            sims = (queries @ keys(ka, kb).T).float()
+            key_ids = torch.arange(ka, kb, device=device)
+            invalid = (query_ids[:, None] == key_ids[None, :]) | \
+                      (device_groups[qa:qb, None] != device_groups[None, ka:kb])
+            vals = torch.cat([best_vals, sims.masked_fill(invalid, -float('inf'))], dim=1)
+            ids = torch.cat([best_ids, key_ids[None, :].expand(qb - qa, -1)], dim=1)
+            best_vals, top = torch.topk(vals, k, dim=1)
+            best_ids = torch.gather(ids, 1, top)
+        best_ids = best_ids.masked_fill(best_vals == -float('inf'), -1).cpu().numpy()
+        result[order[qa:qb]] = np.where(best_ids >= 0, order[np.maximum(best_ids, 0)], -1)
+    return result
+
+
+def build_similarity_index(store, paths, output, neighbors_per_clip, scope, block_size):
+    """ Writes a SimilarClipIndex at output with the nearest neighbors of every embedded clip in paths. """
+    row_of = {p: i for i, p in enumerate(store.paths)}
+    rows = np.array([row_of[p] for p in paths if p in row_of], dtype=np.int64)
+    kept = [store.paths[r] for r in rows]
+    groups = None
+    if scope == 'directory':
+        _, groups = np.unique([os.path.dirname(p) for p in kept], return_inverse=True)
+    top = blocked_topk(store.matrix(), neighbors_per_clip, rows, groups, block_size)
+    # As in phase_3_generate_similarities.py, a clip without any neighbors is its own conditioning candidate.
+    neighbors = [[int(n) for n in row if n >= 0] or [i] for i, row in enumerate(top)]
+    write_similar_clip_index(output, kept, neighbors)
+    print(f'Indexed {len(kept)} clips into {output}.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', type=str, help='Path to the options YAML file used to train the CLIP model', default='../options/train_voice_voice_clip.yml')
+    parser.add_argument('--path', type=str, help='Root path to search for audio directories from', default='Y:\\clips\\for_finetuning\\mlp\\good')
+    parser.add_argument('--output', type=str, help='Prefix of the embedding store and index files', required=True)
+    parser.add_argument('--clip_size', type=int, help='Amount of audio samples to pull from each file', default=22050)
+    parser.add_argument('--batch_size', type=int, help='Clips embedded per batch', default=1024)
+    parser.add_argument('--num_workers', type=int, help='Number of processes loading audio', default=4)
+    parser.add_argument('--neighbors', type=int, help='Similar clips to record per clip', default=3)
+    parser.add_argument('--scope', choices=['directory', 'global'], default='directory',
+                        help='Whether similar clips are drawn from the same directory or from every clip')
+    parser.add_argument('--block_size', type=int, help='Rows per block of the similarity search', default=8192)
+    args = parser.parse_args()
+
+    with open(args.o, mode='r') as f:
+        opt = yaml.load(f, Loader=Loader)
+
+    print("Finding applicable files..")
+    paths = [normalize_clip_path(p) for _, files in recursively_find_audio_directories(args.path) for p in files]
+    print(f"Found {len(paths)} clips.")
+    model = load_model_from_config(preloaded_options=opt, model_name='clip', also_load_savepoint=True).cuda().eval()
+    store = ClipEmbeddingStore(args.output, model.to_latent.weight.shape[0])
+    embed_new_clips(store, model, paths, args.clip_size, args.batch_size, args.num_workers)
+    build_similarity_index(store, paths, args.output, args.neighbors, args.scope, args.block_size)
@@ -0,0 +1,278 @@
+"""
+Streaming replacement for pydub's split_on_silence().
+
+pydub decodes an entire file into memory and measures the RMS of every min_silence_len window with a Python loop.
+StreamingSilenceSplitter consumes decoded audio in blocks instead: it reduces each block to per-millisecond sums of
+squares with NumPy, measures window RMS from running sums and only holds on to the audio which may still end up in a
+chunk. The splitting rules (window placement, silent range merging, keep_silence padding) follow pydub's
+detect_silence(), detect_nonsilent() and split_on_silence().
+"""
+import json
+import math
+import subprocess
+import time
+
+import numpy as np
+import soundfile as sf
+
+
+class CouldntDecodeError(Exception):
+    """ Raised when neither libsndfile nor ffmpeg can decode a file. Retrying will not help. """
+
+
+def _frame(ms, sample_rate):
+    # Millisecond -> frame index, rounded like pydub's AudioSegment slicing.
+    return (np.asarray(ms, dtype=np.float64) * (sample_rate / 1000.0)).astype(np.int64)
+
+
+class StreamingSilenceSplitter:
+    """
+    Splits a stream of audio blocks on silence. Feed blocks of shape (frames, channels) to push() and call finish()
+    after the last one; both return the completed chunks as (index, audio) pairs, where index counts every chunk
+    produced, including those dropped for being shorter than min_duration or longer than max_duration (in seconds).
+    """
+    def __init__(self, sample_rate, min_silence_len=600, silence_thresh=-40, seek_step=100, keep_silence=50,
+                 min_duration=0, max_duration=math.inf):
+        assert sample_rate >= 1000
+        # A silent range spans at least min_silence_len, so padded chunks can only overlap when this does not hold.
+        assert 2 * keep_silence <= min_silence_len
+        self.sample_rate = sample_rate
+        self.min_silence_len = min_silence_len
+        self.thresh_sq = (10 ** (silence_thresh / 20)) ** 2
+        self.seek_step = seek_step
+        self.keep_silence = keep_silence
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+
+        self.frames = 0  # Frames received.
+        self.tail = np.zeros((0,), dtype=np.float64)  # Squared samples of the incomplete millisecond.
+        self.energy = np.zeros((0,), dtype=np.float64)  # Per-ms sums of squares starting at energy_start.
+        self.counts = np.zeros((0,), dtype=np.int64)
+        self.energy_start = 0
+        self.complete_ms = 0
+        self.next_window = 0
+        self.audio = []  # Blocks of audio starting at audio_start.
+        self.audio_start = 0
+
+        self.prev_silence = None  # Start of the last silent window.
+        self.range_start = None  # Start of the current silent range.
+        self.nonsilent_start = 0
+        self.chunk_index = 0
+
+    def _add_energy(self, block, final=False):
+        """
+        Adds per-millisecond sums of squares for every millisecond completed by block. Millisecond m covers frames
+        [_frame(m), _frame(m+1)); when final, the remaining partial millisecond is added as well.
+        """
+        sq = np.concatenate([self.tail, np.square(block, dtype=np.float64).mean(axis=1)])
+        base = _frame(self.complete_ms, self.sample_rate)
+        n = int(len(sq) * 1000 // self.sample_rate) + 2
+        bounds = _frame(np.arange(self.complete_ms, self.complete_ms + n + 1), self.sample_rate) - base
+        if final:
+            ms_starts = bounds[bounds < len(sq)]
+            ms_ends = np.append(ms_starts[1:], len(sq))
+        else:
+            ms_ends = bounds[1:][bounds[1:] <= len(sq)]
+            ms_starts = bounds[:len(ms_ends)]
+        if len(ms_starts) == 0:
+            self.tail = sq
+            return
+        self.energy = np.concatenate([self.energy, np.add.reduceat(sq[:ms_ends[-1]], ms_starts)])
+        self.counts = np.concatenate([self.counts, ms_ends - ms_starts])
+        self.complete_ms += len(ms_starts)
+        self.tail = sq[ms_ends[-1]:]
+
+    def _scan(self, window_starts, total_ms=None):
+        """ Measures the windows at window_starts (ms), clipping them to total_ms, and updates the silent ranges. """
+        chunks = []
+        if len(window_starts) == 0:
+            return chunks
+        csum = np.concatenate([[0], np.cumsum(self.energy)])
+        ccount = np.concatenate([[0], np.cumsum(self.counts)])
+        lo = window_starts - self.energy_start
+        hi = np.minimum(window_starts + self.min_silence_len, self.complete_ms if total_ms is None else total_ms)
+        hi = np.minimum(hi - self.energy_start, len(self.energy))
+        silent = (csum[hi] - csum[lo]) <= self.thresh_sq * np.maximum(ccount[hi] - ccount[lo], 1)
+        for i in window_starts[silent].tolist():
+            if self.prev_silence is None:
+                self.range_start = i
+                if i > 0:
+                    chunks.extend(self._emit(0, i))
+            elif i != self.prev_silence + self.seek_step and i > self.prev_silence + self.min_silence_len:
+                chunks.extend(self._emit(self.prev_silence + self.min_silence_len, i))
+                self.range_start = i
+            self.prev_silence = i
+            self.nonsilent_start = i + self.min_silence_len
+        return chunks
+
+    def _emit(self, start, end, total_ms=None):
+        """ Produces the chunk for the non-silent range [start, end) (ms), padded by keep_silence. """
+        index = self.chunk_index
+        self.chunk_index += 1
+        a = _frame(max(start - self.keep_silence, 0), self.sample_rate)
+        b = _frame(end + self.keep_silence if total_ms is None else min(end + self.keep_silence, total_ms), self.sample_rate)
+        b = min(b, self.frames)
+        duration = (b - a) / self.sample_rate
+        if duration < self.min_duration or duration > self.max_duration or a < self.audio_start:
+            return [(index, None)]
+        audio = np.concatenate(self.audio, axis=0) if len(self.audio) > 1 else self.audio[0]
+        self.audio = [audio]
+        return [(index, audio[a - self.audio_start:b - self.audio_start])]
+
+    def _trim(self):
+        # Windows before next_window have been measured. The final window is placed at the end of the audio, which is
+        # at most one seek_step earlier; keep the energies from there on.
+        keep_from = max(self.next_window - self.seek_step, 0)
+        drop = keep_from - self.energy_start
+        if drop > 0:
+            self.energy = self.energy[drop:]
+            self.counts = self.counts[drop:]
+            self.energy_start = keep_from
+        # Keep the audio the pending non-silent range could still need. Once that range is too long to be kept, only
+        # audio for ranges starting after the next possible silent window is needed.
+        keep_from = self.nonsilent_start
+        if self.next_window - keep_from > self.max_duration * 1000:
+            keep_from = self.next_window + self.min_silence_len
+        keep_frame = _frame(max(keep_from - self.keep_silence, 0), self.sample_rate)
+        while self.audio and self.audio_start + len(self.audio[0]) <= keep_frame:
+            self.audio_start += len(self.audio.pop(0))
+
+    def push(self, block):
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim == 1:
+            block = block[:, None]
+        self.audio.append(block)
+        self.frames += len(block)
+        self._add_energy(block)
+        last_start = self.complete_ms - self.min_silence_len
+        starts = np.arange(self.next_window, last_start + 1, self.seek_step, dtype=np.int64)
+        if len(starts):
+            self.next_window = int(starts[-1]) + self.seek_step
+        chunks = self._scan(starts)
+        self._trim()
+        return chunks
+
+    def finish(self):
+        total_ms = round(1000 * self.frames / self.sample_rate)
+        self._add_energy(np.zeros((0, 1), dtype=np.float32), final=True)
+        if total_ms < self.min_silence_len:
+            return self._emit(0, total_ms, total_ms)
+        last_start = total_ms - self.min_silence_len
+        starts = list(range(self.next_window, last_start + 1, self.seek_step))
+        if last_start % self.seek_step:
+            starts.append(last_start)
+        chunks = self._scan(np.array(starts, dtype=np.int64), total_ms)
+        if self.prev_silence is None:
+            chunks.extend(self._emit(0, total_ms, total_ms))
+        elif not (self.range_start == 0 and self.prev_silence + self.min_silence_len == total_ms):
+            end = self.prev_silence + self.min_silence_len
+            if end != total_ms:
+                chunks.extend(self._emit(end, total_ms, total_ms))
+        self.audio = []
+        return chunks
+
+
+def stream_audio_blocks(path, block_seconds=30):
+    """
+    Yields (sample_rate, block) pairs of decoded audio with blocks of shape (frames, channels). Formats that libsndfile
+    cannot read are decoded by an ffmpeg subprocess. Raises CouldntDecodeError for files neither can decode.
+    """
+    try:
+        f = sf.SoundFile(path)
+    except Exception:
+        f = None
+    if f is not None:
+        with f:
+            for block in f.blocks(blocksize=int(block_seconds * f.samplerate), dtype='float32', always_2d=True):
+                yield f.samplerate, block
+        return
+    probe = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries',
+                            'stream=sample_rate,channels', '-of', 'json', path], capture_output=True)
+    try:
+        probe.check_returncode()
+        stream = json.loads(probe.stdout)['streams'][0]
+        sample_rate, channels = int(stream['sample_rate']), int(stream['channels'])
+    except (subprocess.CalledProcessError, ValueError, KeyError, IndexError) as e:
+        raise CouldntDecodeError(f'{path} has no decodable audio stream: {probe.stderr.decode(errors="replace").strip()}') from e
+    proc = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', path, '-f', 'f32le', '-'], stdout=subprocess.PIPE)
+    block_bytes = int(block_seconds * sample_rate) * channels * 4
+    try:
+        while True:
+            data = proc.stdout.read(block_bytes)
+            if not data:
+                break
+            data = data[:len(data) - len(data) % (channels * 4)]
+            yield sample_rate, np.frombuffer(data, dtype=np.float32).reshape(-1, channels)
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise CouldntDecodeError(f'ffmpeg failed to decode {path} (exit code {returncode})')
+
+
+def write_mp3(path, audio, sample_rate):
+    """ Writes audio (frames, channels) to path as a mono MP3. """
+    sf.write(path, audio.mean(axis=1), sample_rate, format='MP3')
+
+
+def split_file_on_silence(path, chunk_fn, block_seconds=30, **splitter_kwargs):
+    """ Streams path through a StreamingSilenceSplitter, calling chunk_fn(index, audio, sample_rate) for kept chunks. """
+    splitter = None
+    for sample_rate, block in stream_audio_blocks(path, block_seconds):
+        if splitter is None:
+            splitter = StreamingSilenceSplitter(sample_rate, **splitter_kwargs)
+        for index, audio in splitter.push(block):
+            if audio is not None:
+                chunk_fn(index, audio, sample_rate)
+    if splitter is not None:
+        for index, audio in splitter.finish():
+            if audio is not None:
+                chunk_fn(index, audio, sample_rate)
+
+
+def benchmark_silence_splitting(minutes=10, sample_rate=22050, min_silence_len=600, silence_thresh=-40, seek_step=100,
+                                keep_silence=50):
+    """
+    Compares silence splitting throughput (audio seconds processed per second) of pydub's split_on_silence against
+    StreamingSilenceSplitter on synthetic speech-like audio, and checks that they produce the same chunk boundaries.
+    """
+    rng = np.random.default_rng(0)
+    pieces = []
+    while sum(len(p) for p in pieces) < minutes * 60 * sample_rate:
+        pieces.append((rng.standard_normal(int(rng.uniform(.5, 15) * sample_rate)) * .2).astype(np.float32))
+        pieces.append((rng.standard_normal(int(rng.uniform(.1, 2) * sample_rate)) * .001).astype(np.float32))
+    audio = np.concatenate(pieces)
+    seconds = len(audio) / sample_rate
+    kwargs = dict(min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=seek_step,
+                  keep_silence=keep_silence)
+
+    start = time.perf_counter()
+    splitter = StreamingSilenceSplitter(sample_rate, **kwargs)
+    ours = []
+    for i in range(0, len(audio), 30 * sample_rate):
+        ours.extend(splitter.push(audio[i:i + 30 * sample_rate]))
+    ours.extend(splitter.finish())
+    ours_time = time.perf_counter() - start
+    results = {'streaming_audio_sec_per_sec': seconds / ours_time}
+    print(f'Streaming splitter: {seconds / ours_time:.0f} audio seconds/sec, {len(ours)} chunks.')
+
+    try:
+        from pydub import AudioSegment
+        from pydub.silence import split_on_silence
+    except ImportError:
+        print('pydub is not installed; skipping the comparison.')
+        return results
+    segment = AudioSegment((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes(), frame_rate=sample_rate,
+                           sample_width=2, channels=1)
+    start = time.perf_counter()
+    theirs = split_on_silence(segment, **kwargs)
+    pydub_time = time.perf_counter() - start
+    lengths_match = [len(c[1]) for c in ours] == [len(c.get_array_of_samples()) for c in theirs]
+    results.update({'pydub_audio_sec_per_sec': seconds / pydub_time, 'chunks_match': lengths_match})
+    print(f'pydub: {seconds / pydub_time:.0f} audio seconds/sec, {len(theirs)} chunks. '
+          f'Speedup: {pydub_time / ours_time:.1f}x. Chunk lengths match: {lengths_match}')
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_silence_splitting()
@@ -0,0 +1,65 @@
+import argparse
+import os.path as osp
+
+import torch
+import yaml
+
+from trainer.eval.evaluator import create_evaluator
+from utils.util import load_model_from_config
+
+# Sweeps a diffusion evaluator (music_diffusion_fid, audio_diffusion_fid, sr_diffusion_fid, ...) across samplers and
+# numbers of function evaluations, printing the quality metrics of each combination.
+#
+# Example:
+#   python scripts/diffusion/diffusion_sampler_nfe_sweep.py -config ../options/train_music_diffusion.yml -model generator \
+#       -load_path ../experiments/music_diffusion.pth -eval_opt ../options/eval_music_fid.yml \
+#       -samplers p_sample,ddim,dpm++,unipc -nfes 10,20,50,100
+
+
+def set_sampler(opt_eval, sampler, nfe, order):
+    if 'diffusion_params' in opt_eval.keys():
+        # Evaluators built on GaussianDiffusionInferenceInjector.
+        opt_eval['diffusion_params']['sampler'] = sampler
+        opt_eval['diffusion_params']['solver_order'] = order
+        opt_eval['diffusion_params']['respaced_timestep_spacing'] = nfe
+    else:
+        opt_eval['sampler'] = sampler
+        opt_eval['solver_order'] = order
+        opt_eval['diffusion_steps'] = nfe
+    return opt_eval
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-config', type=str, help='Training config the model is defined in.', required=True)
+    parser.add_argument('-model', type=str, help='Name of the model in the config.', default='generator')
+    parser.add_argument('-load_path', type=str, help='Model weights.', required=True)
+    parser.add_argument('-eval_opt', type=str, help='YAML file holding the evaluator options, including its type.', required=True)
+    parser.add_argument('-samplers', type=str, help='Comma-separated samplers to sweep.', default='ddim,dpm++,unipc')
+    parser.add_argument('-nfes', type=str, help='Comma-separated numbers of function evaluations to sweep.', default='10,15,20,50')
+    parser.add_argument('-order', type=int, help='Order of the dpm++ and unipc solvers.', default=2)
+    parser.add_argument('-output_path', type=str, help='Where evaluators write their samples.', default='../results/sampler_nfe_sweep')
+    parser.add_argument('-device', type=str, default='cuda')
+    args = parser.parse_args()
+
+    model = load_model_from_config(args.config, args.model, also_load_savepoint=False, load_path=args.load_path,
+                                   strict_load=False, device=args.device).eval()
+    with open(args.eval_opt, 'r') as f:
+        base_opt_eval = yaml.safe_load(f)
+
+    results = []
+    for sampler in args.samplers.split(','):
+        for nfe in [int(n) for n in args.nfes.split(',')]:
+            opt_eval = set_sampler(yaml.safe_load(yaml.safe_dump(base_opt_eval)), sampler, nfe, args.order)
+            env = {'rank': 0, 'base_path': osp.join(args.output_path, 'base'), 'step': f'{sampler}_{nfe}',
+                   'device': args.device, 'opt': {}}
+            evaluator = create_evaluator(model, opt_eval, env)
+            with torch.no_grad():
+                metrics = evaluator.perform_eval()
+            metrics = {k: v.item() if torch.is_tensor(v) else v for k, v in metrics.items()}
+            print(f'{sampler} @ {nfe} NFE: {metrics}')
+            results.append((sampler, nfe, metrics))
+
+    print('sampler\tNFE\tmetrics')
+    for sampler, nfe, metrics in results:
+        print(f'{sampler}\t{nfe}\t' + '\t'.join(f'{k}={v:.4f}' if isinstance(v, float) else f'{k}={v}' for k, v in metrics.items()))
@@ -8,6 +8,7 @@ from collections import OrderedDict
 import utils
 import utils.options as option
 import utils.util as util
+from models.attention_backends import set_attention_backend
 from trainer.ExtensibleTrainer import ExtensibleTrainer
 from data import create_dataset, create_dataloader
 from tqdm import tqdm
@@ -62,6 +63,7 @@ if __name__ == "__main__":
     opt = option.parse(parser.parse_args().opt, is_train=False)
     opt = option.dict_to_nonedict(opt)
     utils.util.loaded_options = opt
+    set_attention_backend(util.opt_get(opt, ['attention_backend'], 'math'))
 
     util.mkdirs(
         (path for key, path in opt['path'].items()
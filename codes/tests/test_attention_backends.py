@@ -0,0 +1,61 @@
+"""
+Checks that every attention backend in models/attention_backends.py matches the default 'math' backend on each of the
+QKVAttention modules. Run from the codes/ directory: python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import maybe_bnb
+maybe_bnb.populate(False, False, False, embedding=None)
+
+from models import attention_backends
+from models.attention_backends import set_attention_backend, _parity_cases
+
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+BACKENDS = ['chunked'] + (['sdpa'] if hasattr(F, 'scaled_dot_product_attention') else [])
+
+
+@pytest.fixture(autouse=True)
+def restore_backend():
+    previous = attention_backends._backend
+    yield
+    set_attention_backend(previous)
+
+
+def test_default_backend_is_math():
+    assert attention_backends.get_attention_backend() == 'math'
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_backend_matches_math(device, backend):
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for name, module, args, kwargs in _parity_cases(device):
+            set_attention_backend('math')
+            expected = module(*args, **kwargs)
+            set_attention_backend(backend)
+            actual = module(*args, **kwargs)
+            assert torch.allclose(actual, expected, atol=1e-4, rtol=1e-4), \
+                f'{name} with {backend} differs from math by {(actual - expected).abs().max().item()}'
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_backend_gradients_match_math(backend):
+    from models.arch_util import QKVAttentionLegacy
+    torch.manual_seed(0)
+    module = QKVAttentionLegacy(4)
+    qkv = torch.randn(2, 4 * 32 * 3, 300)
+    grads = []
+    for b in ['math', backend]:
+        set_attention_backend(b)
+        x = qkv.clone().requires_grad_(True)
+        module(x).square().sum().backward()
+        grads.append(x.grad)
+    assert torch.allclose(grads[1], grads[0], atol=1e-3, rtol=1e-3)
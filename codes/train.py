@@ -9,7 +9,10 @@ import shutil
 from tqdm import tqdm
 
 import torch
-from data.data_sampler import DistIterSampler
+from data.data_sampler import DistIterSampler, BucketingBatchSampler, DistBucketingBatchSampler
+from data.zero_pad_dict_collate import LengthTrimmingCollate
+from models.attention_backends import set_attention_backend
+from trainer.async_evaluation import AsyncEvaluationRunner
 from trainer.eval.evaluator import create_evaluator
 
 from utils import util, options as option
@@ -43,6 +46,8 @@ class Trainer:
         self.val_compute_fea = opt_get(opt, ['eval', 'compute_fea'], False)
         self.current_step = 0
         self.total_training_data_encountered = 0
+        self.batches_consumed_in_epoch = 0
+        self.resume_batches_consumed = 0
 
         #### loading resume state if exists
         if opt['path'].get('resume_state', None):
@@ -101,6 +106,7 @@ class Trainer:
 
         torch.backends.cudnn.benchmark = opt_get(opt, ['cuda_benchmarking_enabled'], True)
         torch.backends.cuda.matmul.allow_tf32 = True
+        set_attention_backend(opt_get(opt, ['attention_backend'], 'math'))
         # torch.backends.cudnn.deterministic = True
         if opt_get(opt, ['anomaly_detection'], False):
             torch.autograd.set_detect_anomaly(True)
@@ -119,14 +125,42 @@ class Trainer:
                 train_size = int(math.ceil(len(self.train_set) / dataset_opt['batch_size']))
                 total_iters = int(opt['train']['niter'])
                 self.total_epochs = int(math.ceil(total_iters / train_size))
-                if opt['dist']:
-                    self.train_sampler = DistIterSampler(self.train_set, self.world_size, self.rank, dataset_ratio)
+                batch_sampler = None
+                # Samplers must be seeded identically on every rank, so this does not use the rank-adjusted seed.
+                sampler_seed = opt_get(opt, ['train', 'manual_seed'], 0) or 0
+                bucketing_opt = opt_get(dataset_opt, ['length_bucketing'], None)
+                if bucketing_opt is not None:
+                    # Groups clips of similar length into batches, which are then only padded to the longest clip.
+                    assert hasattr(self.train_set, 'get_item_lengths'), 'length_bucketing requires a dataset with get_item_lengths()'
+                    bucketing_args = {'max_batch_samples': opt_get(bucketing_opt, ['max_batch_samples'], None),
+                                      'num_buckets': opt_get(bucketing_opt, ['num_buckets'], 10),
+                                      'seed': sampler_seed}
+                    lengths = self.train_set.get_item_lengths()
+                    if opt['dist']:
+                        batch_sampler = DistBucketingBatchSampler(lengths, dataset_opt['batch_size'] // self.world_size,
+                                                                  self.world_size, self.rank, **bucketing_args)
+                    else:
+                        batch_sampler = BucketingBatchSampler(lengths, dataset_opt['batch_size'], **bucketing_args)
+                    collate_fn = LengthTrimmingCollate(collate_fn)
+                    if hasattr(self.train_set, 'set_bucket_sampler'):
+                        # Lets the dataset replace items that fail to load with items of the same bucket.
+                        self.train_set.set_bucket_sampler(batch_sampler)
+                    self.train_sampler = batch_sampler
+                    train_size = len(batch_sampler)
+                    self.total_epochs = int(math.ceil(total_iters / train_size))
+                    shuffle = False
+                    if self.rank <= 0:
+                        self.logger.info(f'Length bucketing enabled. Expected padding ratio: {batch_sampler.padding_ratio():.3f}')
+                elif opt['dist']:
+                    self.train_sampler = DistIterSampler(self.train_set, self.world_size, self.rank, dataset_ratio, seed=sampler_seed)
                     self.total_epochs = int(math.ceil(total_iters / (train_size * dataset_ratio)))
                     shuffle = False
                 else:
-                    self.train_sampler = None
-                    shuffle = True
-                self.train_loader = create_dataloader(self.train_set, dataset_opt, opt, self.train_sampler, collate_fn=collate_fn, shuffle=shuffle)
+                    # A single-replica DistIterSampler rather than shuffle=True so that the data order can be resumed.
+                    self.train_sampler = DistIterSampler(self.train_set, 1, 0, dataset_ratio, seed=sampler_seed)
+                    shuffle = False
+                self.train_loader = create_dataloader(self.train_set, dataset_opt, opt, self.train_sampler, collate_fn=collate_fn,
+                                                      shuffle=shuffle, batch_sampler=batch_sampler)
                 if self.rank <= 0:
                     self.logger.info('Number of training data elements: {:,d}, iters: {:,d}'.format(
                         len(self.train_set), train_size))
@@ -147,15 +181,24 @@ class Trainer:
 
         ### Evaluators
         self.evaluators = []
+        self.async_evaluator = None
         if 'eval' in opt.keys() and 'evaluators' in opt['eval'].keys():
             # In "pure" mode, we propagate through the normal training steps, but use validation data instead and average
             # the total loss. A validation dataloader is required.
             if opt_get(opt, ['eval', 'pure'], False):
                 assert hasattr(self, 'val_loader')
 
-            for ev_key, ev_opt in opt['eval']['evaluators'].items():
-                self.evaluators.append(create_evaluator(self.model.networks[ev_opt['for']],
-                                                        ev_opt, self.model.env))
+            if opt_get(opt, ['eval', 'async'], False):
+                # Evaluators run in a separate process on the EMA weights (when available) and do not block training.
+                if self.rank <= 0:
+                    self.async_evaluator = AsyncEvaluationRunner(opt, os.path.join(opt['path']['experiments_root'], 'eval_handoff'),
+                                                                 device=opt_get(opt, ['eval', 'async_device'], 'cpu'),
+                                                                 max_pending=opt_get(opt, ['eval', 'async_max_pending'], 1),
+                                                                 checkpoint_writer=self.model.get_checkpoint_writer())
+            else:
+                for ev_key, ev_opt in opt['eval']['evaluators'].items():
+                    self.evaluators.append(create_evaluator(self.model.networks[ev_opt['for']],
+                                                            ev_opt, self.model.env))
 
         #### resume training
         if resume_state:
@@ -165,6 +208,8 @@ class Trainer:
             self.start_epoch = resume_state['epoch']
             self.current_step = resume_state['iter']
             self.total_training_data_encountered = opt_get(resume_state, ['total_data_processed'], 0)
+            # Older states did not record the sampler position; those resume from the start of the epoch.
+            self.resume_batches_consumed = opt_get(resume_state, ['sampler_state', 'batches_consumed'], 0)
             if opt_get(opt, ['path', 'optimizer_reset'], False):
                 print('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
                 print('!! RESETTING OPTIMIZER STATES')
@@ -198,6 +243,7 @@ class Trainer:
         batch_size = self.opt['datasets']['train']['batch_size']  # It may seem weird to derive this from opt, rather than train_data. The reason this is done is
                                                                   # because train_data is process-local while the opt variant represents all of the data fed across all GPUs.
         self.current_step += 1
+        self.batches_consumed_in_epoch += 1
         self.total_training_data_encountered += batch_size
         will_log = self.current_step % opt['logger']['print_freq'] == 0
 
@@ -284,7 +330,8 @@ class Trainer:
                     )
 
                 self.model.save(self.current_step)
-                state = {'epoch': self.epoch, 'iter': self.current_step, 'total_data_processed': self.total_training_data_encountered}
+                state = {'epoch': self.epoch, 'iter': self.current_step, 'total_data_processed': self.total_training_data_encountered,
+                         'sampler_state': {'batches_consumed': self.batches_consumed_in_epoch}}
                 if self.dataset_debugger is not None:
                     state['dataset_debugger_state'] = self.dataset_debugger.get_state()
                 if opt['logger']['disable_state_saving'] is False:
@@ -329,36 +376,67 @@ class Trainer:
                 if eval.uses_all_ddp or self.rank <= 0:
                     eval_dict.update(eval.perform_eval())
             if self.rank <= 0:
-                print("Evaluator results: ", eval_dict)
-                for ek, ev in eval_dict.items():
-                    self.tb_logger.add_scalar(ek, ev, self.current_step)
-                if opt['wandb']:
-                    import wandb
-                    wandb.log(eval_dict)
+                self.log_eval_results(self.current_step, eval_dict)
+        if self.async_evaluator is not None:
+            if do_eval:
+                self.model.flush_emas()
+                networks = {}
+                for ev_opt in opt['eval']['evaluators'].values():
+                    net = self.model.emas.get(ev_opt['for'], self.model.networks[ev_opt['for']])
+                    networks[ev_opt['for']] = net.module if hasattr(net, 'module') else net
+                if not self.async_evaluator.submit(self.current_step, networks):
+                    print(f"Skipping evaluation of step {self.current_step}: the previous evaluation is still running.")
+            for step, eval_dict in self.async_evaluator.poll():
+                self.log_eval_results(step, eval_dict)
 
         # Should not be necessary, but make absolutely sure that there is no grad leakage from validation runs.
         for net in self.model.networks.values():
             net.zero_grad()
 
+    def log_eval_results(self, step, eval_dict):
+        print(f"Evaluator results for step {step}: ", eval_dict)
+        if self.opt['use_tb_logger'] and 'debug' not in self.opt['name']:
+            for ek, ev in eval_dict.items():
+                self.tb_logger.add_scalar(ek, ev, step)
+        if self.opt['wandb']:
+            import wandb
+            wandb.log({**eval_dict, 'eval_step': step})
+
+    def start_sampler_epoch(self, epoch):
+        if self.train_sampler is not None:
+            self.train_sampler.set_epoch(epoch)
+        if hasattr(self.train_set, 'set_epoch'):
+            self.train_set.set_epoch(epoch)
+        self.batches_consumed_in_epoch = 0
+        if self.resume_batches_consumed > 0:
+            # Resuming mid-epoch: skip the batches which were already trained on. Samplers without a batch_sampler
+            # count in samples, batch samplers in batches.
+            batch_size = self.train_loader.batch_size
+            self.train_sampler.set_start(self.resume_batches_consumed * (batch_size if batch_size is not None else 1))
+            self.batches_consumed_in_epoch = self.resume_batches_consumed
+            self.resume_batches_consumed = 0
+
     def do_training(self):
         self.logger.info('Start training from epoch: {:d}, iter: {:d}'.format(self.start_epoch, self.current_step))
         for epoch in range(self.start_epoch, self.total_epochs + 1):
             self.epoch = epoch
-            if self.opt['dist']:
-                self.train_sampler.set_epoch(epoch)
+            self.start_sampler_epoch(epoch)
 
             tq_ldr = tqdm(self.train_loader) if self.rank <= 0 else self.train_loader
 
             _t = time()
             for train_data in tq_ldr:
                 self.do_step(train_data)
+        self.model.wait_for_checkpoints()
+        if self.async_evaluator is not None:
+            for step, eval_dict in self.async_evaluator.close():
+                self.log_eval_results(step, eval_dict)
 
     def create_training_generator(self, index):
         self.logger.info('Start training from epoch: {:d}, iter: {:d}'.format(self.start_epoch, self.current_step))
         for epoch in range(self.start_epoch, self.total_epochs + 1):
             self.epoch = epoch
-            if self.opt['dist']:
-                self.train_sampler.set_epoch(epoch)
+            self.start_sampler_epoch(epoch)
             tq_ldr = tqdm(self.train_loader, position=index)
 
             _t = time()
@@ -14,6 +14,7 @@ import trainer.lr_scheduler as lr_scheduler
 import trainer.networks as networks
 from trainer.base_model import BaseModel
 from trainer.batch_size_optimizer import create_batch_size_optimizer
+from trainer.ema import EmaUpdater
 from trainer.inject import create_injector
 from trainer.injectors.audio_injectors import normalize_mel
 from trainer.steps import ConfigurableStep
@@ -64,6 +65,8 @@ class ExtensibleTrainer(BaseModel):
             # It does come at the cost of a round trip to CPU memory at every batch.
             self.do_emas = opt_get(train_opt, ['ema_enabled'], True)
             self.ema_on_cpu = opt_get(train_opt, ['ema_on_cpu'], False)
+            self.ema_cpu_interval = opt_get(train_opt, ['ema_cpu_update_interval'], 10)
+        self.ema_updaters = {}
         self.checkpointing_cache = opt['checkpointing_enabled']
         self.auto_recover = opt_get(opt, ['automatically_recover_nan_by_reverting_n_saves'], None)
         self.batch_size_optimizer = create_batch_size_optimizer(train_opt)
@@ -415,9 +418,24 @@ class ExtensibleTrainer(BaseModel):
         return grad_norms
 
 
+    def get_ema_updater(self, name):
+        # EMA modules can be swapped out (e.g. by load()), so the updater is rebuilt whenever the pairing changes.
+        net, ema = self.networks[name], self.emas[name]
+        updater = self.ema_updaters.get(name, None)
+        if updater is None or not updater.is_for(net, ema):
+            updater = EmaUpdater(net, ema, self.ema_rate, on_cpu=self.ema_on_cpu, cpu_interval=self.ema_cpu_interval)
+            self.ema_updaters[name] = updater
+        return updater
+
+    def flush_emas(self):
+        for updater in self.ema_updaters.values():
+            updater.flush()
+
     def consume_gradients(self, state, step, it):
         [e.before_optimize(state) for e in self.experiments]
         self.restore_optimizers()
+        for updater in self.ema_updaters.values():
+            updater.before_optimizer_step()
         step.do_step(it)
         self.stash_optimizers()
 
@@ -426,21 +444,8 @@ class ExtensibleTrainer(BaseModel):
             if hasattr(net.module, "after_step"):
                 net.module.after_step(it)
             if self.do_emas:
-                # When the EMA is on the CPU, only update every 10 steps to save processing time.
-                if self.ema_on_cpu and it % 10 != 0:
-                    continue
-                ema_params = self.emas[name].parameters()
-                net_params = net.parameters()
-                for ep, np in zip(ema_params, net_params):
-                    ema_rate = self.ema_rate
-                    new_rate = 1 - ema_rate
-                    if self.ema_on_cpu:
-                        np = np.cpu()
-                        ema_rate = ema_rate ** 10  # Because it only happens every 10 steps.
-                        mid = (1 - (ema_rate+new_rate))/2
-                        ema_rate += mid
-                        new_rate += mid
-                    ep.detach().mul_(ema_rate).add_(np, alpha=1 - ema_rate)
+                # When the EMA is on the CPU, it is only updated every ema_cpu_interval steps to save processing time.
+                self.get_ema_updater(name).update(it)
         [e.after_optimize(state) for e in self.experiments]
 
 
@@ -500,6 +505,7 @@ class ExtensibleTrainer(BaseModel):
 
         # The batch size optimizer also outputs loggable data.
         log.update(self.batch_size_optimizer.get_statistics())
+        log.update(self.get_checkpoint_metrics())
 
         # In distributed mode, get agreement on all single tensors.
         if distributed.is_available() and distributed.is_initialized():
@@ -558,6 +564,14 @@ class ExtensibleTrainer(BaseModel):
                 "Expected network name (opt['networks'][*]) to be 'ddpm' or 'gpt', but got %s" % network_name,
             )
 
+        if self.checkpoint_writer is not None:
+            # Let checkpoints which are still being written land before deciding what to delete.
+            self.checkpoint_writer.submit_task(
+                lambda: self._remove_old_checkpoints_and_states(network_name, models_number, state_number))
+        else:
+            self._remove_old_checkpoints_and_states(network_name, models_number, state_number)
+
+    def _remove_old_checkpoints_and_states(self, network_name, models_number, state_number):
         models_path = Path(self.opt['path']['models']).parent / 'models'
         states_path = Path(self.opt['path']['models']).parent / 'training_state'
         files_pth, files_ema_pth, files_state = [], [], []
@@ -584,6 +598,7 @@ class ExtensibleTrainer(BaseModel):
                 os.remove(file_path)
 
     def save(self, iter_step):
+        self.flush_emas()
         for name, net in self.networks.items():
             # Don't save non-trainable networks.
             if self.opt['networks'][name]['trainable']:
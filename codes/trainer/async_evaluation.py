@@ -0,0 +1,191 @@
+import os
+import queue
+import threading
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from trainer.checkpoint_writer import atomic_torch_save
+from utils.util import opt_get
+
+
+def _run_evaluators(opt, device, jobs, results):
+    """
+    Worker process body. Builds the networks which the evaluators are for, then for each job loads the handed-off
+    weights into them and runs every evaluator. Results (or a traceback) are posted back along with the job's step.
+    """
+    import maybe_bnb
+    if opt_get(opt, ['use_8bit'], True):
+        maybe_bnb.populate()
+    else:
+        maybe_bnb.populate(False, False, False, embedding=None)
+    from models.attention_backends import set_attention_backend
+    from trainer.eval.evaluator import create_evaluator
+    from trainer.networks import create_model
+
+    set_attention_backend(opt_get(opt, ['attention_backend'], 'math'))
+    env = {'device': device, 'rank': 0, 'opt': opt, 'step': 0, 'dist': False, 'base_path': opt['path']['models']}
+    networks = {}
+    evaluators = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        step, path = job
+        try:
+            state = torch.load(path, map_location='cpu')
+            os.remove(path)
+            for name, state_dict in state.items():
+                if name not in networks:
+                    networks[name] = create_model(opt, opt['networks'][name]).to(device)
+                networks[name].load_state_dict(state_dict)
+            if evaluators is None:
+                env['generators'] = networks
+                env['emas'] = networks
+                evaluators = [create_evaluator(networks[ev_opt['for']], ev_opt, env)
+                              for ev_opt in opt['eval']['evaluators'].values()]
+            env['step'] = step
+            eval_dict = {}
+            for evaluator in evaluators:
+                eval_dict.update(evaluator.perform_eval())
+            results.put((step, {k: float(v) for k, v in eval_dict.items()}, None))
+        except Exception:
+            results.put((step, None, traceback.format_exc()))
+
+
+class AsyncEvaluationRunner:
+    """
+    Runs the evaluators configured under opt['eval']['evaluators'] in a separate process, so that training does not
+    pause while they run.
+
+    submit() snapshots the given networks (normally the EMAs) into a handoff file under handoff_dir. When an
+    AsyncCheckpointWriter is provided, the write happens on its thread and only the device->host copy blocks. The worker
+    process, running on `device`, loads the snapshot, runs every evaluator and posts the results, tagged with the step,
+    which poll() collects. At most max_pending evaluations are outstanding; further submissions are dropped until the
+    worker catches up.
+
+    If the worker process dies (e.g. it was OOM killed), its outstanding evaluations are dropped and it is restarted, up
+    to max_restarts times.
+    """
+    def __init__(self, opt, handoff_dir, device='cpu', max_pending=1, checkpoint_writer=None, max_restarts=3):
+        self.opt = opt
+        self.device = device
+        self.handoff_dir = handoff_dir
+        self.max_pending = max_pending
+        self.checkpoint_writer = checkpoint_writer
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        # step->handoff path of every evaluation which has been submitted but whose results have not been collected.
+        self.outstanding = {}
+        self.lock = threading.Lock()
+        os.makedirs(handoff_dir, exist_ok=True)
+        self._start_worker()
+
+    def _start_worker(self):
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_run_evaluators, args=(self.opt, self.device, self.jobs, self.results),
+                                   name='async-evaluator', daemon=True)
+        self.process.start()
+
+    @property
+    def pending(self):
+        return len(self.outstanding)
+
+    def _drop(self, step):
+        with self.lock:
+            path = self.outstanding.pop(step, None)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def _queue_job(self, step, path):
+        with self.lock:
+            # The worker may have been restarted while the handoff was being written, dropping this evaluation.
+            if step in self.outstanding:
+                self.jobs.put((step, path))
+                return
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _check_worker(self):
+        """ Restarts the worker process if it died, dropping its outstanding evaluations. """
+        if self.process.is_alive():
+            return
+        if self.restarts >= self.max_restarts:
+            raise RuntimeError(f'The asynchronous evaluation worker died {self.restarts + 1} times '
+                               f'(last exit code {self.process.exitcode}).')
+        self.restarts += 1
+        lost = sorted(self.outstanding.keys())
+        print(f'Asynchronous evaluation worker died with exit code {self.process.exitcode}; restarting it. '
+              f'Dropped evaluations of steps {lost}.')
+        for step in lost:
+            self._drop(step)
+        self._start_worker()
+
+    def submit(self, step, networks):
+        """ Hands the state of networks (a dict of name->module) to the worker. Returns False if it was dropped. """
+        self._check_worker()
+        if self.pending >= self.max_pending:
+            return False
+        path = os.path.join(self.handoff_dir, f'{step}.pth')
+        with self.lock:
+            self.outstanding[step] = path
+        state = {name: net.state_dict() for name, net in networks.items()}
+        if self.checkpoint_writer is not None:
+            def handoff_failed(e):
+                # A lost evaluation must not fail training (or the next checkpoint save), so keep this out of the
+                # writer's error slot.
+                print(f'Handoff of step {step} to the asynchronous evaluator failed; skipping its evaluation: {e!r}')
+                self._drop(step)
+
+            try:
+                self.checkpoint_writer.submit('eval_handoff', state, [path], post_write=lambda: self._queue_job(step, path),
+                                              on_error=handoff_failed)
+            except:
+                self._drop(step)
+                raise
+        else:
+            try:
+                atomic_torch_save(state, path)
+            except:
+                self._drop(step)
+                raise
+            self._queue_job(step, path)
+        return True
+
+    def _collect(self, block):
+        out = []
+        while self.pending > 0:
+            try:
+                step, eval_dict, error = self.results.get(block=block, timeout=5 if block else None)
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                break
+            with self.lock:
+                self.outstanding.pop(step, None)
+            if error is not None:
+                print(f'Asynchronous evaluation of step {step} failed:\n{error}')
+            else:
+                out.append((step, eval_dict))
+        return out
+
+    def poll(self):
+        """ Returns a list of (step, results) for every evaluation that has finished since the last call. """
+        out = self._collect(block=False)
+        self._check_worker()
+        return out
+
+    def close(self):
+        """
+        Waits for outstanding evaluations, stops the worker and returns their results. Any checkpoint writer in use must
+        have been waited on first, so that every handoff has been queued.
+        """
+        if not self.process.is_alive():
+            return self._collect(block=False)
+        out = self._collect(block=True)
+        self.jobs.put(None)
+        self.process.join()
+        return out
@@ -6,6 +6,7 @@ from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.nn.parallel.distributed import DistributedDataParallel
 
 import utils.util
+from trainer.checkpoint_writer import AsyncCheckpointWriter
 from utils.util import opt_get, optimizer_to, map_to_device
 
 
@@ -24,6 +25,9 @@ class BaseModel():
         self.optimizers = []
         self.disc_optimizers = []
         self.save_history = {}
+        # When enabled, checkpoints are snapshotted to host memory and written by a background thread.
+        self.async_checkpointing = opt_get(opt, ['logger', 'async_checkpointing'], False)
+        self.checkpoint_writer = None
 
     def feed_data(self, data):
         pass
@@ -84,25 +88,49 @@ class BaseModel():
             network = network.module
         return str(network), sum(map(lambda x: x.numel(), network.parameters()))
 
+    def get_checkpoint_writer(self):
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = AsyncCheckpointWriter()
+        return self.checkpoint_writer
+
+    def wait_for_checkpoints(self):
+        """ Blocks until all asynchronous checkpoint writes have completed. """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+
+    def get_checkpoint_metrics(self):
+        if self.checkpoint_writer is None:
+            return {}
+        return self.checkpoint_writer.get_metrics()
+
     def save_network(self, network, network_label, iter_label):
         save_filename = '{}_{}.pth'.format(iter_label, network_label)
         save_path = os.path.join(self.opt['path']['models'], save_filename)
         if isinstance(network, nn.DataParallel) or isinstance(network, DistributedDataParallel):
             network = network.module
         state_dict = network.state_dict()
-        for key, param in state_dict.items():
-            state_dict[key] = param.cpu()
-        torch.save(state_dict, save_path)
         if network_label not in self.save_history.keys():
             self.save_history[network_label] = []
         self.save_history[network_label].append(save_path)
-
+        paths = [save_path]
         # Also save to the 'alt_path' which is useful for caching to Google Drive in colab, for example.
         if 'alt_path' in self.opt['path'].keys():
-            torch.save(state_dict, os.path.join(self.opt['path']['alt_path'], save_filename))
+            paths.append(os.path.join(self.opt['path']['alt_path'], save_filename))
+        upload = None
         if self.opt['colab_mode']:
-            utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
-                                            save_path, os.path.join(self.opt['remote_path'], 'models', save_filename))
+            upload = lambda: utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
+                                                             save_path, os.path.join(self.opt['remote_path'], 'models', save_filename))
+
+        if self.async_checkpointing:
+            self.get_checkpoint_writer().submit(network_label, state_dict, paths, post_write=upload)
+            return save_path
+
+        for key, param in state_dict.items():
+            state_dict[key] = param.cpu()
+        for path in paths:
+            torch.save(state_dict, path)
+        if upload is not None:
+            upload()
         return save_path
 
     def load_network(self, load_path, network, strict=True, pretrain_base_path=None):
@@ -148,17 +176,27 @@ class BaseModel():
             state['amp'] = amp.state_dict()
         save_filename = '{}.state'.format(utils.util.opt_get(state, ['iter'], 'no_step_provided'))
         save_path = os.path.join(self.opt['path']['training_state'], save_filename)
-        torch.save(map_to_device(state, 'cpu'), save_path)
         if '__state__' not in self.save_history.keys():
             self.save_history['__state__'] = []
         self.save_history['__state__'].append(save_path)
+        upload = None
+        if self.opt['colab_mode']:
+            upload = lambda: utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
+                                                             save_path, os.path.join(self.opt['remote_path'], 'training_state', save_filename))
+
+        if self.async_checkpointing:
+            paths = [save_path]
+            if 'alt_path' in self.opt['path'].keys():
+                paths.append(os.path.join(self.opt['path']['alt_path'], 'latest.state'))
+            self.get_checkpoint_writer().submit('__state__', state, paths, post_write=upload)
+            return
 
+        torch.save(map_to_device(state, 'cpu'), save_path)
         # Also save to the 'alt_path' which is useful for caching to Google Drive in colab, for example.
         if 'alt_path' in self.opt['path'].keys():
             torch.save(state, os.path.join(self.opt['path']['alt_path'], 'latest.state'))
-        if self.opt['colab_mode']:
-            utils.util.copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
-                                            save_path, os.path.join(self.opt['remote_path'], 'training_state', save_filename))
+        if upload is not None:
+            upload()
 
     def stash_optimizers(self):
         """
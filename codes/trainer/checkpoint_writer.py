@@ -0,0 +1,183 @@
+import atexit
+import copy
+import itertools
+import os
+import queue
+import threading
+import time
+
+import torch
+
+
+def _fsync_dir(path):
+    # Makes a rename durable. Not possible (or necessary) on every platform.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_torch_save(obj, path):
+    """ torch.save()s obj to a temporary file next to path, fsyncs it and renames it over path. """
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints from a background thread so that the training loop only pays for a device->host snapshot.
+
+    submit() copies every tensor in a (possibly nested) state dict into CPU buffers, which are pinned when CUDA is
+    available so that the copies are asynchronous. Buffers are reused across checkpoints with the same label. The
+    snapshot is then handed to a worker thread, which waits for the copies, writes each destination with
+    atomic_torch_save() and finally runs any post-write callbacks (e.g. uploads). Jobs, including those added with
+    submit_task(), run strictly in submission order.
+
+    Errors raised by the worker are re-raised on the training thread by the next call to submit() or wait(), unless the
+    failed write was submitted with an on_error callback.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.label_done = {}
+        self.error = None
+        self.queued_bytes = 0
+        self.last_snapshot_seconds = 0
+        self.last_write_seconds = 0
+        self.last_save_latency_seconds = 0
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.wait)
+
+    def _snapshot(self, obj, buffers, it):
+        if isinstance(obj, torch.Tensor):
+            i = next(it)
+            if i < len(buffers) and buffers[i].shape == obj.shape and buffers[i].dtype == obj.dtype:
+                buf = buffers[i]
+            else:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                if i < len(buffers):
+                    buffers[i] = buf
+                else:
+                    buffers.append(buf)
+            buf.copy_(obj.detach(), non_blocking=obj.is_cuda)
+            return buf
+        elif isinstance(obj, dict):
+            # A shallow copy keeps the dict subclass (Counter, defaultdict, OrderedDict...) and any attributes such as
+            # the _metadata that state_dict() records for load_state_dict(). The values are then replaced in place;
+            # dict.__setitem__ bypasses overrides like Counter's that would not store the value as given.
+            snapshot = copy.copy(obj)
+            for k, v in obj.items():
+                dict.__setitem__(snapshot, k, self._snapshot(v, buffers, it))
+            return snapshot
+        elif isinstance(obj, tuple) and hasattr(type(obj), '_make'):
+            return type(obj)._make(self._snapshot(v, buffers, it) for v in obj)
+        elif isinstance(obj, tuple):
+            return tuple(self._snapshot(v, buffers, it) for v in obj)
+        elif isinstance(obj, list):
+            return [self._snapshot(v, buffers, it) for v in obj]
+        return obj
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Asynchronous checkpoint write failed') from error
+
+    def submit(self, label, obj, paths, post_write=None, on_error=None):
+        """
+        Snapshots obj and queues it to be written to each of paths. post_write() is called on the worker thread once
+        all paths are written. If on_error is given, a failure of the write or of post_write() is passed to
+        on_error(exception) on the worker thread instead of being re-raised later. Blocks only if the previous
+        checkpoint with the same label is still being written, since its buffers are about to be reused.
+        """
+        self._raise_error()
+        start = time.perf_counter()
+        if label in self.label_done:
+            self.label_done[label].wait()
+        buffers = self.buffers.setdefault(label, [])
+        counter = itertools.count()
+        snapshot = self._snapshot(obj, buffers, counter)
+        del buffers[next(counter):]
+        copied = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            copied = torch.cuda.Event()
+            copied.record()
+        nbytes = sum(t.numel() * t.element_size() for t in _tensors(snapshot))
+        done = threading.Event()
+        self.label_done[label] = done
+        with self.lock:
+            self.queued_bytes += nbytes
+        self.queue.put((self._write, (snapshot, paths, copied, post_write, on_error, nbytes, start), done))
+        self.last_snapshot_seconds = time.perf_counter() - start
+
+    def submit_task(self, fn):
+        """ Runs fn on the worker thread after every previously submitted write has completed. """
+        self._raise_error()
+        self.queue.put((fn, (), None))
+
+    def _write(self, snapshot, paths, copied, post_write, on_error, nbytes, submitted):
+        start = time.perf_counter()
+        try:
+            if copied is not None:
+                copied.synchronize()
+            for path in paths:
+                atomic_torch_save(snapshot, path)
+            if post_write is not None:
+                post_write()
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(e)
+        finally:
+            with self.lock:
+                self.queued_bytes -= nbytes
+            self.last_write_seconds = time.perf_counter() - start
+            self.last_save_latency_seconds = time.perf_counter() - submitted
+
+    def _run(self):
+        while True:
+            fn, args, done = self.queue.get()
+            try:
+                fn(*args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                if done is not None:
+                    done.set()
+                self.queue.task_done()
+
+    def wait(self):
+        """ Blocks until every queued checkpoint has been written. """
+        self.queue.join()
+        self._raise_error()
+
+    def get_metrics(self):
+        return {
+            'checkpoint_snapshot_seconds': self.last_snapshot_seconds,
+            'checkpoint_write_seconds': self.last_write_seconds,
+            'checkpoint_save_latency_seconds': self.last_save_latency_seconds,
+            'checkpoint_queued_bytes': self.queued_bytes,
+        }
+
+
+def _tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            yield from _tensors(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            yield from _tensors(v)
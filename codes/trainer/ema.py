@@ -0,0 +1,93 @@
+import torch
+
+
+def _foreach_lerp_(ema_params, new_params, rate):
+    # ema = ema * rate + new * (1 - rate), as one multi-tensor kernel launch per op rather than one per parameter.
+    torch._foreach_mul_(ema_params, rate)
+    torch._foreach_add_(ema_params, new_params, alpha=1 - rate)
+
+
+class EmaUpdater:
+    """
+    Updates the EMA copy of a network after optimizer steps.
+
+    When the EMA lives on the same device as the network, the update is a pair of fused multi-tensor ops over all
+    parameters.
+
+    When the EMA lives on the CPU (ema_on_cpu), every `cpu_interval` steps the network parameters are copied into a
+    single flattened pinned staging buffer on a side CUDA stream. The copy is not waited on: it runs concurrently with
+    the next forward/backward pass and is folded into the CPU EMA the next time it has completed. The only
+    synchronization is a device-side wait which stops the next optimizer step from overwriting parameters that are still
+    being copied.
+    """
+    def __init__(self, net, ema, rate, on_cpu=False, cpu_interval=10):
+        self.net = net
+        self.ema = ema
+        self.rate = rate
+        self.on_cpu = on_cpu
+        self.cpu_interval = cpu_interval
+        self.ema_params = [p.detach() for p in ema.parameters()]
+        self.net_params = [p.detach() for p in net.parameters()]
+        assert len(self.ema_params) == len(self.net_params)
+
+        self.async_copy = on_cpu and len(self.net_params) > 0 and self.net_params[0].is_cuda
+        self.pending_event = None
+        if self.async_copy:
+            self.copy_stream = torch.cuda.Stream(device=self.net_params[0].device)
+            # One flat pinned buffer per dtype, with views for each parameter.
+            self.staging = {}
+            sizes = {}
+            for p in self.net_params:
+                sizes[p.dtype] = sizes.get(p.dtype, 0) + p.numel()
+            for dtype, size in sizes.items():
+                self.staging[dtype] = torch.empty((size,), dtype=dtype, pin_memory=True)
+            offsets = {dtype: 0 for dtype in sizes.keys()}
+            self.staging_views = []
+            for p in self.net_params:
+                o = offsets[p.dtype]
+                self.staging_views.append(self.staging[p.dtype][o:o+p.numel()].view(p.shape))
+                offsets[p.dtype] = o + p.numel()
+
+    def is_for(self, net, ema):
+        return self.net is net and self.ema is ema
+
+    def _interval_rate(self):
+        # Compensates for only updating every cpu_interval steps.
+        ema_rate = self.rate ** self.cpu_interval
+        new_rate = 1 - self.rate
+        mid = (1 - (ema_rate + new_rate)) / 2
+        return ema_rate + mid
+
+    def before_optimizer_step(self):
+        """ Must be called before the network's optimizer steps. Does not block the host. """
+        if self.pending_event is not None:
+            torch.cuda.current_stream(self.net_params[0].device).wait_event(self.pending_event)
+
+    def flush(self):
+        """ Folds any in-flight parameter copy into the EMA, blocking if necessary. Call before reading the EMA. """
+        if self.pending_event is not None:
+            self.pending_event.synchronize()
+            _foreach_lerp_(self.ema_params, self.staging_views, self._interval_rate())
+            self.pending_event = None
+
+    def update(self, it):
+        if not self.on_cpu:
+            _foreach_lerp_(self.ema_params, self.net_params, self.rate)
+            return
+
+        if self.pending_event is not None and self.pending_event.query():
+            self.flush()
+        if it % self.cpu_interval != 0:
+            return
+        if not self.async_copy:
+            _foreach_lerp_(self.ema_params, [p.cpu() for p in self.net_params], self._interval_rate())
+            return
+        # The previous copy must be folded in before its staging buffer is reused.
+        self.flush()
+        main_stream = torch.cuda.current_stream(self.net_params[0].device)
+        self.copy_stream.wait_stream(main_stream)
+        with torch.cuda.stream(self.copy_stream):
+            for view, p in zip(self.staging_views, self.net_params):
+                view.copy_(p, non_blocking=True)
+            self.pending_event = torch.cuda.Event()
+            self.pending_event.record(self.copy_stream)
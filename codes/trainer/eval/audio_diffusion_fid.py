@@ -1,3 +1,4 @@
+import hashlib
 import os
 import os.path as osp
 import random
@@ -19,10 +20,14 @@ from data.audio.voice_tokenizer import VoiceBpeTokenizer
 from models.clip.mel_text_clip import MelTextCLIP
 from models.audio.tts.tacotron2 import text_to_sequence
 from scripts.audio.gen.speech_synthesis_utils import load_discrete_vocoder_diffuser, wav_to_mel, load_speech_dvae, \
-    convert_mel_to_codes, load_univnet_vocoder, wav_to_univnet_mel, load_clvp
+    convert_mel_to_codes, load_univnet_vocoder, wav_to_univnet_mel, load_clvp, get_mel_frontend
+from trainer.checkpoint_writer import atomic_torch_save
 from trainer.injectors.audio_injectors import denormalize_mel, TorchMelSpectrogramInjector, normalize_mel
 from utils.util import ceil_multiple, opt_get, load_model_from_config, pad_or_truncate
 
+PROJECTOR_WEIGHTS = '../experiments/clip_text_to_voice_for_speech_fid.pth'
+W2V_MODEL = 'jbetker/wav2vec2-large-robust-ft-libritts-voxpopuli'
+
 
 class AudioDiffusionFid(evaluator.Evaluator):
     """
@@ -30,6 +35,12 @@ class AudioDiffusionFid(evaluator.Evaluator):
 
     This evaluator is kind of a mess. It has been repeatedly modified to work with several different model types, which
     means it is bloated beyond belief. I would not recommend attempting to understand what is going on here.
+
+    The reference side of the evaluation (projections of the real samples, their mean and covariance and their wav2vec2
+    CTC losses) does not depend on the model, so it is computed during the first eval and cached under
+    `reference_cache_dir`, keyed by the contents of the eval TSV and the projector weights. The projector and wav2vec2
+    are loaded once and stay in memory between evals. Samples are generated `batch_size` at a time; clips in a batch are
+    zero-padded to a common length, so only batch_size=1 (the default) generates each clip exactly as it is.
     """
     def __init__(self, model, opt_eval, env):
         super().__init__(model, opt_eval, env, uses_all_ddp=True)
@@ -58,9 +69,21 @@ class AudioDiffusionFid(evaluator.Evaluator):
         self.diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_steps, schedule=diffusion_schedule,
                                                        enable_conditioning_free_guidance=conditioning_free_diffusion_enabled,
                                                        conditioning_free_k=conditioning_free_k)
+        # 'p_sample', 'ddim', 'dpm++' or 'unipc'.
+        self.sample_fn = self.diffuser.sample_loop_fn(opt_get(opt_eval, ['sampler'], 'p_sample'),
+                                                      order=opt_get(opt_eval, ['solver_order'], 2))
         self.bpe_tokenizer = VoiceBpeTokenizer('../experiments/bpe_lowercase_asr_256.json')
         self.dev = self.env['device']
         mode = opt_get(opt_eval, ['diffusion_type'], 'tts')
+        self.mode = mode
+        self.batch_size = opt_get(opt_eval, ['batch_size'], 1)
+        # When False, the eval models stay on the device between evals instead of being moved back to the CPU.
+        self.offload_models = opt_get(opt_eval, ['offload_models'], True)
+        self.reference_cache_dir = opt_get(opt_eval, ['reference_cache_dir'],
+                                           osp.join(self.env['base_path'], '../', 'audio_eval', 'reference'))
+        self.reference = None
+        self.projector = None
+        self.w2v = None
         self.local_modules = {}
         if mode == 'tts':
             self.diffusion_fn = self.perform_diffusion_tts
@@ -71,14 +94,14 @@ class AudioDiffusionFid(evaluator.Evaluator):
             self.local_modules['dvae'] = load_speech_dvae().cpu()
             self.diffusion_fn = self.perform_diffusion_vocoder
         elif mode == 'ctc_to_mel':
-            self.diffusion_fn = self.perform_diffusion_ctc
+            self.diffusion_fn = self.prepare_diffusion_ctc
             self.local_modules['vocoder'] = load_univnet_vocoder().cpu()
             self.local_modules['clvp'] = load_clvp()
         elif 'tts9_mel' in mode:
             mel_means, self.mel_max, self.mel_min, mel_stds, mel_vars = torch.load('../experiments/univnet_mel_norms.pth')
             self.local_modules['dvae'] = load_speech_dvae().cpu()
             self.local_modules['vocoder'] = load_univnet_vocoder().cpu()
-            self.diffusion_fn = self.perform_diffusion_tts9_mel_from_codes
+            self.diffusion_fn = self.prepare_diffusion_tts9_mel_from_codes
             if mode == 'tts9_mel_autoin':
                 self.local_modules['autoregressive'] = load_model_from_config("../experiments/train_gpt_tts_unified.yml",
                                                                               model_name='gpt',
@@ -89,7 +112,7 @@ class AudioDiffusionFid(evaluator.Evaluator):
             else:
                 self.tts9_codegen = self.tts9_get_dvae_codes
         elif 'tfd' == mode:
-            self.diffusion_fn = self.perform_diffusion_tfd
+            self.diffusion_fn = self.prepare_diffusion_tfd
             self.local_modules['vocoder'] = load_univnet_vocoder().cpu()
         elif 'tfd_ar' == mode:
             self.local_modules['dvae'] = load_speech_dvae().cpu()
@@ -98,7 +121,7 @@ class AudioDiffusionFid(evaluator.Evaluator):
                                                                           also_load_savepoint=False,
                                                                           load_path='../experiments/tortoise_ar.pth',
                                                                           device=torch.device('cpu')).cuda().eval()
-            self.diffusion_fn = self.perform_diffusion_tfd_ar_prior
+            self.diffusion_fn = self.prepare_diffusion_tfd_ar_prior
             self.local_modules['vocoder'] = load_univnet_vocoder().cpu()
 
     def perform_diffusion_tts(self, audio, codes, text, sample_rate=5500):
@@ -111,9 +134,9 @@ class AudioDiffusionFid(evaluator.Evaluator):
         if padding_needed_for_codes > 0:
             codes = F.pad(codes, (0, padding_needed_for_codes))
         output_shape = (1, 1, padded_size)
-        gen = self.diffuser.p_sample_loop(self.model, output_shape,
-                                    model_kwargs={'tokens': codes.unsqueeze(0),
-                                                  'conditioning_input': real_resampled})
+        gen = self.sample_fn(self.model, output_shape,
+                             model_kwargs={'tokens': codes.unsqueeze(0),
+                                           'conditioning_input': real_resampled})
         return gen, real_resampled, sample_rate
 
     def perform_original_diffusion_vocoder(self, audio, codes, text, sample_rate=11025):
@@ -131,9 +154,9 @@ class AudioDiffusionFid(evaluator.Evaluator):
         if padding_needed_for_codes > 0:
             back_to_mel = F.pad(back_to_mel, (0, padding_needed_for_codes))
         output_shape = (1, 1, padded_size)
-        gen = self.diffuser.p_sample_loop(self.model, output_shape,
-                                    model_kwargs={'spectrogram': back_to_mel,
-                                                  'conditioning_input': orig_audio.unsqueeze(0)})
+        gen = self.sample_fn(self.model, output_shape,
+                             model_kwargs={'spectrogram': back_to_mel,
+                                           'conditioning_input': orig_audio.unsqueeze(0)})
 
         # Pop it back down to 5.5kHz for an accurate comparison with the other diffusers.
         real_resampled = torchaudio.functional.resample(real_resampled.squeeze(0), sample_rate, 5500).unsqueeze(0)
@@ -155,10 +178,10 @@ class AudioDiffusionFid(evaluator.Evaluator):
         if padding_needed_for_codes > 0:
             mel_codes = F.pad(mel_codes, (0, padding_needed_for_codes))
         output_shape = (1, 1, padded_size)
-        gen = self.diffuser.p_sample_loop(self.model, output_shape,
-                                    model_kwargs={'tokens': mel_codes,
-                                                  'conditioning_input': audio.unsqueeze(0),
-                                                  'unaligned_input': torch.tensor(text_codes, device=audio.device).unsqueeze(0)})
+        gen = self.sample_fn(self.model, output_shape,
+                             model_kwargs={'tokens': mel_codes,
+                                           'conditioning_input': audio.unsqueeze(0),
+                                           'unaligned_input': torch.tensor(text_codes, device=audio.device).unsqueeze(0)})
         return gen, real_resampled, sample_rate
 
     def tts9_get_autoregressive_codes(self, mel, text):
@@ -176,58 +199,43 @@ class AudioDiffusionFid(evaluator.Evaluator):
     def tts9_get_dvae_codes(self, mel, text):
         return convert_mel_to_codes(self.local_modules['dvae'], mel)
 
-    def perform_diffusion_tts9_mel_from_codes(self, audio, codes, text):
+    # The prepare_diffusion_* functions below set up the diffusion of a single clip for the MEL-producing modes. Each
+    # returns (output_shape, model_kwargs, ref_mel, ref_vocoder_input), where ref_vocoder_input is what the vocoder
+    # decodes into the reference sample. Generated MELs are always denormalized before vocoding.
+
+    def prepare_diffusion_tts9_mel_from_codes(self, audio, codes, text):
         SAMPLE_RATE = 24000
         mel = wav_to_mel(audio)
         mel_codes = self.tts9_codegen(mel, text)
         real_resampled = torchaudio.functional.resample(audio, 22050, SAMPLE_RATE).unsqueeze(0)
         univnet_mel = wav_to_univnet_mel(real_resampled, do_normalization=False)  # to be used for a conditioning input, but also guides output shape.
-        output_shape = univnet_mel.shape
-        gen_mel = self.diffuser.p_sample_loop(self.model, output_shape,
-                                    model_kwargs={'aligned_conditioning': mel_codes,
-                                                  'conditioning_input': univnet_mel})
-        # denormalize mel
-        gen_mel = denormalize_mel(gen_mel)
-
-        gen_wav = self.local_modules['vocoder'].inference(gen_mel)
-        real_dec = self.local_modules['vocoder'].inference(univnet_mel)
-        return gen_wav.float(), real_dec, gen_mel, univnet_mel, SAMPLE_RATE
-
-    def perform_diffusion_ctc(self, audio, codes, text):
+        return univnet_mel.shape, {'aligned_conditioning': mel_codes, 'conditioning_input': univnet_mel}, \
+            univnet_mel, univnet_mel
+
+    def prepare_diffusion_ctc(self, audio, codes, text):
         SAMPLE_RATE = 24000
         text_codes = torch.LongTensor(self.bpe_tokenizer.encode(text)).unsqueeze(0).to(audio.device)
         clvp_latent = self.local_modules['clvp'].embed_text(text_codes)
 
         real_resampled = torchaudio.functional.resample(audio, 22050, SAMPLE_RATE).unsqueeze(0)
         univnet_mel = wav_to_univnet_mel(real_resampled, do_normalization=True)
-        output_shape = univnet_mel.shape
-        cond_mel = TorchMelSpectrogramInjector({'n_mel_channels': 100, 'mel_fmax': 11000, 'filter_length': 8000, 'normalize': True,
-                                                'true_normalization': True, 'in': 'in', 'out': 'out'}, {})({'in': audio})['out']
-
-        gen_mel = self.diffuser.p_sample_loop(self.model, output_shape, model_kwargs={'codes': codes.unsqueeze(0),
-                                                  'conditioning_input': cond_mel, 'type': torch.tensor([0], device=codes.device),
-                                                  'clvp_input': clvp_latent})
-        gen_mel_denorm = denormalize_mel(gen_mel)
-
-        gen_wav = self.local_modules['vocoder'].inference(gen_mel_denorm)
-        real_dec = self.local_modules['vocoder'].inference(denormalize_mel(univnet_mel))
-        return gen_wav.float(), real_dec, gen_mel, univnet_mel, SAMPLE_RATE
-
-    def perform_diffusion_tfd(self, audio, codes, text):
+        cond_mel = get_mel_frontend(TorchMelSpectrogramInjector, {'n_mel_channels': 100, 'mel_fmax': 11000,
+                                                                  'filter_length': 8000, 'normalize': True,
+                                                                  'true_normalization': True, 'in': 'in', 'out': 'out'},
+                                    audio.device)({'in': audio})['out']
+        return univnet_mel.shape, {'codes': codes.unsqueeze(0), 'conditioning_input': cond_mel,
+                                   'type': torch.tensor([0], device=codes.device), 'clvp_input': clvp_latent}, \
+            univnet_mel, denormalize_mel(univnet_mel)
+
+    def prepare_diffusion_tfd(self, audio, codes, text):
         SAMPLE_RATE = 24000
         audio_resampled = torchaudio.functional.resample(audio, 22050, SAMPLE_RATE).unsqueeze(0)
         vmel = wav_to_mel(audio)
         umel = wav_to_univnet_mel(audio_resampled, do_normalization=True)
-        gen_mel = self.diffuser.p_sample_loop(self.model, umel.shape,
-                                              model_kwargs={'truth_mel': vmel,
-                                                            'conditioning_input': None,
-                                                            'disable_diversity': True})
-
-        gen_wav = self.local_modules['vocoder'].inference(denormalize_mel(gen_mel))
-        real_dec = self.local_modules['vocoder'].inference(denormalize_mel(umel))
-        return gen_wav.float(), real_dec, gen_mel, umel, SAMPLE_RATE
+        return umel.shape, {'truth_mel': vmel, 'conditioning_input': None, 'disable_diversity': True}, \
+            umel, denormalize_mel(umel)
 
-    def perform_diffusion_tfd_ar_prior(self, audio, codes, text):
+    def prepare_diffusion_tfd_ar_prior(self, audio, codes, text):
         SAMPLE_RATE = 24000
         audio_resampled = torchaudio.functional.resample(audio, 22050, SAMPLE_RATE).unsqueeze(0)
         vmel = wav_to_mel(audio)
@@ -242,13 +250,31 @@ class AudioDiffusionFid(evaluator.Evaluator):
                                                                     mel_codes,
                                                                     torch.tensor([mel_codes.shape[-1]*mlc], device=vmel.device),
                                                                     text_first=True, raw_mels=None, return_latent=True)
+        return umel.shape, {'codes': auto_latents}, umel, denormalize_mel(umel)
 
-        gen_mel = self.diffuser.p_sample_loop(self.model, umel.shape,
-                                              model_kwargs={'codes': auto_latents})
-
-        gen_wav = self.local_modules['vocoder'].inference(denormalize_mel(gen_mel))
-        real_dec = self.local_modules['vocoder'].inference(denormalize_mel(umel))
-        return gen_wav.float(), real_dec, gen_mel, umel, SAMPLE_RATE
+    def sample_batch(self, output_shapes, model_kwargs):
+        """
+        Runs p_sample_loop once for a batch of clips. Every tensor input (and the output) is zero-padded at the end of
+        each dimension to the largest size in the batch; outputs are trimmed back to each clip's own output_shape.
+        """
+        def pad_to(t, shape):
+            pad = []
+            for have, want in zip(reversed(t.shape), reversed(shape)):
+                pad.extend([0, want - have])
+            return F.pad(t, pad)
+
+        batch_kwargs = {}
+        for k, first in model_kwargs[0].items():
+            values = [kw[k] for kw in model_kwargs]
+            if isinstance(first, torch.Tensor):
+                shape = [max(dims) for dims in zip(*[v.shape for v in values])]
+                batch_kwargs[k] = torch.cat([pad_to(v, shape) for v in values], dim=0)
+            else:
+                assert all(v == first for v in values), f'Cannot batch differing values of non-tensor input {k}'
+                batch_kwargs[k] = first
+        shape = [len(output_shapes)] + [max(dims) for dims in zip(*[s[1:] for s in output_shapes])]
+        gen = self.sample_fn(self.model, shape, model_kwargs=batch_kwargs)
+        return [gen[(slice(i, i+1),) + tuple(slice(0, d) for d in s[1:])] for i, s in enumerate(output_shapes)]
 
     def load_projector(self):
         """
@@ -258,7 +284,7 @@ class AudioDiffusionFid(evaluator.Evaluator):
         model = MelTextCLIP(dim_text=512, dim_latent=512, dim_speech=512, num_text_tokens=148, text_enc_depth=8,
                             text_seq_len=400, text_heads=8, speech_enc_depth=10, speech_heads=8, speech_seq_len=1000,
                             text_mask_percentage=.15, voice_mask_percentage=.15)
-        weights = torch.load('../experiments/clip_text_to_voice_for_speech_fid.pth')
+        weights = torch.load(PROJECTOR_WEIGHTS)
         model.load_state_dict(weights)
         return model
 
@@ -268,44 +294,75 @@ class AudioDiffusionFid(evaluator.Evaluator):
         return projector.get_speech_projection(mel).squeeze(0)  # Getting rid of the batch dimension means it's just [hidden_dim]
 
     def load_w2v(self):
-        return Wav2Vec2ForCTC.from_pretrained("jbetker/wav2vec2-large-robust-ft-libritts-voxpopuli")
+        return Wav2Vec2ForCTC.from_pretrained(W2V_MODEL)
+
+    def ctc_loss(self, w2v, sample, sample_rate, real_text):
+        """ Measures the wav2vec2 CTC loss of sample against the real text. """
+        text_codes = torch.tensor(text_to_sequence(real_text), device=sample.device)
+        s = torchaudio.functional.resample(sample, sample_rate, 16000)
+        norm_s = (s - s.mean()) / torch.sqrt(s.var() + 1e-7)
+        norm_s = norm_s.squeeze(1)
+        return w2v(input_values=norm_s, labels=text_codes).loss
 
     def intelligibility_loss(self, w2v, sample, real_sample, sample_rate, real_text):
         """
         Measures the differences between CTC losses using wav2vec2 against the real sample and the generated sample.
         """
-        text_codes = torch.tensor(text_to_sequence(real_text), device=sample.device)
-        results = []
-        for s in [sample, real_sample]:
-            s = torchaudio.functional.resample(s, sample_rate, 16000)
-            norm_s = (s - s.mean()) / torch.sqrt(s.var() + 1e-7)
-            norm_s = norm_s.squeeze(1)
-            loss = w2v(input_values=norm_s, labels=text_codes).loss
-            results.append(loss)
-        gen_loss, real_loss = results
-        return gen_loss - real_loss
-
-    def compute_frechet_distance(self, proj1, proj2):
+        return self.ctc_loss(w2v, sample, sample_rate, real_text) - self.ctc_loss(w2v, real_sample, sample_rate, real_text)
+
+    def compute_statistics(self, proj):
+        proj = proj.cpu().numpy()
+        return np.mean(proj, axis=0), np.cov(proj, rowvar=False)
+
+    def compute_frechet_distance(self, proj1, proj2, stats2=None):
         # I really REALLY FUCKING HATE that this is going to numpy. Why does "pytorch_fid" operate in numpy land. WHY?
-        proj1 = proj1.cpu().numpy()
-        proj2 = proj2.cpu().numpy()
-        mu1 = np.mean(proj1, axis=0)
-        mu2 = np.mean(proj2, axis=0)
-        sigma1 = np.cov(proj1, rowvar=False)
-        sigma2 = np.cov(proj2, rowvar=False)
+        mu1, sigma1 = self.compute_statistics(proj1)
+        mu2, sigma2 = self.compute_statistics(proj2) if stats2 is None else stats2
         return torch.tensor(calculate_frechet_distance(mu1, sigma1, mu2, sigma2))
 
+    def reference_cache_path(self):
+        """
+        The reference statistics depend on the eval TSV, the projector weights and which clips this rank evaluates.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        for path in [self.real_path, PROJECTOR_WEIGHTS]:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        h.update(repr((self.mode, W2V_MODEL, len(self.data), self.skip, self.env['rank'])).encode())
+        return osp.join(self.reference_cache_dir, f'{h.hexdigest()}.pth')
+
+    def load_reference(self):
+        if self.reference is None:
+            path = self.reference_cache_path()
+            if osp.exists(path):
+                self.reference = torch.load(path)
+                self.reference['path'] = path
+            else:
+                self.reference = {'path': path}
+        return self.reference if 'projections' in self.reference else None
+
+    def save_reference(self, projections, ctc_losses):
+        mu, sigma = self.compute_statistics(projections)
+        reference = {'projections': projections, 'mu': torch.from_numpy(mu), 'sigma': torch.from_numpy(sigma),
+                     'ctc_losses': ctc_losses}
+        os.makedirs(self.reference_cache_dir, exist_ok=True)
+        atomic_torch_save(reference, self.reference['path'])
+        self.reference.update(reference)
+
     def perform_eval(self):
+        assert self.diffusion_fn.__name__.startswith('prepare_'), f'diffusion_type {self.mode} cannot be evaluated.'
         save_path = osp.join(self.env['base_path'], "../", "audio_eval", str(self.env["step"]))
         os.makedirs(save_path, exist_ok=True)
 
-        projector = self.load_projector().to(self.env['device'])
-        projector.eval()
-
-        w2v = self.load_w2v().to(self.env['device'])
-        w2v.eval()
+        if self.projector is None:
+            self.projector = self.load_projector().eval()
+            self.w2v = self.load_w2v().eval()
+        projector = self.projector = self.projector.to(self.env['device'])
+        w2v = self.w2v = self.w2v.to(self.env['device'])
         for k, mod in self.local_modules.items():
             self.local_modules[k] = mod.to(self.env['device'])
+        reference = self.load_reference()
 
         # Attempt to fix the random state as much as possible. RNG state will be restored before returning.
         rng_state = torch.get_rng_state()
@@ -315,25 +372,42 @@ class AudioDiffusionFid(evaluator.Evaluator):
         with torch.no_grad():
             gen_projections = []
             real_projections = []
-            intelligibility_losses = []
-            for i in tqdm(list(range(0, len(self.data), self.skip))):
-                path, text, codes = self.data[(i + self.env['rank']) % len(self.data)]
-                audio = load_audio(path, 22050).to(self.dev)
-                codes = codes.to(self.dev)
-                sample, ref, gen_mel, ref_mel, sample_rate = self.diffusion_fn(audio, codes, text)
-
-                gen_projections.append(self.project(projector, sample, sample_rate).cpu())  # Store on CPU to avoid wasting GPU memory.
-                real_projections.append(self.project(projector, ref, sample_rate).cpu())
-                intelligibility_losses.append(self.intelligibility_loss(w2v, sample, ref, sample_rate, text))
-
-                torchvision.utils.save_image((gen_mel.unsqueeze(1) + 1) / 2, os.path.join(save_path, f'{self.env["rank"]}_{i}_mel.png'))
-                torchvision.utils.save_image((ref_mel.unsqueeze(1) + 1) / 2, os.path.join(save_path, f'{self.env["rank"]}_{i}_mel_target.png'))
-                torchaudio.save(os.path.join(save_path, f"{self.env['rank']}_{i}_gen.wav"), sample.squeeze(0).cpu(), sample_rate)
-                torchaudio.save(os.path.join(save_path, f"{self.env['rank']}_{i}_real.wav"), ref.squeeze(0).cpu(), sample_rate)
+            gen_losses = []
+            real_losses = []
+            indices = list(range(0, len(self.data), self.skip))
+            for b in tqdm(list(range(0, len(indices), self.batch_size))):
+                batch = []
+                for i in indices[b:b+self.batch_size]:
+                    path, text, codes = self.data[(i + self.env['rank']) % len(self.data)]
+                    audio = load_audio(path, 22050).to(self.dev)
+                    codes = codes.to(self.dev)
+                    batch.append((i, text, *self.diffusion_fn(audio, codes, text)))
+                sample_rate = 24000
+                gen_mels = self.sample_batch([p[2] for p in batch], [p[3] for p in batch])
+
+                for (i, text, _, _, ref_mel, ref_vocoder_input), gen_mel in zip(batch, gen_mels):
+                    sample = self.local_modules['vocoder'].inference(denormalize_mel(gen_mel)).float()
+                    gen_projections.append(self.project(projector, sample, sample_rate).cpu())  # Store on CPU to avoid wasting GPU memory.
+                    gen_losses.append(self.ctc_loss(w2v, sample, sample_rate, text).cpu())
+                    torchvision.utils.save_image((gen_mel.unsqueeze(1) + 1) / 2, os.path.join(save_path, f'{self.env["rank"]}_{i}_mel.png'))
+                    torchaudio.save(os.path.join(save_path, f"{self.env['rank']}_{i}_gen.wav"), sample.squeeze(0).cpu(), sample_rate)
+
+                    if reference is None:
+                        # Real samples are only decoded and saved by the eval which builds the reference cache.
+                        ref = self.local_modules['vocoder'].inference(ref_vocoder_input)
+                        real_projections.append(self.project(projector, ref, sample_rate).cpu())
+                        real_losses.append(self.ctc_loss(w2v, ref, sample_rate, text).cpu())
+                        torchvision.utils.save_image((ref_mel.unsqueeze(1) + 1) / 2, os.path.join(save_path, f'{self.env["rank"]}_{i}_mel_target.png'))
+                        torchaudio.save(os.path.join(save_path, f"{self.env['rank']}_{i}_real.wav"), ref.squeeze(0).cpu(), sample_rate)
+            if reference is None:
+                self.save_reference(torch.stack(real_projections, dim=0), torch.stack(real_losses, dim=0))
+                reference = self.reference
             gen_projections = torch.stack(gen_projections, dim=0)
-            real_projections = torch.stack(real_projections, dim=0)
-            intelligibility_loss = torch.stack(intelligibility_losses, dim=0).mean()
-            frechet_distance = torch.tensor(self.compute_frechet_distance(gen_projections, real_projections), device=self.env['device'])
+            # The mean of the per-sample loss differences, as computed by intelligibility_loss().
+            intelligibility_loss = (torch.stack(gen_losses, dim=0).mean() - reference['ctc_losses'].mean()).to(self.env['device'])
+            frechet_distance = torch.tensor(self.compute_frechet_distance(gen_projections, reference['projections'],
+                                                                          (reference['mu'].numpy(), reference['sigma'].numpy())),
+                                            device=self.env['device'])
 
             if distributed.is_initialized() and distributed.get_world_size() > 1:
                 distributed.all_reduce(frechet_distance)
@@ -345,8 +419,11 @@ class AudioDiffusionFid(evaluator.Evaluator):
         torch.set_rng_state(rng_state)
 
         # Put modules used for evaluation back into CPU memory.
-        for k, mod in self.local_modules.items():
-            self.local_modules[k] = mod.cpu()
+        if self.offload_models:
+            self.projector = self.projector.cpu()
+            self.w2v = self.w2v.cpu()
+            for k, mod in self.local_modules.items():
+                self.local_modules[k] = mod.cpu()
 
         return {"frechet_distance": frechet_distance, "intelligibility_loss": intelligibility_loss}
 
@@ -34,6 +34,8 @@ class MusicDiffusionFid(evaluator.Evaluator):
         self.data = self.load_data(self.real_path)
         self.clip = opt_get(opt_eval, ['clip_audio'], True)  # Recommend setting true for more efficient eval passes.
         self.ddim = opt_get(opt_eval, ['use_ddim'], False)
+        explicit_sampler = opt_get(opt_eval, ['sampler'], None)  # 'p_sample', 'ddim', 'dpm++' or 'unipc'
+        sampler = explicit_sampler or ('ddim' if self.ddim else 'p_sample')
         self.causal = opt_get(opt_eval, ['causal'], False)
         self.causal_slope = opt_get(opt_eval, ['causal_slope'], 1)
         if distributed.is_initialized() and distributed.get_world_size() > 1:
@@ -50,6 +52,10 @@ class MusicDiffusionFid(evaluator.Evaluator):
         self.diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [diffusion_steps]), model_mean_type='epsilon',
                            model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule(diffusion_schedule, 4000),
                            conditioning_free=conditioning_free_diffusion_enabled, conditioning_free_k=conditioning_free_k)
+        self.sample_fn = self.diffuser.sample_loop_fn(sampler, order=opt_get(opt_eval, ['solver_order'], 2))
+        # The spec_decode and from_codes modes have always used p_sample_loop, whatever use_ddim says. Keep that unless a
+        # sampler is explicitly configured, so that their FID stays comparable with earlier runs.
+        self.p_sample_fn = self.sample_fn if explicit_sampler is not None else self.diffuser.p_sample_loop
         self.spectral_diffuser = SpacedDiffusion(use_timesteps=space_timesteps(4000, [16 if self.ddim else 100]), model_mean_type='epsilon',
                            model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule('linear', 4000),
                            conditioning_free=False, conditioning_free_k=1)
@@ -101,8 +107,8 @@ class MusicDiffusionFid(evaluator.Evaluator):
         audio = audio.unsqueeze(0)
         output_shape = (1, self.squeeze_ratio, audio.shape[-1] // self.squeeze_ratio)
         mel = self.spec_fn({'in': audio})['out']
-        gen = self.diffuser.p_sample_loop(self.model, output_shape,
-                                          model_kwargs={'codes': mel})
+        gen = self.p_sample_fn(self.model, output_shape,
+                               model_kwargs={'codes': mel})
         gen = pixel_shuffle_1d(gen, self.squeeze_ratio)
 
         return gen, real_resampled, normalize_torch_mel(self.spec_fn({'in': gen})['out']), normalize_torch_mel(mel), sample_rate, 0
@@ -115,8 +121,8 @@ class MusicDiffusionFid(evaluator.Evaluator):
         codegen = self.local_modules['codegen'].to(mel.device)
         codes = codegen.get_codes(mel, project=True)
         mel_norm = normalize_torch_mel(mel)
-        gen_mel = self.diffuser.p_sample_loop(self.model, mel_norm.shape,
-                                              model_kwargs={'codes': codes, 'conditioning_input': torch.zeros_like(mel_norm[:,:,:390])})
+        gen_mel = self.p_sample_fn(self.model, mel_norm.shape,
+                                   model_kwargs={'codes': codes, 'conditioning_input': torch.zeros_like(mel_norm[:,:,:390])})
 
         gen_mel_denorm = denormalize_torch_mel(gen_mel)
         output_shape = (1,16,audio.shape[-1]//16)
@@ -140,7 +146,7 @@ class MusicDiffusionFid(evaluator.Evaluator):
         #perp = self.diffuser.p_sample_loop_for_log_perplexity(self.model, mel_norm,
         #                                                      model_kwargs = {'truth_mel': mel_norm})
 
-        sampler = self.diffuser.ddim_sample_loop if self.ddim else self.diffuser.p_sample_loop
+        sampler = self.sample_fn
         gen_mel = sampler(self.model, mel_norm.shape, model_kwargs={'truth_mel': mel_norm})
 
         gen_mel_denorm = denormalize_torch_mel(gen_mel)
@@ -165,7 +171,7 @@ class MusicDiffusionFid(evaluator.Evaluator):
         cheater = self.local_modules['cheater_encoder'].to(audio.device)(mel_norm)
 
         # 1. Generate the cheater latent using the input as a reference.
-        sampler = self.diffuser.ddim_sample_loop if self.ddim else self.diffuser.p_sample_loop
+        sampler = self.sample_fn
         # center-pad the conditioning input (the center isn't actually used). this is hack for giving tfdpc5 a bigger working context.
         cheater_padded = torch.cat([cheater[:,:,cheater.shape[-1]//2:], torch.zeros(1,256,160, device=cheater.device),  cheater[:,:,:cheater.shape[-1]//2]], dim=-1)
         gen_cheater = sampler(self.model, cheater.shape, progress=True,
@@ -200,7 +206,7 @@ class MusicDiffusionFid(evaluator.Evaluator):
         ar_latent = self.local_modules['ar_prior'].to(audio.device)(cheater_codes, cheater, return_latent=True)
 
         # 1. Generate the cheater latent using the input as a reference.
-        sampler = self.diffuser.ddim_sample_loop if self.ddim else self.diffuser.p_sample_loop
+        sampler = self.sample_fn
         gen_cheater = sampler(self.model, cheater.shape, progress=True,
                               causal=self.causal, causal_slope=self.causal_slope,
                               model_kwargs={'codes': ar_latent})
@@ -228,7 +234,7 @@ class MusicDiffusionFid(evaluator.Evaluator):
         conditioning = mel_norm[:,:,:1200]
         downsampled = F.interpolate(mel_norm, scale_factor=1/4, mode='nearest')
         stage1_shape = (1, 256, downsampled.shape[-1]*4)
-        sampler = self.diffuser.ddim_sample_loop if self.ddim else self.diffuser.p_sample_loop
+        sampler = self.sample_fn
         # (Eventually) Chain super-sampling using 2 stages.
         #stage1 = sampler(self.model, stage1_shape, model_kwargs={'resolution': torch.tensor([1], device=audio.device),
         #                                                         'x_prior': downsampled,
@@ -6,6 +6,8 @@ import sys
 
 import torch.nn
 
+from trainer.registry_index import RegistryIndex, scan_source
+
 
 # Base class for all other injectors.
 class Injector(torch.nn.Module):
@@ -30,26 +32,53 @@ def format_injector_name(name):
     return name.replace("_injector", "")
 
 
+_registered_injectors = {}
+
+
 # Works by loading all python modules in the injectors/ directory and sniffing out subclasses of Injector.
-# field will be properly populated.
+# field will be properly populated. Memoized per process.
 def find_registered_injectors(base_path="trainer/injectors"):
+    if base_path not in _registered_injectors:
+        _registered_injectors[base_path] = _scan_registered_injectors(base_path)
+    return _registered_injectors[base_path]
+
+
+def _is_injector_class(obj):
+    return inspect.isclass(obj) and 'Injector' in [mro.__name__ for mro in inspect.getmro(obj)]
+
+
+def _scan_registered_injectors(base_path):
     module_iter = pkgutil.walk_packages([base_path])
     results = {}
     for mod in module_iter:
         if mod.ispkg:
             EXCLUSION_LIST = []
             if mod.name not in EXCLUSION_LIST:
-                results.update(find_registered_injectors(f'{base_path}/{mod.name}'))
+                results.update(_scan_registered_injectors(f'{base_path}/{mod.name}'))
         else:
             mod_name = f'{base_path}/{mod.name}'.replace('/', '.')
             importlib.import_module(mod_name)
             classes = inspect.getmembers(sys.modules[mod_name], inspect.isclass)
             for name, obj in classes:
-                if 'Injector' in [mro.__name__ for mro in inspect.getmro(obj)]:
+                if _is_injector_class(obj):
                     results[format_injector_name(name)] = obj
     return results
 
 
+_injector_index = RegistryIndex('trainer/injectors', scan_source(r'^class (\w+)\s*[(:]', format_injector_name))
+
+
+# Like find_registered_injectors()[name], but only imports the module which defines the injector, as found by the
+# persistent registry index. Returns None if there is no such injector.
+def find_registered_injector(name):
+    for mod_name in _injector_index.candidates(name):
+        module = importlib.import_module(mod_name)
+        for cls_name, obj in inspect.getmembers(module, _is_injector_class):
+            if obj.__module__ == mod_name and format_injector_name(cls_name) == name:
+                return obj
+    return find_registered_injectors().get(name)
+
+
 class CreateInjectorError(Exception):
     def __init__(self, name, available):
         super().__init__(f'Could not find the specified injector name: {name}.  Available injectors:'
@@ -58,8 +87,8 @@ class CreateInjectorError(Exception):
 
 # Injectors are a way to synthesize data within a step that can then be used (and reused) by loss functions.
 def create_injector(opt_inject, env):
-    injectors = find_registered_injectors()
     type = opt_inject['type']
-    if type not in injectors.keys():
-        raise CreateInjectorError(type, list(injectors.keys()))
-    return injectors[opt_inject['type']](opt_inject, env)
+    injector = find_registered_injector(type)
+    if injector is None:
+        raise CreateInjectorError(type, list(find_registered_injectors().keys()))
+    return injector(opt_inject, env)
@@ -6,6 +6,7 @@ import torchaudio
 
 from models.audio.music.cheater_gen_ar import ConditioningAR
 from trainer.inject import Injector
+from utils.kmeans import kmeans_predict
 from utils.music_utils import get_music_codegen
 from utils.util import opt_get, load_model_from_config, pad_or_truncate
 
@@ -445,8 +446,9 @@ class KmeansQuantizerInjector(Injector):
     def __init__(self, opt, env):
         super().__init__(opt, env)
         _, self.centroids = torch.load(opt['centroids'])
-        k, b = self.centroids.shape
-        self.centroids = self.centroids.permute(1,0)
+        # Centroids of clusters which ended up empty are NaN; move them out of reach so that they are never chosen.
+        self.centroids[self.centroids.isnan().any(dim=-1)] = 1e6
+        self.chunk_size = opt_get(opt, ['chunk_size'], None)
 
     def forward(self, state):
         with torch.no_grad():
@@ -454,11 +456,8 @@ class KmeansQuantizerInjector(Injector):
             self.centroids = self.centroids.to(x.device)
             b, c, s = x.shape
             x = x.permute(0,2,1).reshape(b*s, c)
-            distances = x.pow(2).sum(1,keepdim=True) - 2 * x @ self.centroids + self.centroids.pow(2).sum(0, keepdim=True)
-            distances[distances.isnan()] = 9999999999
-            distances = distances.reshape(b, s, self.centroids.shape[-1])
-            labels = distances.argmin(-1)
-            return {self.output: labels}
+            labels = kmeans_predict(x, self.centroids, chunk_size=self.chunk_size)
+            return {self.output: labels.reshape(b, s)}
 
 
 class MusicCheaterArInjector(Injector):
@@ -133,18 +133,19 @@ class GaussianDiffusionInferenceInjector(Injector):
     def __init__(self, opt, env):
         super().__init__(opt, env)
         use_ddim = opt_get(opt, ['use_ddim'], False)
+        sampler = opt_get(opt, ['sampler'], 'ddim' if use_ddim else 'p_sample')  # 'p_sample', 'ddim', 'dpm++' or 'unipc'
         self.generator = opt['generator']
         self.output_batch_size = opt['output_batch_size']
         self.output_scale_factor = opt['output_scale_factor']
         self.undo_n1_to_1 = opt_get(opt, ['undo_n1_to_1'], False)  # Explanation: when specified, will shift the output of this injector from [-1,1] to [0,1]
         opt['diffusion_args']['betas'] = get_named_beta_schedule(**opt['beta_schedule'])
-        if use_ddim:
+        if sampler == 'ddim':
             spacing = "ddim" + str(opt['respaced_timestep_spacing'])
         else:
             spacing = [opt_get(opt, ['respaced_timestep_spacing'], opt['beta_schedule']['num_diffusion_timesteps'])]
         opt['diffusion_args']['use_timesteps'] = space_timesteps(opt['beta_schedule']['num_diffusion_timesteps'], spacing)
         self.diffusion = SpacedDiffusion(**opt['diffusion_args'])
-        self.sampling_fn = self.diffusion.ddim_sample_loop if use_ddim else self.diffusion.p_sample_loop
+        self.sampling_fn = self.diffusion.sample_loop_fn(sampler, order=opt_get(opt, ['solver_order'], 2))
         self.model_input_keys = opt_get(opt, ['model_input_keys'], [])
         self.use_ema_model = opt_get(opt, ['use_ema'], False)
         self.noise_style = opt_get(opt, ['noise_type'], 'random')  # 'zero', 'fixed' or 'random'
@@ -0,0 +1,398 @@
+import random
+from math import pi
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from kornia.enhance import adjust_brightness_accumulative, adjust_contrast_with_mean_subtraction, \
+    adjust_saturation_with_gray_subtraction, adjust_hue
+from torchvision.io import decode_jpeg, encode_jpeg
+
+from trainer.inject import Injector
+from utils.util import opt_get
+
+
+# Families of corruptions, checked in the same order (and by the same substring matching) as
+# ImageCorruptor.apply_corruption.
+CORRUPTION_FAMILIES = ['color_quantization', 'color_jitter', 'gaussian_blur', 'motion_blur', 'block_noise',
+                       'lq_resampling', 'color_shift', 'interlacing', 'chromatic_aberration', 'noise', 'jpeg',
+                       'saturation', 'greyscale', 'none']
+JPEG_QUALITY_RANGES = {'jpeg': (10, 20), 'jpeg-low': (15, 10), 'jpeg-medium': (23, 25), 'jpeg-broad': (15, 60),
+                       'jpeg-normal': (47, 35)}
+# ImageCorruptor passes an index into its list of interpolation modes to cv2.resize, which cv2 reads as its own
+# interpolation codes 0-3. These are the torch equivalents of those codes.
+RESAMPLING_MODES = ['nearest', 'bilinear', 'bicubic', 'area']
+
+
+def corruption_family(aug):
+    for family in CORRUPTION_FAMILIES:
+        if family in aug:
+            return family
+    raise NotImplementedError("Augmentation doesn't exist")
+
+
+def _per_sample_conv(x, kernels):
+    """ Cross-correlates each sample of x (b,c,h,w) with its own (kh,kw) kernel from kernels (b,kh,kw), using reflect-101
+    borders like cv2.filter2D. Kernels must have odd sizes. """
+    b, c, h, w = x.shape
+    kh, kw = kernels.shape[1:]
+    x = F.pad(x, (kw // 2, kw // 2, kh // 2, kh // 2), mode='reflect')
+    weight = kernels.to(x.dtype).repeat_interleave(c, dim=0).unsqueeze(1)
+    return F.conv2d(x.reshape(1, b * c, *x.shape[2:]), weight, groups=b * c).reshape(b, c, h, w)
+
+
+def quantize_colors(x, quant_div):
+    quant_div = quant_div.to(x.device, x.dtype).view(-1, 1, 1, 1)
+    return torch.div(x * 255, quant_div, rounding_mode='floor') * quant_div / 255
+
+
+def color_jitter(x, brightness, contrast, saturation, hue, order):
+    """ kornia's ColorJitter, with per-sample factors (b,) and per-sample transform order (b,4). """
+    transforms = [lambda y, f: adjust_brightness_accumulative(y, f),
+                  lambda y, f: adjust_contrast_with_mean_subtraction(y, f),
+                  lambda y, f: adjust_saturation_with_gray_subtraction(y, f),
+                  lambda y, f: adjust_hue(y, f * 2 * pi)]
+    factors = [f.to(x.device, x.dtype) for f in [brightness, contrast, saturation, hue]]
+    for step in range(4):
+        out = x.clone()
+        for t, (fn, f) in enumerate(zip(transforms, factors)):
+            rows = (order[:, step] == t).nonzero().squeeze(1).to(x.device)
+            if len(rows) > 0:
+                out[rows] = fn(x[rows], f[rows])
+        x = out
+    return x
+
+
+def gaussian_blur(x, sigmas):
+    """ cv2.GaussianBlur(img, (0,0), sigma) (for float images) with a per-sample sigma. """
+    kernels = []
+    for sigma in sigmas.tolist():
+        ksize = int(round(sigma * 4 * 2 + 1)) | 1
+        kernels.append(cv2.getGaussianKernel(ksize, sigma, cv2.CV_64F)[:, 0] if sigma > 0 else np.ones((1,)))
+    size = max(len(k) for k in kernels)
+    k1d = torch.zeros(len(kernels), size, dtype=torch.float64)
+    for i, k in enumerate(kernels):
+        pad = (size - len(k)) // 2
+        k1d[i, pad:pad + len(k)] = torch.from_numpy(k)
+    k1d = k1d.to(x.device)
+    x = _per_sample_conv(x, k1d.unsqueeze(1))
+    return _per_sample_conv(x, k1d.unsqueeze(2))
+
+
+def motion_blur(x, intensities, angles):
+    """ ImageCorruptor's motion blur: a line kernel of the given (integer) length rotated by angle degrees. """
+    kernels = []
+    for n, angle in zip(intensities.tolist(), angles.tolist()):
+        k = np.zeros((n, n), dtype=np.float32)
+        k[(n - 1) // 2, :] = np.ones(n, dtype=np.float32)
+        k = cv2.warpAffine(k, cv2.getRotationMatrix2D((n / 2 - 0.5, n / 2 - 0.5), angle, 1.0), (n, n))
+        kernels.append(k * (1.0 / np.sum(k)))
+    size = max(len(k) for k in kernels) | 1
+    canvas = torch.zeros(len(kernels), size, size)
+    for i, k in enumerate(kernels):
+        # cv2.filter2D anchors a kernel at (n//2, n//2); line that up with the center of the canvas.
+        o = size // 2 - len(k) // 2
+        canvas[i, o:o + len(k), o:o + len(k)] = torch.from_numpy(k)
+    return _per_sample_conv(x, canvas.to(x.device))
+
+
+def _area_weights(n, scale, device):
+    """ Weights of cv2's INTER_AREA when shrinking n pixels to n // scale, which counts partly covered pixels. """
+    ratio = n / (n // scale)
+    edges = torch.arange(n // scale + 1, dtype=torch.float64) * ratio
+    pixels = torch.arange(n, dtype=torch.float64)
+    overlap = torch.minimum(edges[1:, None], pixels + 1) - torch.maximum(edges[:-1, None], pixels)
+    return (overlap.clamp(min=0) / ratio).to(device, torch.float)
+
+
+def downsample(x, scale, mode):
+    h, w = x.shape[-2:]
+    if RESAMPLING_MODES[mode] == 'area' and (h % scale or w % scale):
+        # torch's area mode (adaptive average pooling) differs from cv2 when the size does not divide evenly.
+        return torch.einsum('oh,bchw,pw->bcop', _area_weights(h, scale, x.device), x.float(),
+                            _area_weights(w, scale, x.device)).to(x.dtype)
+    return F.interpolate(x, size=(h // scale, w // scale), mode=RESAMPLING_MODES[mode],
+                         **({'align_corners': False} if mode in [1, 2] else {}))
+
+
+def upsample(x, scale):
+    h, w = x.shape[-2:]
+    return F.interpolate(x, size=(h * scale, w * scale), mode='bilinear', align_corners=False)
+
+
+def add_noise(x, intensities, generator):
+    noise = torch.rand(x.shape, generator=generator, device=x.device, dtype=x.dtype)
+    return x + noise * intensities.to(x.device, x.dtype).view(-1, 1, 1, 1)
+
+
+_batched_jpeg = None
+
+
+def batched_jpeg_supported():
+    """ encode_jpeg() and decode_jpeg() only accept lists of images from torchvision 0.19 on. """
+    global _batched_jpeg
+    if _batched_jpeg is None:
+        try:
+            decode_jpeg(encode_jpeg([torch.zeros((3, 8, 8), dtype=torch.uint8)]))
+            _batched_jpeg = True
+        except Exception:
+            _batched_jpeg = False
+    return _batched_jpeg
+
+
+def jpeg_compress(x, qualities):
+    """ Round-trips each sample through JPEG at its quality. Samples are truncated to uint8 first, like ImageCorruptor. """
+    x8 = (x * 255).clamp(0, 255).to(torch.uint8)
+    out = torch.empty_like(x)
+    for q in sorted(set(qualities.tolist())):
+        rows = (qualities == q).nonzero().squeeze(1).tolist()
+        if batched_jpeg_supported():
+            try:
+                encoded = encode_jpeg([x8[r] for r in rows], quality=q)
+                decoded = decode_jpeg(encoded, device=x.device)
+            except RuntimeError:
+                # This torchvision build cannot code JPEGs on this device.
+                encoded = encode_jpeg([x8[r].cpu() for r in rows], quality=q)
+                decoded = [d.to(x.device) for d in decode_jpeg(encoded)]
+        else:
+            decoded = [decode_jpeg(encode_jpeg(x8[r].cpu(), quality=q)).to(x.device) for r in rows]
+        for r, d in zip(rows, decoded):
+            out[r] = d.to(x.dtype) / 255
+    return out
+
+
+class ImageCorruptionInjector(Injector):
+    """
+    Batched, on-device counterpart of data.images.image_corruptor.ImageCorruptor, for use in place of corrupting
+    images in the dataloader. Accepts the same corruption options (fixed_corruptions, num_corrupts_per_image,
+    random_corruptions, corruption_blur_scale, cosine_bias). Every sample draws its own corruptions and strengths.
+    With random_seed, every draw comes from a generator seeded with it, so the corruptions are reproducible.
+
+    'in' is a (b,c,h,w) batch in [0,1]. When 'entropy_out' is given, the random values behind each fixed corruption
+    are output there as (b, len(fixed_corruptions)), which is the "entropy" ImageCorruptor returns.
+    """
+    def __init__(self, opt, env):
+        super().__init__(opt, env)
+        self.blur_scale = opt_get(opt, ['corruption_blur_scale'], 1)
+        self.fixed_corruptions = opt_get(opt, ['fixed_corruptions'], [])
+        self.num_corrupts = opt_get(opt, ['num_corrupts_per_image'], 0)
+        self.random_corruptions = opt_get(opt, ['random_corruptions'], [])
+        self.cosine_bias = opt_get(opt, ['cosine_bias'], True)
+        self.entropy_output = opt_get(opt, ['entropy_out'], None)
+        for aug in self.fixed_corruptions + (self.random_corruptions if self.num_corrupts > 0 else []):
+            corruption_family(aug)  # Fail on unknown corruptions now rather than mid-training.
+        self.generator = torch.Generator()
+        seed = opt_get(opt, ['random_seed'], None)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    # Same distribution as ImageCorruptor.get_rand(): uniform on [0,1], optionally biased towards 0 by a cosine.
+    def get_rand(self, n):
+        r = torch.rand((n,), generator=self.generator, dtype=torch.float64)
+        if self.cosine_bias:
+            return 1 - torch.cos(r * pi / 2)
+        return r
+
+    def sample_corruptions(self, b):
+        """ Returns the corruptions of b samples as a list of (per-sample corruption names, per-sample rand values). """
+        slots = []
+        if self.num_corrupts > 0:
+            choices = torch.randint(len(self.random_corruptions), (self.num_corrupts, b), generator=self.generator)
+            for c in choices.tolist():
+                slots.append(([self.random_corruptions[i] for i in c], self.get_rand(b)))
+        for aug in self.fixed_corruptions:
+            slots.append(([aug] * b, self.get_rand(b)))
+        return slots
+
+    def apply_corruption(self, x, aug, rand_vals, applied_augmentations, noise_generator):
+        """
+        Applies aug to x, the samples of one resolution group, with their rand values. Returns a list of
+        (downsampling factor, rows of x, corrupted rows), since lq_resampling can split the group.
+        """
+        family = corruption_family(aug)
+        n = len(x)
+        everything = torch.arange(n)
+        if family == 'color_quantization':
+            x = quantize_colors(x, 2 ** (torch.floor(rand_vals * 10 / 3) + 2))
+        elif family == 'color_jitter':
+            setting = rand_vals * .2
+            rows = (setting * 255 > 1).nonzero().squeeze(1)
+            if len(rows) > 0:
+                s = setting[rows]
+                u = torch.rand((4, len(rows)), generator=self.generator, dtype=torch.float64)
+                order = torch.stack([torch.randperm(4, generator=self.generator) for _ in range(len(rows))])
+                x = x.clone()
+                x[rows.to(x.device)] = color_jitter(x[rows.to(x.device)], 1 - s + 2 * s * u[0], 1 - s + 2 * s * u[1],
+                                                    1 - s + 2 * s * u[2], -s + 2 * s * u[3], order)
+        elif family == 'gaussian_blur':
+            x = gaussian_blur(x, self.blur_scale * rand_vals * 1.5)
+        elif family == 'motion_blur':
+            intensities = (self.blur_scale * rand_vals * 3 + 1).long()
+            x = motion_blur(x, intensities, torch.randint(0, 361, (n,), generator=self.generator))
+        elif family == 'lq_resampling':
+            if aug == 'lq_resampling4x':
+                scales = torch.full((n,), 4)
+            else:
+                scales = torch.where(rand_vals < .3, 1, torch.where(rand_vals < .7, 2, 4))
+            modes = torch.randint(0, 5, (n,), generator=self.generator) % len(RESAMPLING_MODES)
+            unchanged = (scales == 1).nonzero().squeeze(1)
+            out = [(1, unchanged, x[unchanged.to(x.device)])] if len(unchanged) > 0 else []
+            for scale in scales[scales > 1].unique().tolist():
+                for mode in modes.unique().tolist():
+                    rows = ((scales == scale) & (modes == mode)).nonzero().squeeze(1)
+                    if len(rows) > 0:
+                        out.append((scale, rows, downsample(x[rows.to(x.device)], scale, mode)))
+            return out
+        elif family == 'noise':
+            if aug == 'noise-5':
+                intensities = torch.full((n,), 5 / 255.0)
+            else:
+                intensities = (rand_vals * 6) / 255.0
+            x = add_noise(x, intensities, noise_generator)
+        elif family == 'jpeg':
+            rows = torch.tensor([not ({'noise', 'noise-5'} & a) for a in applied_augmentations], dtype=torch.bool)
+            rows = rows.nonzero().squeeze(1)
+            if len(rows) > 0:
+                if aug not in JPEG_QUALITY_RANGES:
+                    raise NotImplementedError("specified jpeg corruption doesn't exist")
+                lo, rng = JPEG_QUALITY_RANGES[aug]
+                qualities = ((1 - rand_vals[rows]) * rng).long() + lo
+                x = x.clone()
+                x[rows.to(x.device)] = jpeg_compress(x[rows.to(x.device)], qualities)
+        elif family == 'saturation':
+            x = torch.clamp(x + (rand_vals * .3).to(x.device, x.dtype).view(-1, 1, 1, 1), 0, 1)
+        elif family == 'greyscale':
+            x = x.mean(dim=1, keepdim=True).repeat(1, x.shape[1], 1, 1)
+        return [(1, everything, x)]
+
+    def corrupt(self, imgs, slots):
+        b, c, h, w = imgs.shape
+        seed = int(torch.randint(2 ** 62, (1,), generator=self.generator))
+        noise_generator = torch.Generator(imgs.device).manual_seed(seed)
+        applied = [set(augs[i] for augs, _ in slots) for i in range(b)]
+        # Samples are grouped by the lq_resampling downsamples applied to them, since each group has its own size.
+        groups = {(): (torch.arange(b), imgs.float())}
+        for augs, rand_vals in slots:
+            for aug in sorted(set(augs)):
+                selected = torch.tensor([a == aug for a in augs])
+                new_groups = {}
+                for scales, (ids, x) in groups.items():
+                    rows = selected[ids].nonzero().squeeze(1)
+                    others = (~selected[ids]).nonzero().squeeze(1)
+                    if len(others) > 0:
+                        new_groups.setdefault(scales, []).append((ids[others], x[others.to(x.device)]))
+                    if len(rows) == 0:
+                        continue
+                    sub_ids = ids[rows]
+                    for scale, sub_rows, y in self.apply_corruption(x[rows.to(x.device)], aug, rand_vals[sub_ids],
+                                                                    [applied[i] for i in sub_ids.tolist()],
+                                                                    noise_generator):
+                        key = scales + (scale,) if scale > 1 else scales
+                        new_groups.setdefault(key, []).append((sub_ids[sub_rows], y))
+                groups = {k: (torch.cat([i for i, _ in v]), torch.cat([y for _, y in v])) for k, v in new_groups.items()}
+
+        out = torch.empty((b, c, h, w), device=imgs.device, dtype=torch.float)
+        for scales, (ids, x) in groups.items():
+            # Undo the downsampling, in the order it was applied.
+            for scale in scales:
+                x = upsample(x, scale)
+            if x.shape[-2:] != (h, w):
+                # Sizes which did not divide evenly by the downsampling factor.
+                x = F.interpolate(x, size=(h, w), mode='bilinear', align_corners=False)
+            out[ids.to(imgs.device)] = x
+        return out.to(imgs.dtype)
+
+    def forward(self, state):
+        with torch.no_grad():
+            imgs = state[self.input]
+            slots = self.sample_corruptions(imgs.shape[0])
+            result = {self.output: self.corrupt(imgs, slots)}
+            if self.entropy_output is not None:
+                fixed = slots[len(slots) - len(self.fixed_corruptions):]
+                result[self.entropy_output] = torch.stack([r for _, r in fixed], dim=1).float().to(imgs.device) \
+                    if fixed else torch.zeros((imgs.shape[0], 0), device=imgs.device)
+            return result
+
+
+def check_image_corruption_parity(batch_size=6, size=64, device='cpu', seed=0):
+    """
+    Compares the batched corruptions against ImageCorruptor.apply_corruption, image by image, with the same strengths
+    (and, where ImageCorruptor draws from `random`, the same draws). Color jitter is compared against kornia's ColorJitter
+    with the same factors, noise by its mean, and JPEG (torchvision vs PIL encoders) by its mean error. Motion blur is not
+    compared, as ImageCorruptor's motion blur needs an integer kernel size that it does not compute. Returns the max
+    difference per corruption.
+    """
+    from kornia.augmentation import ColorJitter
+    from data.images.image_corruptor import ImageCorruptor
+
+    rng = np.random.RandomState(seed)
+    imgs = [rng.rand(size, size, 3).astype(np.float32) for _ in range(batch_size)]
+    batch = torch.from_numpy(np.stack(imgs)).permute(0, 3, 1, 2).contiguous().to(device)
+    rand_vals = torch.linspace(.05, .95, batch_size, dtype=torch.float64)
+    cpu = ImageCorruptor({})
+    injector = ImageCorruptionInjector({'in': 'hq', 'out': 'lq', 'random_seed': seed}, {})
+    to_batch = lambda l: torch.from_numpy(np.stack(l)).permute(0, 3, 1, 2).to(device)
+
+    def cpu_corrupt(aug, python_seeds=None):
+        out = []
+        for i, img in enumerate(imgs):
+            if python_seeds is not None:
+                random.seed(python_seeds[i])
+            img, undo = cpu.apply_corruption(np.copy(img), aug, rand_vals[i].item(), [aug])
+            img = undo(img) if undo is not None else img
+            if img.shape[:2] != (size, size):
+                # ImageCorruptor leaves sizes which do not divide by the downsampling factor cropped; the injector
+                # resizes them back, so do the same here.
+                img = F.interpolate(torch.from_numpy(img).permute(2, 0, 1).unsqueeze(0), size=(size, size),
+                                    mode='bilinear', align_corners=False)[0].permute(1, 2, 0).numpy()
+            out.append(img)
+        return to_batch(out)
+
+    results = {}
+    for aug in ['color_quantization', 'gaussian_blur', 'saturation', 'greyscale', 'lq_resampling', 'lq_resampling4x']:
+        python_seeds = None
+        if 'lq_resampling' in aug:
+            # Peek at the interpolation modes the injector is about to draw (after its noise seed) and seed `random`
+            # so that ImageCorruptor draws the same ones.
+            state = injector.generator.get_state()
+            torch.randint(2 ** 62, (1,), generator=injector.generator)
+            modes = torch.randint(0, 5, (batch_size,), generator=injector.generator).tolist()
+            injector.generator.set_state(state)
+            python_seeds = []
+            for mode in modes:
+                python_seed = 0
+                while random.seed(python_seed) or random.randint(0, 4) != mode:
+                    python_seed += 1
+                python_seeds.append(python_seed)
+        gpu = injector.corrupt(batch, [([aug] * batch_size, rand_vals)])
+        diff = gpu - cpu_corrupt(aug, python_seeds)
+        if 'lq_resampling' in aug:
+            # Downsampling by 4 makes the outermost pixels depend on how the borders are extended.
+            diff = diff[..., 4:-4, 4:-4]
+        results[aug] = diff.abs().max().item()
+
+    s = (rand_vals * .2).float()
+    u = torch.rand((4, batch_size), dtype=torch.float64, generator=torch.Generator().manual_seed(seed)).float()
+    factors = [1 - s + 2 * s * u[0], 1 - s + 2 * s * u[1], 1 - s + 2 * s * u[2], -s + 2 * s * u[3]]
+    order = torch.stack([torch.randperm(4) for _ in range(batch_size)])
+    gpu = color_jitter(batch, *factors, order)
+    expected = torch.cat([ColorJitter(.2, .2, .2, .2)(batch[i:i+1].cpu(), params={
+        'brightness_factor': factors[0][i:i+1], 'contrast_factor': factors[1][i:i+1],
+        'saturation_factor': factors[2][i:i+1], 'hue_factor': factors[3][i:i+1], 'order': order[i],
+        'batch_prob': torch.ones(1, dtype=torch.bool)}) for i in range(batch_size)]).to(device)
+    results['color_jitter'] = (gpu - expected).abs().max().item()
+
+    noise = injector.corrupt(batch, [(['noise-5'] * batch_size, rand_vals)]) - batch
+    results['noise-5 (mean)'] = abs(noise.mean().item() - 2.5 / 255)
+    gpu = injector.corrupt(batch, [(['jpeg-medium'] * batch_size, rand_vals)])
+    results['jpeg-medium (mean)'] = (gpu - cpu_corrupt('jpeg-medium')).abs().mean().item()
+    for k, v in results.items():
+        print(f'{k}: {v:.3g}')
+    return results
+
+
+if __name__ == '__main__':
+    check_image_corruption_parity()
@@ -7,6 +7,8 @@ import sys
 from collections import OrderedDict
 from inspect import isfunction, getmembers, signature
 
+from trainer.registry_index import RegistryIndex, scan_source
+
 logger = logging.getLogger('base')
 
 
@@ -32,16 +34,26 @@ def register_model(func):
     return func
 
 
+MODEL_EXCLUSION_LIST = ['flownet2']
+_registered_model_fns = {}
+
+
 def find_registered_model_fns(base_path='models'):
+    """ Imports every module under base_path and returns all registered model fns. Memoized per process. """
+    if base_path not in _registered_model_fns:
+        _registered_model_fns[base_path] = _scan_registered_model_fns(base_path)
+    return _registered_model_fns[base_path]
+
+
+def _scan_registered_model_fns(base_path):
     found_fns = {}
     module_iter = pkgutil.walk_packages([base_path])
     for mod in module_iter:
         if os.path.join(os.getcwd(), base_path) not in mod.module_finder.path:
             continue   # I have no idea why this is necessary - I think it's a bug in the latest PyWindows release.
         if mod.ispkg:
-            EXCLUSION_LIST = ['flownet2']
-            if mod.name not in EXCLUSION_LIST:
-                found_fns.update(find_registered_model_fns(f'{base_path}/{mod.name}'))
+            if mod.name not in MODEL_EXCLUSION_LIST:
+                found_fns.update(_scan_registered_model_fns(f'{base_path}/{mod.name}'))
         else:
             mod_name = f'{base_path}/{mod.name}'.replace('/', '.')
             importlib.import_module(mod_name)
@@ -51,6 +63,22 @@ def find_registered_model_fns(base_path='models'):
     return found_fns
 
 
+_model_index = RegistryIndex('models', scan_source(r'^def register_(\w+)\s*\('), exclusions=MODEL_EXCLUSION_LIST)
+
+
+def find_registered_model_fn(name):
+    """
+    Returns the registered model fn for name, or None. Only the module which defines it is imported, located through
+    the persistent registry index; if the index is wrong for any reason, all modules are scanned instead.
+    """
+    for mod_name in _model_index.candidates(name):
+        module = importlib.import_module(mod_name)
+        fn = getattr(module, f'register_{name}', None)
+        if getattr(fn, '_dlas_registered_model', False) and fn._dlas_model_name == name:
+            return fn
+    return find_registered_model_fns().get(name)
+
+
 class CreateModelError(Exception):
     def __init__(self, name, available):
         super().__init__(f'Could not find the specified model name: {name}. Tip: If your model is in a'
@@ -65,11 +93,11 @@ def create_model(opt, opt_net, other_nets=None):
         which_model = opt_net['which_model_G']
     if not which_model:
         which_model = opt_net['which_model_D']
-    registered_fns = find_registered_model_fns()
-    if which_model not in registered_fns.keys():
-        raise CreateModelError(which_model, list(registered_fns.keys()))
-    num_params = len(signature(registered_fns[which_model]).parameters)
+    registered_fn = find_registered_model_fn(which_model)
+    if registered_fn is None:
+        raise CreateModelError(which_model, list(find_registered_model_fns().keys()))
+    num_params = len(signature(registered_fn).parameters)
     if num_params == 2:
-        return registered_fns[which_model](opt_net, opt)
+        return registered_fn(opt_net, opt)
     else:
-        return registered_fns[which_model](opt_net, opt, other_nets)
+        return registered_fn(opt_net, opt, other_nets)
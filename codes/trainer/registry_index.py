@@ -0,0 +1,93 @@
+import json
+import os
+import re
+
+INDEX_FILE_NAME = '.registry_index.json'
+
+
+class RegistryIndex:
+    """
+    Persistent map from registered names (models, injectors, ..) to the modules under base_path which define them.
+
+    Source files are scanned as text by `scan_fn`, so nothing is imported to build the index. The index is saved to
+    `{base_path}/.registry_index.json` along with each file's mtime and size; on later runs only files which have changed
+    since are re-scanned. Within a process, the index is built once.
+
+    Names found by scanning are candidates only: callers import the candidate module and verify that it really does
+    register the name, falling back to a full import scan if not.
+    """
+    def __init__(self, base_path, scan_fn, exclusions=()):
+        self.base_path = base_path
+        self.scan_fn = scan_fn
+        self.exclusions = set(exclusions)
+        self._names = None
+
+    def _module_files(self, base_path=None):
+        # Mirrors the traversal of pkgutil.walk_packages in find_registered_* : sorted, only descending into packages.
+        base_path = self.base_path if base_path is None else base_path
+        for fname in sorted(os.listdir(base_path)):
+            path = os.path.join(base_path, fname)
+            if os.path.isdir(path):
+                if '.' not in fname and fname not in self.exclusions and os.path.exists(os.path.join(path, '__init__.py')):
+                    yield from self._module_files(path)
+            elif fname.endswith('.py') and fname != '__init__.py':
+                yield path
+
+    def _load_cache(self, cache_file):
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache_file, entries):
+        # Best effort: a read-only checkout just doesn't get a persistent index.
+        try:
+            tmp = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(tmp, cache_file)
+        except OSError:
+            pass
+
+    def names(self):
+        """ Returns a dict of registered name -> list of candidate module names, in scan order. """
+        if self._names is not None:
+            return self._names
+        cache_file = os.path.join(self.base_path, INDEX_FILE_NAME)
+        cached = self._load_cache(cache_file)
+        entries = {}
+        changed = False
+        for path in self._module_files():
+            key = os.path.relpath(path, self.base_path).replace(os.sep, '/')
+            st = os.stat(path)
+            entry = cached.get(key)
+            if entry is None or entry['mtime'] != st.st_mtime_ns or entry['size'] != st.st_size:
+                with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                    entry = {'mtime': st.st_mtime_ns, 'size': st.st_size, 'names': self.scan_fn(f.read())}
+                changed = True
+            entries[key] = entry
+        if changed or len(entries) != len(cached):
+            self._save_cache(cache_file, entries)
+
+        names = {}
+        for key, entry in entries.items():
+            module = f'{self.base_path}/{key}'[:-len('.py')].replace('/', '.')
+            for name in entry['names']:
+                names.setdefault(name, []).append(module)
+        self._names = names
+        return names
+
+    def candidates(self, name):
+        """ Modules which may register name. Later modules take precedence, as with the full scan. """
+        return list(reversed(self.names().get(name, [])))
+
+
+def scan_source(pattern, format_fn=None):
+    """ Returns a scan_fn which reports every match of the first group of pattern, optionally reformatted. """
+    regex = re.compile(pattern, re.MULTILINE)
+
+    def scan(source):
+        found = regex.findall(source)
+        return [format_fn(f) if format_fn else f for f in found]
+    return scan
@@ -1,26 +1,177 @@
-# From: https://github.com/subhadarship/kmeans_pytorch
+# Originally from: https://github.com/subhadarship/kmeans_pytorch
 # License: https://github.com/subhadarship/kmeans_pytorch/blob/master/LICENSE
-import random
+#
+# Distances are computed in row chunks with the ||x||^2 - 2x.c + ||c||^2 expansion and centroids are updated with
+# scatter_add, so neither the (N, K, D) difference tensor nor the full (N, K) distance matrix is ever materialized.
+# Inputs may be torch tensors or numpy arrays / memmaps (see open_vectors()); the latter are streamed a chunk at a time
+# onto the device, which allows clustering vector files which are much larger than device memory.
+import os
 
 import numpy as np
 import torch
 from tqdm import tqdm
 
 
-# ToDo: Can't choose a cluster if two points are too close to each other, that's where the nan come from
+def open_vectors(path, dim=None, dtype=np.float32):
+    """
+    Opens a file of vectors for clustering without reading it into memory.
+    :param path: .npy file (memory-mapped), .pth/.pt file (loaded) or raw binary file of rows of `dim` elements of `dtype`.
+    :return: (N, D) numpy memmap or torch tensor
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return np.load(path, mmap_mode='r')
+    if ext in ['.pth', '.pt']:
+        return torch.load(path, map_location='cpu')
+    assert dim is not None, 'dim must be specified for raw vector files.'
+    return np.memmap(path, dtype=dtype, mode='r').reshape(-1, dim)
+
+
+def rows_per_chunk(num_clusters, max_chunk_bytes=2**28):
+    """ Number of rows whose float32 distances to num_clusters centers fit in max_chunk_bytes. """
+    return max(1, max_chunk_bytes // (4 * max(num_clusters, 1)))
+
+
+def _load_rows(X, start, end, device):
+    if isinstance(X, torch.Tensor):
+        return X[start:end].to(device).float()
+    return torch.from_numpy(np.array(X[start:end], dtype=np.float32)).to(device)
+
+
+def _prepare_centers(centers, distance):
+    """ Returns the centers and the per-center term of the distance expansion. """
+    if distance == 'euclidean':
+        return centers, centers.pow(2).sum(dim=-1)
+    elif distance == 'cosine':
+        return centers / centers.norm(dim=-1, keepdim=True), None
+    raise NotImplementedError
+
+
+def _chunk_distances(x, centers, center_term, distance):
+    if distance == 'euclidean':
+        return torch.addmm(center_term.unsqueeze(0), x, centers.T, alpha=-2).add_(x.pow(2).sum(dim=-1, keepdim=True)).clamp_(min=0)
+    return 1 - (x / x.norm(dim=-1, keepdim=True)) @ centers.T
 
 
-def initialize(X, num_clusters):
+def nearest_centers(X, centers, distance='euclidean', chunk_size=None, device=None, tqdm_flag=False):
+    """
+    Finds the nearest center of every row of X, computing distances for chunk_size rows at a time.
+    :param X: (N, D) torch tensor, numpy array or memmap
+    :param centers: (K, D) torch tensor
+    :param chunk_size: rows per chunk [default: as many as fit 256MB of distances]
+    :param device: device to compute on [default: the device of centers]
+    :return: (torch.tensor, torch.tensor) nearest center ids and distances, on device
     """
-    initialize cluster centers
+    device = centers.device if device is None else torch.device(device)
+    chunk_size = chunk_size or rows_per_chunk(len(centers))
+    centers, center_term = _prepare_centers(centers.to(device).float(), distance)
+    labels = torch.empty((len(X),), dtype=torch.long, device=device)
+    dists = torch.empty((len(X),), dtype=torch.float, device=device)
+    for start in tqdm(range(0, len(X), chunk_size), disable=not tqdm_flag, desc='[assigning clusters]'):
+        end = min(start + chunk_size, len(X))
+        d = _chunk_distances(_load_rows(X, start, end, device), centers, center_term, distance)
+        dists[start:end], labels[start:end] = d.min(dim=1)
+    return labels, dists
+
+
+def _nearest_points(X, centers, distance, chunk_size, device):
+    """ Returns the row of X nearest to each center. """
+    centers, center_term = _prepare_centers(centers.to(device).float(), distance)
+    best = torch.full((len(centers),), float('inf'), device=device)
+    best_ids = torch.zeros((len(centers),), dtype=torch.long, device=device)
+    for start in range(0, len(X), chunk_size):
+        end = min(start + chunk_size, len(X))
+        d, ids = _chunk_distances(_load_rows(X, start, end, device), centers, center_term, distance).min(dim=0)
+        better = d < best
+        best = torch.where(better, d, best)
+        best_ids = torch.where(better, ids + start, best_ids)
+    return torch.cat([_load_rows(X, i, i + 1, device) for i in best_ids.tolist()])
+
+
+def _sample_rows(X, num_samples, generator, device):
+    """ Loads num_samples distinct random rows of X (all of them, in order, if X has no more than that). """
+    if num_samples >= len(X):
+        return _load_rows(X, 0, len(X), device)
+    indices = torch.randperm(len(X), generator=generator)[:num_samples].sort().values
+    if isinstance(X, torch.Tensor):
+        return X[indices].to(device).float()
+    return torch.from_numpy(np.array(X[indices.numpy()], dtype=np.float32)).to(device)
+
+
+def initialize(X, num_clusters, generator=None):
+    """
+    initialize cluster centers by picking random rows
     :param X: (torch.tensor) matrix
     :param num_clusters: (int) number of clusters
-    :return: (np.array) initial state
+    :return: (torch.tensor) initial state
+    """
+    return _sample_rows(X, num_clusters, generator, X.device if isinstance(X, torch.Tensor) else 'cpu')
+
+
+def kmeans_plus_plus(X, num_clusters, distance='euclidean', generator=None):
     """
-    num_samples = len(X)
-    indices = np.random.choice(num_samples, num_clusters, replace=False)
-    initial_state = X[indices]
-    return initial_state
+    k-means++ initialization: every center after the first is drawn from the rows of X with probability proportional to
+    their squared distance to the nearest center drawn so far. Runs in O(N*K*D) time and O(N) extra memory, so large
+    inputs should be subsampled first (see init_sample_size in kmeans() and minibatch_kmeans()).
+    :param X: (torch.tensor) (N, D) matrix
+    :return: (torch.tensor) (num_clusters, D) initial state
+    """
+    assert len(X) >= num_clusters, f'Cannot choose {num_clusters} centers from {len(X)} points.'
+    X = X.float()
+    if distance == 'cosine':
+        X = X / X.norm(dim=-1, keepdim=True)
+    elif distance != 'euclidean':
+        raise NotImplementedError
+
+    def dist_to(c):
+        if distance == 'euclidean':
+            return (X - c).pow_(2).sum(dim=-1)
+        return (1 - X @ c).clamp_(min=0).pow_(2)
+
+    # Draws use the CPU generator so that results do not depend on the device.
+    def draw(weights):
+        total = weights.sum()
+        if not total > 0:  # Every point coincides with a center; fall back to uniform draws.
+            weights, total = torch.ones_like(weights), float(len(weights))
+        r = torch.rand((1,), generator=generator).item() * float(total)
+        return min(int(torch.searchsorted(torch.cumsum(weights, 0), torch.tensor([r], device=weights.device))), len(X) - 1)
+
+    ids = [int(torch.randint(len(X), (1,), generator=generator))]
+    min_dist = dist_to(X[ids[0]])
+    for _ in range(1, num_clusters):
+        ids.append(draw(min_dist.double()))
+        torch.minimum(min_dist, dist_to(X[ids[-1]]), out=min_dist)
+    return X[ids].clone()
+
+
+def _limit_cluster_members(labels, num_clusters, limit, generator):
+    """ Returns a mask keeping at most `limit` randomly chosen members of every cluster. """
+    perm = torch.randperm(len(labels), generator=generator).to(labels.device)
+    order = perm[torch.sort(labels[perm], stable=True).indices]
+    counts = torch.bincount(labels, minlength=num_clusters)
+    starts = torch.cumsum(counts, 0) - counts
+    rank = torch.arange(len(labels), device=labels.device) - starts[labels[order]]
+    keep = torch.zeros_like(labels, dtype=torch.bool)
+    keep[order[rank < limit]] = True
+    return keep
+
+
+def _accumulate(x, labels, sums, counts):
+    sums.scatter_add_(0, labels.unsqueeze(1).expand(-1, x.shape[1]), x)
+    counts.scatter_add_(0, labels, torch.ones_like(labels, dtype=counts.dtype))
+
+
+def _initial_state(X, num_clusters, distance, cluster_centers, init, init_sample_size, generator, chunk_size, device):
+    if isinstance(cluster_centers, torch.Tensor):
+        print('resuming')
+        # find the data point closest to each initial cluster center
+        return _nearest_points(X, cluster_centers, distance, chunk_size, device)
+    if init == 'random':
+        return _sample_rows(X, num_clusters, generator, device)
+    elif init == 'k-means++':
+        sample = _sample_rows(X, init_sample_size or 64 * num_clusters, generator, device)
+        return kmeans_plus_plus(sample, num_clusters, distance, generator).to(device)
+    raise NotImplementedError
 
 
 def kmeans(
@@ -32,64 +183,65 @@ def kmeans(
         tqdm_flag=True,
         iter_limit=0,
         gravity_limit_per_iter=None,
-        device=torch.device('cpu')
+        device=torch.device('cpu'),
+        init='k-means++',
+        init_sample_size=None,
+        chunk_size=None,
+        seed=None,
 ):
     """
-    perform kmeans
-    :param X: (torch.tensor) matrix
+    perform kmeans (Lloyd's algorithm over every point, every iteration)
+    :param X: (torch.tensor) matrix, or a numpy array / memmap which is streamed onto the device in chunks
     :param num_clusters: (int) number of clusters
     :param distance: (str) distance [options: 'euclidean', 'cosine'] [default: 'euclidean']
+    :param cluster_centers: (torch.tensor) centers to resume from; the nearest data points are used as initial state
     :param tol: (float) threshold [default: 0.0001]
     :param device: (torch.device) device [default: cpu]
     :param tqdm_flag: Allows to turn logs on and off
     :param iter_limit: hard limit for max number of iterations
+    :param gravity_limit_per_iter: if set, at most this many random members of each cluster update its center
+    :param init: (str) initialization [options: 'k-means++', 'random'] [default: 'k-means++']
+    :param init_sample_size: points k-means++ chooses among [default: 64 * num_clusters]
+    :param chunk_size: rows per distance chunk [default: as many as fit 256MB of distances]
+    :param seed: seed for initialization and gravity limiting
     :return: (torch.tensor, torch.tensor) cluster ids, cluster centers
     """
     print(f'running k-means on {device}..')
+    device = torch.device(device)
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    chunk_size = chunk_size or rows_per_chunk(num_clusters)
 
-    if distance == 'euclidean':
-        pairwise_distance_function = pairwise_distance
-    elif distance == 'cosine':
-        pairwise_distance_function = pairwise_cosine
-    else:
-        raise NotImplementedError
-
-    # convert to float
-    X = X.float()
-
-    # transfer to device
-    X = X.to(device)
-
-    # initialize
-    if type(cluster_centers) == list:  # ToDo: make this less annoyingly weird
-        initial_state = initialize(X, num_clusters)
-    else:
-        print('resuming')
-        # find data point closest to the initial cluster center
-        initial_state = cluster_centers
-        dis = pairwise_distance_function(X, initial_state)
-        choice_points = torch.argmin(dis, dim=0)
-        initial_state = X[choice_points]
-        initial_state = initial_state.to(device)
+    if isinstance(X, torch.Tensor):
+        X = X.float().to(device)
+    initial_state = _initial_state(X, num_clusters, distance, cluster_centers, init, init_sample_size, generator,
+                                   chunk_size, device)
+    num_features = initial_state.shape[1]
 
     iteration = 0
     if tqdm_flag:
         tqdm_meter = tqdm(desc='[running kmeans]')
     while True:
-
-        dis = pairwise_distance_function(X, initial_state)
-
-        choice_cluster = torch.argmin(dis, dim=1)
-
-        initial_state_pre = initial_state.clone()
-
-        for index in range(num_clusters):
-            selected = torch.nonzero(choice_cluster == index).squeeze().to(device)
-            selected = torch.index_select(X, 0, selected)
-            if gravity_limit_per_iter and len(selected) > gravity_limit_per_iter:
-                ch = random.randint(0, len(selected)-gravity_limit_per_iter)
-                selected=selected[ch:ch+gravity_limit_per_iter]
-            initial_state[index] = selected.mean(dim=0)
+        centers, center_term = _prepare_centers(initial_state, distance)
+        sums = torch.zeros((num_clusters, num_features), device=device)
+        counts = torch.zeros((num_clusters,), dtype=torch.long, device=device)
+        choice_cluster = torch.empty((len(X),), dtype=torch.long, device=device)
+        for start in range(0, len(X), chunk_size):
+            end = min(start + chunk_size, len(X))
+            x = _load_rows(X, start, end, device)
+            labels = _chunk_distances(x, centers, center_term, distance).argmin(dim=1)
+            choice_cluster[start:end] = labels
+            if not gravity_limit_per_iter:
+                _accumulate(x, labels, sums, counts)
+        if gravity_limit_per_iter:
+            keep = _limit_cluster_members(choice_cluster, num_clusters, gravity_limit_per_iter, generator)
+            for start in range(0, len(X), chunk_size):
+                end = min(start + chunk_size, len(X))
+                k = keep[start:end]
+                _accumulate(_load_rows(X, start, end, device)[k], choice_cluster[start:end][k], sums, counts)
+
+        initial_state_pre = initial_state
+        # Clusters which lost all of their points keep their previous center.
+        initial_state = torch.where((counts > 0).unsqueeze(1), sums / counts.clamp(min=1).unsqueeze(1), initial_state_pre)
 
         center_shift = torch.sum(
             torch.sqrt(
@@ -100,13 +252,14 @@ def kmeans(
         iteration = iteration + 1
 
         # update tqdm meter
-        bins = torch.bincount(choice_cluster)
         if tqdm_flag:
+            bins = torch.bincount(choice_cluster, minlength=num_clusters)
             tqdm_meter.set_postfix(
                 iteration=f'{iteration}',
                 center_shift=f'{center_shift ** 2}',
                 tol=f'{tol}',
-                bins=f'{bins}',
+                empty=f'{int((bins == 0).sum())}',
+                largest=f'{int(bins.max())}',
             )
             tqdm_meter.update()
         if tol > 0 and center_shift ** 2 < tol:
@@ -117,58 +270,163 @@ def kmeans(
     return choice_cluster.cpu(), initial_state.cpu()
 
 
+def minibatch_kmeans(
+        X,
+        num_clusters,
+        distance='euclidean',
+        batch_size=2**16,
+        epochs=1,
+        tol=0,
+        init='k-means++',
+        init_sample_size=None,
+        cluster_centers=None,
+        device=torch.device('cpu'),
+        seed=None,
+        tqdm_flag=True,
+):
+    """
+    Mini-batch k-means (Sculley, 2010) which streams X in contiguous batches, so that memory-mapped vector files need
+    not fit in host or device memory and are read sequentially. Batches are visited in a random order each epoch. Each
+    center moves to the running mean of every point ever assigned to it, i.e. with a per-center learning rate of
+    1 / (points assigned so far).
+    :param X: (N, D) torch tensor, numpy array or memmap (see open_vectors())
+    :param batch_size: rows per mini-batch
+    :param epochs: passes over X
+    :param tol: stop early once an epoch's squared center shift is below this [default: 0, disabled]
+    :param cluster_centers: optional (K, D) centers to start from instead of initializing
+    :param seed: seed for initialization and batch order
+    :return: (torch.tensor) (num_clusters, D) cluster centers. Use kmeans_predict() to assign points.
+    """
+    device = torch.device(device)
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    if cluster_centers is not None:
+        centers = cluster_centers.to(device).float().clone()
+    else:
+        centers = _initial_state(X, num_clusters, distance, None, init, init_sample_size, generator, batch_size, device)
+    num_features = centers.shape[1]
+    seen = torch.zeros((num_clusters,), dtype=torch.long, device=device)
+    starts = torch.arange(0, len(X), batch_size)
+    for epoch in range(epochs):
+        epoch_start_centers = centers.clone()
+        for start in tqdm(starts[torch.randperm(len(starts), generator=generator)].tolist(), disable=not tqdm_flag,
+                          desc=f'[minibatch kmeans, epoch {epoch}]'):
+            x = _load_rows(X, start, min(start + batch_size, len(X)), device)
+            labels = _chunk_distances(x, *_prepare_centers(centers, distance), distance).argmin(dim=1)
+            sums = torch.zeros((num_clusters, num_features), device=device)
+            counts = torch.zeros((num_clusters,), dtype=torch.long, device=device)
+            _accumulate(x, labels, sums, counts)
+            seen += counts
+            # c <- c + (sum - count * c) / seen, which keeps c at the mean of every point assigned to it so far.
+            centers += (sums - counts.unsqueeze(1) * centers) / seen.clamp(min=1).unsqueeze(1)
+        shift = torch.sum(torch.sqrt(torch.sum((centers - epoch_start_centers) ** 2, dim=1))) ** 2
+        if tqdm_flag:
+            print(f'epoch {epoch}: center_shift={shift}, empty clusters={int((seen == 0).sum())}')
+        if tol > 0 and shift < tol:
+            break
+    return centers.cpu()
+
+
 def kmeans_predict(
         X,
         cluster_centers,
-        distance='euclidean'
+        distance='euclidean',
+        device=None,
+        chunk_size=None,
 ):
     """
     predict using cluster centers
-    :param X: (torch.tensor) matrix
+    :param X: (torch.tensor) matrix, or a numpy array / memmap
     :param cluster_centers: (torch.tensor) cluster centers
     :param distance: (str) distance [options: 'euclidean', 'cosine'] [default: 'euclidean']
-    :param device: (torch.device) device [default: 'cpu']
+    :param device: (torch.device) device [default: the device of X if it is a tensor, otherwise that of cluster_centers]
+    :param chunk_size: rows per distance chunk [default: as many as fit 256MB of distances]
     :return: (torch.tensor) cluster ids
     """
-    if distance == 'euclidean':
-        pairwise_distance_function = pairwise_distance
-    elif distance == 'cosine':
-        pairwise_distance_function = pairwise_cosine
-    else:
-        raise NotImplementedError
-
-    dis = pairwise_distance_function(X, cluster_centers)
-    choice_cluster = torch.argmin(dis, dim=1)
-
-    return choice_cluster
+    if device is None:
+        device = X.device if isinstance(X, torch.Tensor) else cluster_centers.device
+    return nearest_centers(X, cluster_centers, distance, chunk_size, device)[0]
 
 
 def pairwise_distance(data1, data2):
-    # N*1*M
-    A = data1.unsqueeze(dim=1)
+    # (N, M) squared euclidean distances, via ||a||^2 - 2a.b + ||b||^2
+    return _dense_distances(data1, data2, 'euclidean')
 
-    # 1*N*M
-    B = data2.unsqueeze(dim=0)
 
-    dis = (A - B) ** 2.0
-    # return N*N matrix for pairwise distance
-    dis = dis.sum(dim=-1).squeeze()
-    return dis
+def pairwise_cosine(data1, data2):
+    # (N, M) cosine distances
+    return _dense_distances(data1, data2, 'cosine')
 
 
-def pairwise_cosine(data1, data2):
-    # N*1*M
-    A = data1.unsqueeze(dim=1)
+def _dense_distances(data1, data2, distance):
+    data2, center_term = _prepare_centers(data2.float(), distance)
+    return _chunk_distances(data1.float(), data2, center_term, distance)
 
-    # 1*N*M
-    B = data2.unsqueeze(dim=0)
 
-    # normalize the points  | [0.3, 0.4] -> [0.3/sqrt(0.09 + 0.16), 0.4/sqrt(0.09 + 0.16)] = [0.3/0.5, 0.4/0.5]
-    A_normalized = A / A.norm(dim=-1, keepdim=True)
-    B_normalized = B / B.norm(dim=-1, keepdim=True)
+def _reference_lloyd_step(X, centers):
+    """ One iteration of the original implementation: dense (N, K, D) distances and a per-cluster update loop. """
+    dis = ((X.unsqueeze(1) - centers.unsqueeze(0)) ** 2).sum(dim=-1)
+    choice_cluster = torch.argmin(dis, dim=1)
+    new_centers = centers.clone()
+    for index in range(len(centers)):
+        selected = torch.index_select(X, 0, torch.nonzero(choice_cluster == index).squeeze(1))
+        if len(selected) > 0:
+            new_centers[index] = selected.mean(dim=0)
+    return choice_cluster, new_centers
 
-    cosine = A_normalized * B_normalized
 
-    # return N*N matrix for pairwise distance
-    cosine_dis = 1 - cosine.sum(dim=-1).squeeze()
-    return cosine_dis
+def benchmark_kmeans(num_vectors=20000, dim=64, num_clusters=256, device='cpu', iterations=3, seed=0):
+    """
+    Times Lloyd iterations of the original dense implementation against the chunked one from identical starting
+    centers, checks that they agree, then times mini-batch k-means over the same data written to a memmap.
+    """
+    import tempfile
+    import time
+    device = torch.device(device)
+    g = torch.Generator().manual_seed(seed)
+    # Gaussian blobs, so that there is structure to find.
+    blobs = torch.randn(num_clusters, dim, generator=g) * 4
+    X = (blobs[torch.randint(num_clusters, (num_vectors,), generator=g)] + torch.randn(num_vectors, dim, generator=g)).to(device)
+    start_centers = X[torch.randperm(num_vectors, generator=g)[:num_clusters].to(device)]
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    def timed(fn):
+        sync()
+        start = time.perf_counter()
+        out = fn()
+        sync()
+        return out, time.perf_counter() - start
+
+    def reference():
+        c = start_centers
+        for _ in range(iterations):
+            labels, c = _reference_lloyd_step(X, c)
+        return labels, c
+    (ref_labels, ref_centers), ref_time = timed(reference)
+    (labels, centers), new_time = timed(lambda: kmeans(X, num_clusters, cluster_centers=start_centers, tol=0,
+                                                       iter_limit=iterations, tqdm_flag=False, device=device,
+                                                       chunk_size=4096))
+    # Resuming snaps centers to their nearest points, which start_centers already are.
+    agreement = (labels == ref_labels.cpu()).float().mean().item()
+    center_err = (centers - ref_centers.cpu()).abs().max().item()
+    print(f'Original: {iterations / ref_time:.2f} iterations/sec. Chunked: {iterations / new_time:.2f} iterations/sec. '
+          f'Label agreement: {agreement:.5f}, max center difference: {center_err:.2e}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'vectors.npy')
+        np.save(path, X.cpu().numpy())
+        mm = open_vectors(path)
+        mb_centers, mb_time = timed(lambda: minibatch_kmeans(mm, num_clusters, batch_size=4096, epochs=iterations,
+                                                             device=device, seed=seed, tqdm_flag=False))
+        mb_labels, mb_dists = nearest_centers(mm, mb_centers.to(device))
+        _, ref_dists = nearest_centers(X, ref_centers)
+        print(f'Mini-batch over memmap: {iterations / mb_time:.2f} epochs/sec. Inertia: {mb_dists.sum().item():.4g} vs '
+              f'{ref_dists.sum().item():.4g} for {iterations} full Lloyd iterations.')
+        del mm, mb_labels
+    return iterations / ref_time, iterations / new_time, agreement
+
+
+if __name__ == '__main__':
+    benchmark_kmeans()
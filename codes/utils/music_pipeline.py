@@ -0,0 +1,255 @@
+import contextlib
+import math
+import queue
+import threading
+import time
+
+import torch
+
+from models.diffusion.gaussian_diffusion import get_named_beta_schedule
+from models.diffusion.respace import SpacedDiffusion, space_timesteps
+from trainer.injectors.audio_injectors import denormalize_torch_mel, pixel_shuffle_1d
+from utils.music_utils import get_cheater_decoder, get_mel2wav_v3_model, get_cheater_generator
+
+# Each cheater latent covers 16 MEL frames with a hop of 256 waveform samples.
+CHEATER_HOP = 4096
+MAX_CONTEXT = 30 * 22050 // CHEATER_HOP
+
+
+def make_diffuser(steps, schedule='linear', conditioning_free=True, conditioning_free_k=1):
+    return SpacedDiffusion(use_timesteps=space_timesteps(4000, [steps]), model_mean_type='epsilon',
+                           model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule(schedule, 4000),
+                           conditioning_free=conditioning_free, conditioning_free_k=conditioning_free_k)
+
+
+def chunk_starts(length, chunk_length, overlap):
+    """
+    Returns the offsets of equally long chunks of `chunk_length` that cover [0, length) while sharing at least `overlap`
+    frames with their neighbours. Equal lengths let every chunk go through a stage in one batch. Chunks further apart
+    than direct neighbours may overlap too when length is only slightly above a multiple of the stride.
+    """
+    if length <= chunk_length:
+        return [0]
+    assert overlap < chunk_length, 'chunks must advance by at least one frame'
+    count = math.ceil((length - overlap) / (chunk_length - overlap))
+    stride = (length - chunk_length) / (count - 1)
+    return [round(i * stride) for i in range(count)]
+
+
+def crossfade_chunks(chunks, starts, hop):
+    """
+    Overlap-adds chunks of shape [n,c,l] placed at starts*hop, linearly crossfading wherever neighbours overlap. The sum
+    is divided by the summed weights, which keeps the result normalized even where more than two chunks overlap.
+    """
+    n, c, l = chunks.shape
+    out = chunks.new_zeros((c, starts[-1] * hop + l))
+    total_weight = torch.zeros(out.shape[-1], device=chunks.device)
+    for i, start in enumerate(starts):
+        start = start * hop
+        weight = torch.ones(l, device=chunks.device)
+        if i > 0:
+            fade = starts[i-1] * hop + l - start
+            weight[:fade] = torch.linspace(0, 1, fade + 2, device=chunks.device)[1:-1]
+        if i < n - 1:
+            fade = start + l - starts[i+1] * hop
+            weight[l-fade:] *= torch.linspace(1, 0, fade + 2, device=chunks.device)[1:-1]
+        out[:, start:start+l] += chunks[i] * weight
+        total_weight[start:start+l] += weight
+    return (out / total_weight).unsqueeze(0)
+
+
+class MusicCascade:
+    """
+    Inference pipeline for the music cascade: cheater latents -> MEL (cheater decoder) -> waveform (mel2wav), plus the
+    cheater generator used to join clips. All models are loaded once and stay resident on `device`.
+
+    Long cheater sequences are split into overlapping, equally long chunks which travel through each stage in batches of
+    `batch_size`. When `pipelined`, mel2wav runs on one batch in a worker thread (and its own CUDA stream) while the
+    cheater decoder works on the next one. Decoded chunks are crossfaded back together.
+
+    The starting noise of every batch is drawn up front on the calling thread, in the order sequential decoding would
+    draw it, so that seeded output does not depend on `pipelined` or thread scheduling. The 'p_sample' sampler also draws
+    noise at every step and is therefore only reproducible when not pipelined.
+    """
+    def __init__(self, device='cuda', cheater_decoder=None, mel2wav=None, cheater_generator=None,
+                 decoder_steps=64, spectral_steps=32, sampler='ddim', solver_order=2,
+                 chunk_length=MAX_CONTEXT, overlap=4, batch_size=4, pipelined=True):
+        self.device = torch.device(device)
+        self.cheater_decoder = (cheater_decoder or get_cheater_decoder().diff).to(self.device).eval()
+        self.mel2wav = (mel2wav or get_mel2wav_v3_model()).to(self.device).eval()
+        self.cheater_generator = cheater_generator.to(self.device).eval() if cheater_generator is not None else None
+        self.decoder_diffuser = make_diffuser(decoder_steps)
+        self.spectral_diffuser = make_diffuser(spectral_steps)
+        self.decode_mel_fn = self.decoder_diffuser.sample_loop_fn(sampler, solver_order)
+        self.decode_wav_fn = self.spectral_diffuser.sample_loop_fn(sampler, solver_order)
+        self.chunk_length = chunk_length
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.pipelined = pipelined
+        if self.device.type == 'cuda':
+            self.streams = (torch.cuda.Stream(self.device), torch.cuda.Stream(self.device))
+
+    @staticmethod
+    def mel_shape(cheater_shape):
+        return cheater_shape[0], 256, cheater_shape[-1] * 16
+
+    @staticmethod
+    def wav_shape(mel_shape):
+        return mel_shape[0], 16, mel_shape[-1] * 256 // 16
+
+    def cheater_to_mel(self, cheaters, noise=None):
+        """ [b,256,l] cheater latents -> [b,256,l*16] normalized MELs. """
+        return self.decode_mel_fn(self.cheater_decoder, self.mel_shape(cheaters.shape), noise=noise, progress=False,
+                                  model_kwargs={'codes': cheaters.permute(0, 2, 1)})
+
+    def mel_to_wav(self, mels, noise=None):
+        """ [b,256,l] normalized MELs -> [b,1,l*256] waveforms. """
+        mels = denormalize_torch_mel(mels)
+        wav = self.decode_wav_fn(self.mel2wav, self.wav_shape(mels.shape), noise=noise, progress=False,
+                                 model_kwargs={'codes': mels})
+        return pixel_shuffle_1d(wav, 16)
+
+    def _draw_noise(self, batches):
+        """ Returns the (mel, wav) starting noise of every batch. """
+        noises = []
+        for batch in batches:
+            mel_shape = self.mel_shape(batch.shape)
+            noises.append((torch.randn(mel_shape, device=self.device),
+                           torch.randn(self.wav_shape(mel_shape), device=self.device)))
+        return noises
+
+    def _stream(self, i):
+        return torch.cuda.stream(self.streams[i]) if self.device.type == 'cuda' else contextlib.nullcontext()
+
+    def _decode_mels(self, i, batch, noise, mel_fn):
+        mel = self.cheater_to_mel(batch, noise)
+        if mel_fn is not None:
+            for j in range(mel.shape[0]):
+                mel_fn(i * self.batch_size + j, mel[j:j+1])
+        return mel
+
+    def _run_sequential(self, batches, noises, mel_fn=None):
+        return [self.mel_to_wav(self._decode_mels(i, batch, mel_noise, mel_fn), wav_noise)
+                for i, (batch, (mel_noise, wav_noise)) in enumerate(zip(batches, noises))]
+
+    def _run_pipelined(self, batches, noises, mel_fn=None):
+        results = [None] * len(batches)
+        errors = []
+        mels = queue.Queue(maxsize=1)
+
+        def mel_to_wav_worker():
+            # Grad mode is thread-local.
+            with torch.no_grad(), self._stream(1):
+                while True:
+                    item = mels.get()
+                    if item is None:
+                        return
+                    i, mel, ready = item
+                    wav_noise = noises[i][1]
+                    try:
+                        if ready is not None:
+                            self.streams[1].wait_event(ready)
+                            mel.record_stream(self.streams[1])
+                            wav_noise.record_stream(self.streams[1])
+                        results[i] = self.mel_to_wav(mel, wav_noise)
+                    except Exception as e:
+                        errors.append(e)
+
+        worker = threading.Thread(target=mel_to_wav_worker, daemon=True)
+        worker.start()
+        if self.device.type == 'cuda':
+            self.streams[0].wait_stream(torch.cuda.current_stream(self.device))
+        try:
+            with self._stream(0):
+                for i, batch in enumerate(batches):
+                    if errors:
+                        break
+                    mel = self._decode_mels(i, batch, noises[i][0], mel_fn)
+                    ready = None
+                    if self.device.type == 'cuda':
+                        ready = torch.cuda.Event()
+                        ready.record(self.streams[0])
+                    mels.put((i, mel, ready))
+        finally:
+            mels.put(None)
+            worker.join()
+        if errors:
+            raise errors[0]
+        if self.device.type == 'cuda':
+            torch.cuda.current_stream(self.device).wait_stream(self.streams[1])
+        return results
+
+    def decode(self, cheater, mel_fn=None):
+        """
+        Decodes [1,256,l] cheater latents into a [1,1,l*CHEATER_HOP] waveform. If given, mel_fn(chunk_index, mel) is
+        called with the normalized [1,256,chunk_length*16] MEL of every chunk, e.g. to save debug images.
+        """
+        with torch.no_grad():
+            cheater = cheater.to(self.device)
+            chunk_length = min(self.chunk_length, cheater.shape[-1])
+            starts = chunk_starts(cheater.shape[-1], chunk_length, self.overlap)
+            chunks = torch.stack([cheater[0, :, s:s+chunk_length] for s in starts])
+            batches = torch.split(chunks, self.batch_size)
+            noises = self._draw_noise(batches)
+            if self.pipelined and len(batches) > 1:
+                wavs = self._run_pipelined(batches, noises, mel_fn)
+            else:
+                wavs = self._run_sequential(batches, noises, mel_fn)
+            return crossfade_chunks(torch.cat(wavs, dim=0), starts, CHEATER_HOP)
+
+    def join_cheaters(self, clip1_cheater, clip2_cheater, leadin=60, gap=240, steps=256, schedule='cosine',
+                      conditioning_free_k=2):
+        """
+        Generates `gap` cheater latents bridging the end of clip1 into the start of clip2 with the cheater generator.
+        The last (first) `leadin` latents of clip1 (clip2) are kept and inpainted around; the remainder of each clip is
+        fed to the generator as conditioning.
+        """
+        if self.cheater_generator is None:
+            self.cheater_generator = get_cheater_generator().to(self.device).eval()
+        diffuser = make_diffuser(steps, schedule, conditioning_free_k=conditioning_free_k)
+        clip1_cheater, clip2_cheater = clip1_cheater.to(self.device), clip2_cheater.to(self.device)
+        inp = torch.cat([clip1_cheater[:, :, -leadin:], torch.zeros(1, 256, gap, device=self.device),
+                         clip2_cheater[:, :, :leadin]], dim=-1)
+        mask = torch.ones_like(inp)
+        mask[:, :, leadin:-leadin] = 0
+        with torch.no_grad():
+            return diffuser.ddim_sample_loop_with_guidance(self.cheater_generator, inp, mask,
+                                                           model_kwargs={'cond_left': clip1_cheater[:, :, :-leadin],
+                                                                         'cond_right': clip2_cheater[:, :, leadin:]})
+
+
+def benchmark_music_cascade(cascade=None, seconds=120, device='cuda'):
+    """
+    Reports seconds of audio generated per wall-clock second when decoding `seconds` of random cheater latents chunk by
+    chunk at batch size 1 (as scripts/audio/gen/music_joiner.py used to) and through the batched, pipelined cascade.
+    All three modes decode the same overlapping chunks, so the speedups only measure batching and pipelining. The
+    previous behaviour also split without overlap, which did slightly less work than any of these.
+    """
+    if cascade is None:
+        cascade = MusicCascade(device)
+    cheater = torch.randn(1, 256, int(seconds * 22050 / CHEATER_HOP), device=cascade.device)
+    audio_seconds = cheater.shape[-1] * CHEATER_HOP / 22050
+
+    def sync():
+        if cascade.device.type == 'cuda':
+            torch.cuda.synchronize(cascade.device)
+
+    settings = {'batch_size': cascade.batch_size, 'pipelined': cascade.pipelined}
+    results = {}
+    for name, batch_size, pipelined in [('sequential', 1, False),
+                                        ('batched', settings['batch_size'], False),
+                                        ('pipelined', settings['batch_size'], True)]:
+        cascade.batch_size, cascade.pipelined = batch_size, pipelined
+        cascade.decode(cheater[:, :, :cascade.chunk_length])  # Warmup.
+        sync()
+        start = time.perf_counter()
+        cascade.decode(cheater)
+        sync()
+        results[name] = audio_seconds / (time.perf_counter() - start)
+        print(f'{name}: {results[name]:.3f} seconds of audio per second')
+    cascade.batch_size, cascade.pipelined = settings['batch_size'], settings['pipelined']
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_music_cascade()
@@ -82,4 +82,14 @@ def get_ar_prior():
     cheater_ar = ConditioningAR(1024, layers=24, dropout=0, cond_free_percent=0)
     cheater_ar.load_state_dict(torch.load('../experiments/music_cheater_ar.pth', map_location=torch.device('cpu')))
     cheater_ar = cheater_ar.eval()
-    return cheater_ar
\ No newline at end of file
+    return cheater_ar
+
+def get_cheater_generator(path='../experiments/music_cheater_gen_v5.pth'):
+    from models.audio.music.tfdpc_v5 import TransformerDiffusionWithPointConditioning
+    model = TransformerDiffusionWithPointConditioning(in_channels=256, out_channels=512, model_channels=1024,
+                                                      contraction_dim=512, num_heads=8, num_layers=32, dropout=0,
+                                                      use_fp16=False, unconditioned_percentage=0, time_proj=False,
+                                                      new_cond=True, regularization=False)
+    model.load_state_dict(torch.load(path, map_location=torch.device('cpu')))
+    model = model.eval()
+    return model